@@ -1,9 +1,52 @@
-from google.appengine.api import mail
 from google.appengine.api import users
+from google.appengine.api.labs import taskqueue
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import util
-from google.appengine.ext.webapp import template
+import logging
 import os
+import time
+
+from main import Photo, PhotoActivity, UniqueContributors
+from main import FETCHLIMIT
+from main import genPhotoKeyName, genActivityKeyName, genContributorKeyName
+from main import Vote
+from main import getPhotos
+from main import STAT_ACTIVITIES, STAT_UNVOTED, STAT_PHOTOS, STAT_CONTRIBUTORS, STAT_VOTES
+from main import ACTIVITYTYPES, genActivityTypeStatName
+from main import CACHEGROUPS
+from main import store, fillinActivityVotes, fillinContributorVotes
+import bulkdata
+import cache
+import counters
+import instrument
+
+# number of entities copied over per migration task
+MIGRATIONBATCH = 100
+
+# kinds that are exported and restored, in the order they are restored
+EXPORTKINDS = dict((model.kind(), model) for model in [Photo, PhotoActivity, UniqueContributors, Vote])
+EXPORTORDER = ['Photo', 'PhotoActivity', 'UniqueContributors', 'Vote']
+
+# kinds that are stored under key names, the property that holds the flickr id,
+# and how that id becomes a key name
+KEYNAMEDKINDS = [('Photo', Photo, 'uid', genPhotoKeyName),
+                 ('PhotoActivity', PhotoActivity, 'activity_id', genActivityKeyName),
+                 ('UniqueContributors', UniqueContributors, 'author', genContributorKeyName)]
+
+def genStatQueries():
+    "the query that counts the real value of each aggregate count, in the order they are reconciled"
+    queries = [(STAT_PHOTOS, Photo.all(keys_only=True)),
+               (STAT_CONTRIBUTORS, UniqueContributors.all(keys_only=True)),
+               (STAT_VOTES, Vote.all(keys_only=True)),
+               (STAT_ACTIVITIES, PhotoActivity.all(keys_only=True)),
+               (STAT_UNVOTED, PhotoActivity.all(keys_only=True).filter("vote_count =", 0))]
+    for activity_type in ACTIVITYTYPES:
+        queries.append((genActivityTypeStatName(activity_type), PhotoActivity.all(keys_only=True).filter("activity_type =", activity_type)))
+    return queries
+
+def getStatNames():
+    return [name for name, query in genStatQueries()]
 
 class AdminHandler(webapp.RequestHandler):
     def get(self):
@@ -14,19 +57,254 @@ class AdminHandler(webapp.RequestHandler):
         url = users.create_logout_url(self.request.uri)
         url_linktext = 'Logout'
         
+        stats = counters.getStats(getStatNames())
         template_values = {
             'nickname': nickname,
             'url': url,
             'url_linktext': url_linktext,
+            'stats': [(name, stats[name]) for name in getStatNames()],
+            'cache_rates': cache.getHitRates(CACHEGROUPS),
+            'handler_summaries': instrument.getSummaries(),
+            'slowest': instrument.getSlowest(),
             }
         
         path = os.path.join(os.path.dirname(__file__), 'admin_overview.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(instrument.renderTemplate(path, template_values))
                 
+def migrateEntity(model, legacy_key, keyname):
+    """copy one entity stored with a numeric id over to keyname and delete it,
+    in one cross group transaction. a retried task finds the entity already
+    gone, so its votes are never counted onto the copy twice"""
+    def txn():
+        entity = db.get(legacy_key)
+        if entity is None:
+            return
+        target = model.get_by_key_name(keyname)
+        if target is None:
+            values = dict((name, getattr(entity, name)) for name in entity.properties())
+            target = model(key_name=keyname, **values)
+        elif hasattr(target, 'vote_sum'):
+            # the same flickr id was stored twice, keep the votes from both
+            target.vote_sum = target.vote_sum + entity.vote_sum
+            target.vote_count = target.vote_count + entity.vote_count
+        target.put()
+        entity.delete()
+    db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+
+def migrateKeyNameBatch(model, id_property, keyname_func, cursor):
+    """copy one batch of entities that were stored with numeric ids over to
+    their key named equivalents, returns the cursor for the next batch, or None
+    when the kind is done"""
+    query = model.all()
+    if cursor:
+        query.with_cursor(cursor)
+    batch = query.fetch(MIGRATIONBATCH)
+    for entity in batch:
+        if entity.key().name() is None:
+            migrateEntity(model, entity.key(), keyname_func(getattr(entity, id_property)))
+    if len(batch) < MIGRATIONBATCH:
+        return None
+    return query.cursor()
+
+class MigrateKeyNames(webapp.RequestHandler):
+    """moves Photo, PhotoActivity and UniqueContributors entities created before
+    they were stored under key names. halt the photosq and activityq queues
+    while this runs, otherwise ingestion will not see the old entities and
+    may store activities twice."""
+    def get(self):
+        kind_index = int(self.request.get('kind', 0))
+        cursor = self.request.get('cursor', None)
+        if kind_index >= len(KEYNAMEDKINDS):
+            self.response.out.write('key name migration is complete')
+            return
+        kind_name, model, id_property, keyname_func = KEYNAMEDKINDS[kind_index]
+        next_cursor = migrateKeyNameBatch(model, id_property, keyname_func, cursor)
+        if next_cursor:
+            params = {'kind': kind_index, 'cursor': next_cursor}
+        else:
+            logging.info('key name migration of %s is complete' % kind_name)
+            params = {'kind': kind_index + 1}
+        taskqueue.add(url='/admin/migratekeys/', params=params, method='GET')
+        self.response.out.write('migrating %s' % kind_name)
+
+def backfillPhotoLinksBatch(cursor):
+    """copy photo page and thumbnail links onto one batch of activities that
+    were created without them, returns the cursor for the next batch, or None
+    when all activities have been looked at"""
+    query = PhotoActivity.all()
+    if cursor:
+        query.with_cursor(cursor)
+    batch = query.fetch(MIGRATIONBATCH)
+    activities = [a for a in batch if not a.photothumb_url]
+    photos = getPhotos([a.photo_id for a in activities])
+    changed = []
+    for activity in activities:
+        photo = photos.get(activity.photo_id)
+        if photo:
+            activity.photopage_url = photo.photopage_url
+            activity.photothumb_url = photo.photothumb_url
+            changed.append(activity)
+    db.put(changed)
+    if len(batch) < MIGRATIONBATCH:
+        return None
+    return query.cursor()
+
+class BackfillPhotoLinks(webapp.RequestHandler):
+    "stores photo links on activities created before they were kept on the activity"
+    def get(self):
+        cursor = self.request.get('cursor', None)
+        next_cursor = backfillPhotoLinksBatch(cursor)
+        if next_cursor:
+            taskqueue.add(url='/admin/backfillphotolinks/', params={'cursor': next_cursor}, method='GET')
+            self.response.out.write('backfilling photo links')
+        else:
+            logging.info('photo link backfill is complete')
+            self.response.out.write('photo link backfill is complete')
+
+class ReconcileStats(webapp.RequestHandler):
+    """counts the real number of photos, activities, contributors and votes and
+    corrects the aggregate counts to match, to take out any drift. each task
+    counts a batch of keys and hands the running total on to the next"""
+    def get(self):
+        stat_index = int(self.request.get('stat', 0))
+        cursor = self.request.get('cursor', None)
+        counted = int(self.request.get('counted', 0))
+        queries = genStatQueries()
+        if stat_index >= len(queries):
+            self.response.out.write('stats are reconciled')
+            return
+        name, query = queries[stat_index]
+        if cursor:
+            query.with_cursor(cursor)
+        batch = query.fetch(FETCHLIMIT)
+        counted = counted + len(batch)
+        if len(batch) == FETCHLIMIT:
+            params = {'stat': stat_index, 'cursor': query.cursor(), 'counted': counted}
+        else:
+            counters.setStat(name, counted)
+            params = {'stat': stat_index + 1}
+        taskqueue.add(url='/admin/reconcilestats/', params=params, method='GET')
+        self.response.out.write('reconciling %s' % name)
+
+# export and restore
+
+def prepareExport(model, entities):
+    """activities and contributors are exported with their live vote tallies
+    and unsharded, so once restored their counters start from those tallies"""
+    if model is PhotoActivity:
+        entities = fillinActivityVotes(entities)
+    elif model is UniqueContributors:
+        entities = fillinContributorVotes(entities)
+    for entity in entities:
+        if getattr(entity, 'votes_sharded', False):
+            entity.votes_sharded = False
+    return entities
+
+def queueExportStep(job):
+    # named from the job's progress, so a step can't be queued twice
+    name = 'export-%d-%d-%d-%d' % (job.key().id(), job.run, job.kind_index, job.chunk_count)
+    try:
+        taskqueue.add(url='/admin/export/step/', params={'job': job.key().id()}, method='GET', name=name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+class ExportData(webapp.RequestHandler):
+    """lists the exports with links to their chunks. posting starts a new
+    export, or with a job id, resumes one that stopped"""
+    def get(self):
+        jobs = bulkdata.ExportJob.all().order('-started').fetch(20)
+        template_values = {'jobs': [(job, range(job.chunk_count)) for job in jobs]}
+        path = os.path.join(os.path.dirname(__file__), 'admin_export.html')
+        self.response.out.write(instrument.renderTemplate(path, template_values))
+
+    def post(self):
+        job_id = self.request.get('job')
+        if job_id:
+            job = bulkdata.ExportJob.get_by_id(int(job_id))
+            job.run = job.run + 1
+            job.put()
+        else:
+            job = bulkdata.startExport(EXPORTORDER)
+        if not job.done:
+            queueExportStep(job)
+        self.redirect('/admin/export/')
+
+class ExportStep(webapp.RequestHandler):
+    "exports one slice of a job and queues the next"
+    def get(self):
+        job = bulkdata.ExportJob.get_by_id(int(self.request.get('job')))
+        if job is None or job.done:
+            return
+        if bulkdata.exportSlice(store, job, EXPORTKINDS, prepareExport):
+            queueExportStep(job)
+        else:
+            logging.info('export %d is complete, %d entities in %d chunks' % (job.key().id(), job.entity_count, job.chunk_count))
+        self.response.out.write('exported %d entities' % job.entity_count)
+
+class DownloadChunk(webapp.RequestHandler):
+    "one chunk of an export, as a gzipped json lines file"
+    def get(self):
+        job_id = int(self.request.get('job'))
+        sequence = int(self.request.get('seq'))
+        chunk = bulkdata.getChunk(job_id, sequence)
+        if chunk is None:
+            self.error(404)
+            return
+        self.response.headers['Content-Type'] = 'application/x-gzip'
+        self.response.headers['Content-Disposition'] = 'attachment; filename=export-%d-%06d-%s.jsonl.gz' % (job_id, sequence, chunk.entity_kind)
+        self.response.out.write(chunk.data)
+
+class RestoreData(webapp.RequestHandler):
+    """posting a chunk file restores its entities straight away, posting an
+    export's job id restores all of its chunks in a chain of tasks. either can
+    be repeated, entities go back under their own key names and ids"""
+    def post(self):
+        data = self.request.get('chunk')
+        if data:
+            restored = bulkdata.restoreChunk(store, data, EXPORTKINDS)
+            self.response.out.write('restored %d entities' % restored)
+            return
+        job_id = int(self.request.get('job'))
+        queueRestoreStep(job_id, int(time.time()), 0)
+        self.redirect('/admin/export/')
+
+def queueRestoreStep(job_id, run, sequence):
+    # named from the restore's progress, so a retried step can't queue the next twice
+    name = 'restore-%d-%d-%d' % (job_id, run, sequence)
+    try:
+        taskqueue.add(url='/admin/restore/step/', params={'job': job_id, 'run': run, 'seq': sequence}, method='GET', name=name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+class RestoreStep(webapp.RequestHandler):
+    "restores one chunk of an export and queues the next"
+    def get(self):
+        job_id = int(self.request.get('job'))
+        sequence = int(self.request.get('seq'))
+        chunk = bulkdata.getChunk(job_id, sequence)
+        if chunk is None:
+            logging.info('restore of export %d is complete, %d chunks' % (job_id, sequence))
+            self.response.out.write('restore is complete')
+            return
+        restored = bulkdata.restoreChunk(store, chunk.data, EXPORTKINDS)
+        queueRestoreStep(job_id, int(self.request.get('run') or 0), sequence + 1)
+        self.response.out.write('restored %d entities' % restored)
+
+ROUTES = [('/admin/', AdminHandler),
+          ('/admin/migratekeys/', MigrateKeyNames),
+          ('/admin/backfillphotolinks/', BackfillPhotoLinks),
+          ('/admin/reconcilestats/', ReconcileStats),
+          ('/admin/export/', ExportData),
+          ('/admin/export/step/', ExportStep),
+          ('/admin/export/chunk/', DownloadChunk),
+          ('/admin/restore/', RestoreData),
+          ('/admin/restore/step/', RestoreStep)]
+
+def makeApplication():
+    return instrument.instrument(webapp.WSGIApplication(ROUTES, debug=True))
+
 def main():
-    application = webapp.WSGIApplication([('/admin/', AdminHandler)],
-                                         debug=True)
-    util.run_wsgi_app(application)
+    util.run_wsgi_app(makeApplication())
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
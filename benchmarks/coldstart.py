@@ -0,0 +1,128 @@
+"""cold start cost of each entry point.
+
+every run is a fresh python process, as a new instance would be. it sets up
+the appengine sdk's service stubs, then times importing the entry point and
+building its application, and then serving its first request. it reports
+the median of --runs runs, the modules the import loaded, and which of the
+heavy ones (the webapp template module and its django, the flickr client and
+its xml parsing, urlfetch, mail) the app had loaded by the end of the first
+request. the stubs load urlfetch and mail themselves, so those only show up
+if something else does.
+
+"main" is every route in one application, as the app was served before it
+was split, for comparison.
+
+run from the top of the checkout, with the sdk somewhere it can be found:
+
+    python benchmarks/coldstart.py --sdk ~/google_appengine --runs 10
+
+the stubs are set up before the clock starts, so the times are what the
+app's own modules cost on top of the runtime, not the whole instance start.
+"""
+import json
+import optparse
+import os
+import subprocess
+import sys
+import time
+import types
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# each entry point, and the first request it is timed serving
+ENTRYPOINTS = [('votes', 'POST', '/rpcincrement?actor=12345@N00&activityid=1'),
+               ('browse', 'GET', '/listactivities/'),
+               ('ingest', 'POST', '/search/index/?ids=1'),
+               ('admin', 'GET', '/admin/'),
+               ('main', 'POST', '/rpcincrement?actor=12345@N00&activityid=1')]
+
+HEAVYMODULES = [('templates', 'google.appengine.ext.webapp.template'),
+                ('flickr', 'flickrclient'),
+                ('xml', 'flickrxml'),
+                ('urlfetch', 'google.appengine.api.urlfetch'),
+                ('mail', 'google.appengine.api.mail')]
+
+def setupSdk(sdk):
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+def installConfig():
+    config = types.ModuleType('config')
+    config.apikey = 'benchmark'
+    config.GROUPID = 'benchmark@N00'
+    config.FETCHLIMIT = 1000
+    config.PAGINGLIMIT = 10
+    sys.modules['config'] = config
+
+def seedActivity():
+    "one activity and its contributor, so the first vote goes all the way through"
+    from google.appengine.api import datastore
+    activity = datastore.Entity('PhotoActivity', name='a1')
+    activity.update({'activity_id': '1', 'photo_id': '1', 'author': '12345@N00', 'activity_type': 'tag',
+                     'activity_content': 'a tag', 'vote_sum': 0, 'vote_count': 0, 'votes_sharded': False})
+    contributor = datastore.Entity('UniqueContributors', name='u12345@N00')
+    contributor.update({'author': '12345@N00', 'vote_sum': 0, 'vote_count': 0, 'votes_sharded': False})
+    datastore.Put([activity, contributor])
+
+def runChild(module_name, method, path):
+    "one cold start, in this process, returns the measurements"
+    from google.appengine.ext import testbed
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id='flickr-voter', USER_EMAIL='admin@example.com', USER_IS_ADMIN='1', overwrite=True)
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_user_stub()
+    installConfig()
+    seedActivity()
+    from google.appengine.ext import webapp
+    before = set(sys.modules)
+    start = time.time()
+    module = __import__(module_name)
+    app = module.makeApplication()
+    imported = time.time()
+    loaded = len(set(sys.modules) - before)
+    request = webapp.Request.blank(path)
+    request.method = method
+    response = request.get_response(app)
+    served = time.time()
+    # the stubs load some of these themselves, only count what the app loaded
+    heavy = [name for name, module_path in HEAVYMODULES if module_path in sys.modules and module_path not in before]
+    return {'import_ms': (imported - start) * 1000, 'request_ms': (served - imported) * 1000,
+            'modules': loaded, 'heavy': heavy, 'status': response.status_int}
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--sdk', default=os.environ.get('APPENGINE_SDK', ''), help='path to the appengine python sdk')
+    parser.add_option('--runs', type='int', default=10, help='cold starts of each entry point')
+    parser.add_option('--child', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+    if options.sdk:
+        setupSdk(options.sdk)
+    if options.child:
+        method, path = args
+        print(json.dumps(runChild(options.child, method, path)))
+        return
+    print('%-8s %10s %11s %8s %7s  %s' % ('entry', 'import ms', 'request ms', 'modules', 'status', 'heavy modules loaded'))
+    for module_name, method, path in ENTRYPOINTS:
+        runs = []
+        for i in range(options.runs):
+            command = [sys.executable, os.path.abspath(__file__), '--child', module_name, method, path]
+            if options.sdk:
+                command.extend(['--sdk', options.sdk])
+            output = subprocess.check_output(command).decode('utf-8')
+            runs.append(json.loads(output.strip().split('\n')[-1]))
+        print('%-8s %10.1f %11.1f %8d %7d  %s' % (module_name, median([r['import_ms'] for r in runs]),
+                                                  median([r['request_ms'] for r in runs]), median([r['modules'] for r in runs]),
+                                                  runs[-1]['status'], ', '.join(runs[-1]['heavy']) or '-'))
+
+if __name__ == '__main__':
+    main()
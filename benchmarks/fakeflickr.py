@@ -0,0 +1,324 @@
+"""a local stand in for the parts of the flickr rest api the app calls.
+
+it serves flickr.groups.pools.getPhotos, flickr.photos.getInfo,
+flickr.photos.comments.getList and flickr.photos.getSizes for a synthetic
+group. the group is generated from a seed, so the same options always give the
+same pool and the same activity. time moves on in cycles: every cycle
+GROWTH new photos join the pool, and each photo has a CHURN chance of picking
+up a new comment, and a smaller chance of a new tag or note.
+
+run it on its own and point FLICKRAPIURL in config.py at it:
+
+    python benchmarks/fakeflickr.py --photos 10000 --port 8090
+
+GET /fake/advance moves on a cycle, /fake/stats returns the calls served so
+far as json and /fake/reset zeroes them. benchmarks/ingestion.py runs it in
+process instead.
+"""
+import json
+import optparse
+import random
+import threading
+import time
+import zlib
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qsl
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qsl
+
+from xml.sax.saxutils import quoteattr, escape
+
+# the dateadded of the oldest photo in the pool
+EPOCH = 1270000000
+# seconds between photos being added, and the length of one cycle
+ADDSPACING = 60
+CYCLESECONDS = 15*60
+# the first photo id, real ids are about this long
+FIRSTID = 5000000000
+
+OWNERS = 500
+# tags and notes turn up less often than comments
+TAGSHARE = 0.3
+NOTESHARE = 0.1
+# activity ids start with one of these, so tags, notes and comments never share an id
+IDPREFIX = {'comment': 6065, 'tag': 1, 'note': 7000}
+
+class SyntheticGroup(object):
+    "a pool of photos and their activity, worked out from the seed whenever it is asked for"
+    def __init__(self, photos, churn=0.02, growth=0, seed=1):
+        self.initial = photos
+        self.churn = churn
+        self.growth = growth
+        self.seed = seed
+        self.cycle = 0
+
+    def advance(self):
+        self.cycle = self.cycle + 1
+
+    def size(self):
+        return self.initial + self.growth * self.cycle
+
+    def _chance(self, *parts):
+        "a number in [0, 1) fixed by the seed and parts"
+        key = '-'.join([str(self.seed)] + [str(part) for part in parts])
+        return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) / 4294967296.0
+
+    def photoId(self, n):
+        return str(FIRSTID + n)
+
+    def photoNumber(self, photo_id):
+        "returns the number of a photo id, or None if it isn't in the pool"
+        try:
+            n = int(photo_id) - FIRSTID
+        except ValueError:
+            return None
+        if 0 <= n < self.size():
+            return n
+        return None
+
+    def addedCycle(self, n):
+        if n < self.initial:
+            return 0
+        return (n - self.initial) // self.growth + 1
+
+    def dateAdded(self, n):
+        return EPOCH + n * ADDSPACING
+
+    def owner(self, n):
+        return '%d@N00' % (10000 + n % OWNERS)
+
+    def activityCycles(self, n, kind, share):
+        "the cycles a photo has had activity of one kind in"
+        first = self.addedCycle(n)
+        base = int(self._chance(n, kind, 'base') * 4 * share)
+        cycles = [first] * base
+        for cycle in range(first + 1, self.cycle + 1):
+            if self._chance(n, kind, cycle) < self.churn * share:
+                cycles.append(cycle)
+        return cycles
+
+    def cycleTime(self, cycle):
+        return EPOCH + self.initial * ADDSPACING + cycle * CYCLESECONDS
+
+    def lastUpdate(self, n):
+        newest = self.addedCycle(n)
+        for kind, share in (('comment', 1.0), ('tag', TAGSHARE), ('note', NOTESHARE)):
+            cycles = self.activityCycles(n, kind, share)
+            if cycles:
+                newest = max(newest, cycles[-1])
+        return max(self.dateAdded(n), self.cycleTime(newest))
+
+    def activity(self, n, kind, share):
+        "returns a list of (id, author, date, text) for one kind of activity on a photo"
+        items = []
+        for i, cycle in enumerate(self.activityCycles(n, kind, share)):
+            author = '%d@N00' % (10000 + int(self._chance(n, kind, i, 'author') * OWNERS))
+            date = self.cycleTime(cycle) + i
+            items.append(('%d-%s-%d' % (IDPREFIX[kind], self.photoId(n), i), author, date, '%s %d on photo %d' % (kind, i, n)))
+        return items
+
+class Faults(object):
+    "latency and errors added to responses"
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, fail_rate=0.0, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def draw(self):
+        "returns (delay in seconds, http error, flickr failure) for one call"
+        self.lock.acquire()
+        try:
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            roll = self.random.random()
+        finally:
+            self.lock.release()
+        return delay, roll < self.error_rate, self.error_rate <= roll < self.error_rate + self.fail_rate
+
+# responses
+
+def ok(body):
+    return '<?xml version="1.0" encoding="utf-8" ?>\n<rsp stat="ok">\n%s\n</rsp>' % body
+
+def fail(code, message):
+    return '<?xml version="1.0" encoding="utf-8" ?>\n<rsp stat="fail">\n<err code="%d" msg=%s />\n</rsp>' % (code, quoteattr(message))
+
+def poolPhotos(group, params):
+    page = max(1, int(params.get('page', 1)))
+    per_page = min(500, max(1, int(params.get('per_page', 100))))
+    extras = params.get('extras', '').split(',')
+    size = group.size()
+    pages = (size + per_page - 1) // per_page
+    rows = []
+    # newest first, as flickr lists pools
+    start = size - 1 - (page - 1) * per_page
+    for n in range(start, max(-1, start - per_page), -1):
+        attrs = 'id="%s" owner="%s" secret="s%x" server="%d" farm="5" title="photo %d" ispublic="1" isfriend="0" isfamily="0" ownername="owner %d" dateadded="%d"' % (
+            group.photoId(n), group.owner(n), n, 1000 + n % 9, n, n % OWNERS, group.dateAdded(n))
+        if 'last_update' in extras:
+            attrs = attrs + ' lastupdate="%d"' % group.lastUpdate(n)
+        rows.append('<photo %s />' % attrs)
+    return ok('<photos page="%d" pages="%d" perpage="%d" total="%d">\n%s\n</photos>' % (page, pages, per_page, size, '\n'.join(rows)))
+
+def photoInfo(group, n):
+    tags = ['<tag id=%s author=%s raw=%s machine_tag="0">%s</tag>' % (quoteattr(item_id), quoteattr(author), quoteattr(text), escape(text.replace(' ', '')))
+            for item_id, author, date, text in group.activity(n, 'tag', TAGSHARE)]
+    notes = ['<note id=%s author=%s authorname="someone" x="10" y="10" w="50" h="50">%s</note>' % (quoteattr(item_id), quoteattr(author), escape(text))
+             for item_id, author, date, text in group.activity(n, 'note', NOTESHARE)]
+    return ok('<photo id="%s" secret="s%x" server="%d" farm="5" dateuploaded="%d" license="0" rotation="0" views="%d" media="photo">\n'
+              '<owner nsid="%s" username="owner %d" />\n<title>photo %d</title>\n<description />\n'
+              '<dates posted="%d" taken="2010-05-28 18:42:18" takengranularity="0" lastupdate="%d" />\n'
+              '<notes>%s</notes>\n<tags>%s</tags>\n</photo>' % (
+                  group.photoId(n), n, 1000 + n % 9, group.dateAdded(n), n % 1000, group.owner(n), n % OWNERS, n,
+                  group.dateAdded(n), group.lastUpdate(n), ''.join(notes), ''.join(tags)))
+
+def photoComments(group, n, params):
+    min_date = int(params.get('min_comment_date') or 0)
+    rows = ['<comment id=%s author=%s authorname="someone" datecreate="%d" permalink="http://www.flickr.com/photos/x/%s/#comment%s">%s</comment>'
+            % (quoteattr(item_id), quoteattr(author), date, group.photoId(n), item_id, escape(text))
+            for item_id, author, date, text in group.activity(n, 'comment', 1.0) if date >= min_date]
+    return ok('<comments photo_id="%s">\n%s\n</comments>' % (group.photoId(n), '\n'.join(rows)))
+
+def photoSizes(group, n):
+    base = 'http://farm5.static.flickr.com/%d/%s_s%x' % (1000 + n % 9, group.photoId(n), n)
+    sizes = [('Square', 75, 75, '_s'), ('Thumbnail', 100, 75, '_t'), ('Small', 240, 180, '_m'), ('Medium', 500, 375, '')]
+    rows = ['<size label="%s" width="%d" height="%d" source="%s%s.jpg" url="http://www.flickr.com/photos/x/%s/sizes/%s/" media="photo" />'
+            % (label, width, height, base, suffix, group.photoId(n), label[0].lower()) for label, width, height, suffix in sizes]
+    return ok('<sizes canblog="0" canprint="0" candownload="1">\n%s\n</sizes>' % '\n'.join(rows))
+
+METHODS = ['flickr.groups.pools.getPhotos', 'flickr.photos.getInfo',
+           'flickr.photos.comments.getList', 'flickr.photos.getSizes']
+
+def respond(group, params):
+    "returns the body of the response to one rest call"
+    method = params.get('method')
+    if method not in METHODS:
+        return fail(112, 'Method "%s" not found' % method)
+    if method == 'flickr.groups.pools.getPhotos':
+        return poolPhotos(group, params)
+    n = group.photoNumber(params.get('photo_id', ''))
+    if n is None:
+        return fail(1, 'Photo "%s" not found (invalid ID)' % params.get('photo_id', ''))
+    if method == 'flickr.photos.getInfo':
+        return photoInfo(group, n)
+    if method == 'flickr.photos.comments.getList':
+        return photoComments(group, n, params)
+    return photoSizes(group, n)
+
+# the server
+
+class FakeFlickrServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, group, faults):
+        HTTPServer.__init__(self, address, FakeFlickrHandler)
+        self.group = group
+        self.faults = faults
+        self.stats_lock = threading.Lock()
+        self.resetStats()
+
+    def resetStats(self):
+        self.stats_lock.acquire()
+        try:
+            self.stats = dict((method, 0) for method in METHODS)
+            self.stats['errors'] = 0
+            self.stats['failures'] = 0
+        finally:
+            self.stats_lock.release()
+
+    def count(self, name):
+        self.stats_lock.acquire()
+        try:
+            self.stats[name] = self.stats.get(name, 0) + 1
+        finally:
+            self.stats_lock.release()
+
+    def calls(self):
+        "the number of rest calls served since the last reset"
+        return sum([self.stats[method] for method in METHODS])
+
+class FakeFlickrHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, content_type='text/xml; charset=utf-8'):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        if url.path == '/fake/advance':
+            server.group.advance()
+            return self.send(200, json.dumps({'cycle': server.group.cycle, 'photos': server.group.size()}), 'application/json')
+        if url.path == '/fake/stats':
+            return self.send(200, json.dumps(server.stats), 'application/json')
+        if url.path == '/fake/reset':
+            server.resetStats()
+            return self.send(200, '{}', 'application/json')
+        params = dict(parse_qsl(url.query))
+        delay, error, failure = server.faults.draw()
+        if delay:
+            time.sleep(delay)
+        if error:
+            server.count('errors')
+            return self.send(503, 'flickr is having a rest')
+        server.count(params.get('method', 'unknown'))
+        if failure:
+            server.count('failures')
+            return self.send(200, fail(105, 'Service currently unavailable'))
+        self.send(200, respond(server.group, params))
+
+def start(group, faults=None, port=0):
+    "serve group from a background thread, returns the server. port 0 picks a free port"
+    server = FakeFlickrServer(('127.0.0.1', port), group, faults or Faults())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def apiUrl(server):
+    return 'http://127.0.0.1:%d/services/rest/' % server.server_address[1]
+
+def optionParser():
+    parser = optparse.OptionParser()
+    parser.add_option('--photos', type='int', default=1000, help='photos in the pool at the start')
+    parser.add_option('--churn', type='float', default=0.02, help='chance of a photo getting a new comment each cycle')
+    parser.add_option('--growth', type='int', default=0, help='photos added to the pool each cycle')
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--latency', type='float', default=0.0, help='seconds added to every call')
+    parser.add_option('--jitter', type='float', default=0.0, help='seconds the latency varies by either way')
+    parser.add_option('--error-rate', type='float', default=0.0, help='share of calls answered with a 503')
+    parser.add_option('--fail-rate', type='float', default=0.0, help='share of calls answered with stat="fail"')
+    return parser
+
+def groupFromOptions(options):
+    return SyntheticGroup(options.photos, options.churn, options.growth, options.seed)
+
+def faultsFromOptions(options):
+    return Faults(options.latency, options.jitter, options.error_rate, options.fail_rate, options.seed)
+
+def main():
+    parser = optionParser()
+    parser.add_option('--port', type='int', default=8090)
+    options, args = parser.parse_args()
+    server = FakeFlickrServer(('127.0.0.1', options.port), groupFromOptions(options), faultsFromOptions(options))
+    print('serving a group of %d photos at %s' % (options.photos, apiUrl(server)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
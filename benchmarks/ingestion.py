@@ -0,0 +1,216 @@
+"""end to end ingestion benchmark, against benchmarks/fakeflickr.py.
+
+it runs the app's handlers in process on the appengine sdk's service stubs,
+with a fake flickr serving a synthetic group, and for each pool size reports
+the wall time, flickr calls, datastore rpcs, tasks run and tasks that failed by
+
+  GetPhotos               the first sync of the whole pool, and the chain of
+                          tasks it hands on to
+  LoadQueues              one enginestart tick, and every task it queues,
+                          once per cycle of activity on the fake
+  UpdateAllPhotoActivity  one sweep of /getupdates/
+
+run from the top of the checkout, with the sdk somewhere it can be found:
+
+    python benchmarks/ingestion.py --sdk ~/google_appengine --sizes 1000,10000,100000
+
+the fake's latency, churn and errors can be set with the same options as
+fakeflickr.py. --storage sqlite keeps the app's photos, activities and votes in
+a temporary sqlite file rather than the datastore stub, see storage.py. each cycle moves the app's clock on by CYCLESECONDS, so photos
+come due and tasks are named as they would be on successive cron ticks.
+"""
+import base64
+import os
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakeflickr
+
+def setupSdk(sdk):
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+def installConfig(options, api_url):
+    "the app reads its settings from config.py, point it at the fake instead"
+    config = types.ModuleType('config')
+    config.apikey = 'benchmark'
+    config.GROUPID = 'benchmark@N00'
+    config.FETCHLIMIT = options.fetchlimit
+    config.PAGINGLIMIT = 10
+    config.FLICKRAPIURL = api_url
+    config.FLICKRQUOTA = options.quota
+    config.STORAGEBACKEND = options.storage
+    config.SQLITEPATH = tempfile.mktemp(suffix='.sqlite')
+    sys.modules['config'] = config
+
+class AppClock(object):
+    "the time as the app sees it, moved on a cycle at a time"
+    def __init__(self):
+        self.offset = timedelta(0)
+
+    def time(self):
+        return time.time() + self.offset.total_seconds()
+
+    def advance(self, seconds):
+        self.offset = self.offset + timedelta(seconds=seconds)
+
+def installClock(modules, clock):
+    class ShiftedDatetime(datetime):
+        @classmethod
+        def now(cls):
+            # a plain datetime, the datastore won't store subclasses
+            return datetime.now() + clock.offset
+    for module in modules:
+        module.datetime = ShiftedDatetime
+        module.clock = clock
+
+class RpcCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def hook(self, service, call, request, response):
+        self.count = self.count + 1
+
+class Harness(object):
+    "one pool size: a fake flickr, fresh service stubs and the app"
+    def __init__(self, options, size):
+        from google.appengine.ext import testbed
+        from google.appengine.api import apiproxy_stub_map
+        self.options = options
+        self.size = size
+        self.group = fakeflickr.SyntheticGroup(size, options.churn, options.growth, options.seed)
+        self.server = fakeflickr.start(self.group, fakeflickr.faultsFromOptions(options))
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='flickr-voter', overwrite=True)
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_urlfetch_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_user_stub()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.rpcs = RpcCounter()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('benchmark', self.rpcs.hook, 'datastore_v3')
+        installConfig(options, fakeflickr.apiUrl(self.server))
+        import main
+        import ingest
+        import storage
+        # only read when they are first imported, so set them again for later sizes
+        ingest.FLICKRAPIURL = fakeflickr.apiUrl(self.server)
+        storage.SQLITEPATH = sys.modules['config'].SQLITEPATH
+        main.store = ingest.store = storage.openBackend(main.store_models)
+        self.clock = AppClock()
+        installClock([main, ingest], self.clock)
+        self.app = main.makeApplication()
+        self.tasks = 0
+        self.failures = 0
+
+    def close(self):
+        self.server.shutdown()
+        self.testbed.deactivate()
+        path = sys.modules['config'].SQLITEPATH
+        if os.path.exists(path):
+            os.remove(path)
+
+    def get(self, url):
+        from google.appengine.ext import webapp
+        response = webapp.Request.blank(url).get_response(self.app)
+        if response.status_int >= 400:
+            print('  %s returned %s' % (url, response.status))
+
+    def runTask(self, queue, task):
+        "run a task the way its queue would, with its method, headers and body"
+        from google.appengine.ext import webapp
+        request = webapp.Request.blank(task['url'])
+        request.method = task['method']
+        for name, value in task['headers']:
+            # the stub gives the length of the encoded body, setting the body sets the real one
+            if name.lower() != 'content-length':
+                request.headers[name] = value
+        request.body = base64.b64decode(task['body'])
+        response = request.get_response(self.app)
+        if response.status_int >= 400:
+            self.failures = self.failures + 1
+            print('  %s %s task returned %s' % (task['method'], task['url'], response.status))
+        # the task is done, but its name stays taken, as it would on appengine
+        self.taskqueue._GetGroup().GetQueue(queue).Delete(task['name'])
+
+    def drain(self):
+        """run queued tasks until the queues are empty, or options.maxtasks have
+        run. tasks put off by the quota or a countdown stay queued until the
+        app's clock reaches them, so they run in a later cycle"""
+        while self.tasks < self.options.maxtasks:
+            now = self.clock.time() * 1000000
+            ran = 0
+            for queue in [queue['name'] for queue in self.taskqueue.GetQueues()]:
+                for task in self.taskqueue.GetTasks(queue):
+                    if task['eta_usec'] > now:
+                        continue
+                    self.runTask(queue, task)
+                    self.tasks = self.tasks + 1
+                    ran = ran + 1
+            if not ran:
+                return
+
+    def measure(self, stage, cycle, run):
+        self.server.resetStats()
+        self.rpcs.count = 0
+        self.tasks = 0
+        self.failures = 0
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+        print('%-24s %8d %6d %10.2f %8d %10d %8d %7d %7d' % (stage, self.size, cycle, elapsed, self.server.calls(),
+                                                             self.rpcs.count, self.tasks, self.failures, self.server.stats['errors']))
+
+    def getPhotos(self):
+        self.get('/getphotos/')
+        self.drain()
+
+    def loadQueues(self):
+        self.get('/enginestart')
+        self.drain()
+
+    def updateAll(self):
+        self.get('/getupdates/')
+        self.drain()
+
+    def run(self):
+        self.measure('GetPhotos', 0, self.getPhotos)
+        for cycle in range(1, self.options.cycles + 1):
+            self.group.advance()
+            self.clock.advance(fakeflickr.CYCLESECONDS)
+            self.measure('LoadQueues', cycle, self.loadQueues)
+        self.measure('UpdateAllPhotoActivity', self.options.cycles, self.updateAll)
+
+def main():
+    parser = fakeflickr.optionParser()
+    parser.remove_option('--photos')
+    parser.add_option('--sdk', default=os.environ.get('APPENGINE_SDK', ''), help='path to the appengine python sdk')
+    parser.add_option('--sizes', default='1000,10000,100000', help='pool sizes to run, comma separated')
+    parser.add_option('--cycles', type='int', default=3, help='enginestart ticks to run after the first sync')
+    parser.add_option('--fetchlimit', type='int', default=1000, help='FETCHLIMIT for the app')
+    parser.add_option('--quota', type='int', default=10000000, help='FLICKRQUOTA for the app, large enough not to matter by default')
+    parser.add_option('--storage', default='datastore', help='where the app keeps its data, datastore or sqlite')
+    parser.add_option('--maxtasks', type='int', default=100000, help='most tasks to run in one stage')
+    options, args = parser.parse_args()
+    if options.sdk:
+        setupSdk(options.sdk)
+    print('%-24s %8s %6s %10s %8s %10s %8s %7s %7s' % ('stage', 'photos', 'cycle', 'seconds', 'flickr', 'datastore', 'tasks', 'failed', 'errors'))
+    for size in [int(size) for size in options.sizes.split(',')]:
+        harness = Harness(options, size)
+        try:
+            harness.run()
+        finally:
+            harness.close()
+
+if __name__ == '__main__':
+    main()
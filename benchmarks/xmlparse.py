@@ -0,0 +1,127 @@
+"""compare reading flickr responses with flickrxml against the old minidom path.
+
+run from the top of the checkout:
+
+    python benchmarks/xmlparse.py
+
+it times both parsers over a 500 photo pool page, a getInfo response read for
+its lastupdate, tags and notes, and a comment list with thousands of comments,
+and reports peak memory where the python has tracemalloc.
+"""
+import os
+import sys
+import time
+from xml.dom import minidom
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import flickrxml
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+REPEATS = 20
+
+def genPoolPage(photos):
+    rows = []
+    for i in range(photos):
+        rows.append('<photo id="%d" owner="%d@N00" secret="abc%d" server="%d" title="photo number %d" ownername="owner %d" dateadded="%d" lastupdate="%d" />'
+                    % (4000000000 + i, 10000 + i % 97, i, 1000 + i % 9, i, i % 97, 1270000000 - i * 60, 1270000000 + i))
+    return '<rsp stat="ok"><photos page="1" pages="20" perpage="%d" total="%d">%s</photos></rsp>' % (photos, photos * 20, ''.join(rows))
+
+def genPhotoInfo(tags, notes):
+    tag_rows = ''.join(['<tag id="1-4000000000-%d" author="%d@N00" raw="tag %d">tag%d</tag>' % (i, 10000 + i, i, i) for i in range(tags)])
+    note_rows = ''.join(['<note id="%d" author="%d@N00" authorname="someone" x="10" y="10" w="50" h="50">note number %d</note>' % (7000 + i, 10000 + i, i) for i in range(notes)])
+    return ('<rsp stat="ok"><photo id="4000000000" secret="abc" server="1000"><title>a photo</title>'
+            '<dates posted="1270000000" taken="2010-05-28 18:42:18" lastupdate="1275000000" />'
+            '<notes>%s</notes><tags>%s</tags></photo></rsp>') % (note_rows, tag_rows)
+
+def genComments(comments):
+    rows = ''.join(['<comment id="6065-4000000000-%d" author="%d@N00" authorname="someone" datecreate="%d" permalink="http://www.flickr.com/photos/x/4000000000/#comment%d">comment number %d, which says rather a lot about the photo</comment>'
+                    % (i, 10000 + i % 500, 1270000000 + i, i, i) for i in range(comments)])
+    return '<rsp stat="ok"><comments photo_id="4000000000">%s</comments></rsp>' % rows
+
+# the old way, as main.py did it before flickrxml
+
+def minidomPool(response):
+    xml = minidom.parseString(response)
+    pages = int(xml.getElementsByTagName('photos')[0].getAttribute("pages"))
+    return pages, [(p.getAttribute("id"), p.getAttribute("dateadded")) for p in xml.getElementsByTagName('photo')]
+
+def minidomInfo(response):
+    # parsed once for the lastupdate, then once each for tags and notes
+    lastupdate = minidom.parseString(response).getElementsByTagName('dates')[0].getAttribute("lastupdate")
+    found = []
+    for activity_type in ["tag", "note"]:
+        for tag in minidom.parseString(response).getElementsByTagName(activity_type):
+            found.append((tag.getAttribute("id"), tag.firstChild.nodeValue))
+    return lastupdate, found
+
+def minidomComments(response):
+    return [(c.getAttribute("id"), c.firstChild.nodeValue) for c in minidom.parseString(response).getElementsByTagName('comment')]
+
+# the new way
+
+def streamPool(response):
+    pages = 0
+    photos = []
+    for record in flickrxml.records(response, set([flickrxml.POOL, flickrxml.POOLPHOTO])):
+        if record.kind == flickrxml.POOL:
+            pages = int(record.getAttribute("pages"))
+        else:
+            photos.append((record.getAttribute("id"), record.getAttribute("dateadded")))
+    return pages, photos
+
+def streamInfo(response):
+    lastupdate = None
+    found = []
+    for record in flickrxml.records(response, set([flickrxml.DATES, flickrxml.TAG, flickrxml.NOTE])):
+        if record.kind == flickrxml.DATES:
+            lastupdate = record.getAttribute("lastupdate")
+        else:
+            found.append((record.getAttribute("id"), record.text))
+    return lastupdate, found
+
+def streamComments(response):
+    # consumed one at a time, as extractActivity does
+    count = 0
+    for record in flickrxml.recordsOfKind(response, flickrxml.COMMENT):
+        count = count + 1
+    return count
+
+def measure(func, response):
+    start = time.time()
+    for i in range(REPEATS):
+        func(response)
+    elapsed = (time.time() - start) / REPEATS
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        func(response)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak
+
+def report(name, old, new, response):
+    old_time, old_peak = measure(old, response)
+    new_time, new_peak = measure(new, response)
+    print('%s (%d bytes)' % (name, len(response)))
+    print('  minidom   %8.2f ms' % (old_time * 1000) + (old_peak is not None and '  peak %8d KB' % (old_peak // 1024) or ''))
+    print('  flickrxml %8.2f ms' % (new_time * 1000) + (new_peak is not None and '  peak %8d KB' % (new_peak // 1024) or ''))
+
+def main():
+    pool = genPoolPage(500)
+    info = genPhotoInfo(75, 20)
+    comments = genComments(5000)
+    assert minidomPool(pool) == streamPool(pool)
+    old_lastupdate, old_found = minidomInfo(info)
+    new_lastupdate, new_found = streamInfo(info)
+    assert old_lastupdate == new_lastupdate and sorted(old_found) == sorted(new_found)
+    assert len(minidomComments(comments)) == streamComments(comments)
+    report('pool page, 500 photos', minidomPool, streamPool, pool)
+    report('getInfo, 75 tags and 20 notes', minidomInfo, streamInfo, info)
+    report('comment list, 5000 comments', minidomComments, streamComments, comments)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""the pages: listings of photos and activity, the actor pages, the league
+table and search. these are what people wait on, so this entry point loads
+nothing of the flickr client, xml parsing or mail.
+"""
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp import util
+
+import instrument
+from main import MainHandler, ListPhotos, ShowStoredPhotoActivity
+from main import ListActivities, ListUnvoted, SearchActivities
+from main import ActorVotes, ActorPictures, ActorActivity, ActorReport, ShowActors, LeagueTable
+from main import Advanced, Instructions
+
+ROUTES = [('/', MainHandler),
+          ('/photo/showactivity/(.*)', ShowStoredPhotoActivity),
+          ('/actor/votesreceived/(.*)', ActorVotes),
+          ('/actor/pictures/(.*)', ActorPictures),
+          ('/actor/activity/(.*)', ActorActivity),
+          ('/actor/report/(.*)', ActorReport),
+          ('/showactors/', ShowActors),
+          ('/leaguetable/', LeagueTable),
+          ('/listactivities/', ListActivities),
+          ('/listunvoted/', ListUnvoted),
+          ('/listphotos/', ListPhotos),
+          ('/search/', SearchActivities),
+          ('/advanced/', Advanced),
+          ('/instructions/', Instructions)]
+
+def makeApplication():
+    return instrument.instrument(webapp.WSGIApplication(ROUTES, debug=True))
+
+def main():
+    util.run_wsgi_app(makeApplication())
+
+if __name__ == '__main__':
+    main()
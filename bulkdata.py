@@ -0,0 +1,154 @@
+"""bulk export and restore of photos, activities, contributors and votes.
+
+an export job walks each kind in turn from a cursor, EXPORTBATCH entities a
+task, and keeps each slice as a chunk: gzipped json lines, one entity a line,
+
+  {"kind": "Photo", "name": "p1234", "properties": {...}}
+
+with "id" in place of "name" for entities that have no key name, such as
+votes. chunks can be downloaded one at a time and read with gunzip. the job
+keeps its kind and cursor after every slice, so a stopped export can carry on
+from where it got to.
+
+restoring puts a chunk's entities back under their own key names and ids,
+through the storage backend in use, so restoring a chunk twice leaves the
+same data as restoring it once, and an export from the datastore can be
+restored into the sqlite backend or the other way round.
+"""
+import zlib
+from datetime import datetime
+
+from django.utils import simplejson
+from google.appengine.ext import db
+
+import storage
+
+# entities read by one export task
+EXPORTBATCH = 500
+# entities put at a time when restoring
+RESTOREBATCH = 500
+# a slice bigger than this once compressed is split, so chunks fit in an entity
+CHUNKBYTES = 900000
+
+DATEFORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+class ExportJob(db.Model):
+    "one export, and how far it has got"
+    kinds = db.StringListProperty()
+    kind_index = db.IntegerProperty(default=0)
+    cursor = db.TextProperty()
+    chunk_count = db.IntegerProperty(default=0)
+    entity_count = db.IntegerProperty(default=0)
+    # bumped each time the job is resumed, so its tasks get fresh names
+    run = db.IntegerProperty(default=0)
+    done = db.BooleanProperty(default=False)
+    started = db.DateTimeProperty(auto_now_add=True)
+    updated = db.DateTimeProperty(auto_now=True)
+
+class ExportChunk(db.Model):
+    "one slice of an export, keyed by its job and sequence number"
+    job_id = db.IntegerProperty(required=True)
+    sequence = db.IntegerProperty(required=True)
+    entity_kind = db.StringProperty(required=True)
+    entity_count = db.IntegerProperty(default=0)
+    data = db.BlobProperty()
+
+def genChunkKeyName(job_id, sequence):
+    return "j%d/%06d" % (job_id, sequence)
+
+def getChunk(job_id, sequence):
+    return ExportChunk.get_by_key_name(genChunkKeyName(job_id, sequence))
+
+def encodeEntity(backend, entity):
+    properties = {}
+    for name in storage.propertyNames(entity.__class__):
+        value = getattr(entity, name)
+        if isinstance(value, datetime):
+            value = value.strftime(DATEFORMAT)
+        properties[name] = value
+    record = {"kind": entity.kind(), "properties": properties}
+    key_name = entity.has_key() and entity.key().name()
+    if key_name:
+        record["name"] = key_name
+    else:
+        record["id"] = backend.idOrName(entity)
+    return record
+
+def decodeEntity(backend, model, record):
+    values = {}
+    for name, value in record["properties"].items():
+        if value is not None and isinstance(model.properties()[name], db.DateTimeProperty):
+            value = datetime.strptime(value, DATEFORMAT)
+        values[str(name)] = value
+    return backend.newEntity(model, values, record.get("name"), record.get("id"))
+
+def compressLines(lines):
+    "gzip lines into chunks of at most CHUNKBYTES, returns a list of (data, line count)"
+    if not lines:
+        return []
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    data = compressor.compress("\n".join(lines) + "\n") + compressor.flush()
+    if len(data) <= CHUNKBYTES or len(lines) == 1:
+        return [(data, len(lines))]
+    half = len(lines) // 2
+    return compressLines(lines[:half]) + compressLines(lines[half:])
+
+def readChunk(data):
+    "the records of a chunk, as dicts"
+    text = zlib.decompress(data, 32 + zlib.MAX_WBITS)
+    return [simplejson.loads(line) for line in text.split("\n") if line]
+
+def startExport(kinds):
+    job = ExportJob(kinds=kinds)
+    job.put()
+    return job
+
+def exportSlice(backend, job, models, prepare=None):
+    """export the next EXPORTBATCH entities of job as one or more chunks.
+    models is a dict of kind -> model, prepare(model, entities) can change
+    the entities before they are written. returns True while there is more"""
+    model = models[job.kinds[job.kind_index]]
+    query = backend.query(model)
+    if job.cursor:
+        query.with_cursor(job.cursor)
+    entities = query.fetch(EXPORTBATCH)
+    if prepare:
+        entities = prepare(model, entities)
+    lines = [simplejson.dumps(encodeEntity(backend, entity)) for entity in entities]
+    chunks = []
+    for data, count in compressLines(lines):
+        chunks.append(ExportChunk(key_name=genChunkKeyName(job.key().id(), job.chunk_count), job_id=job.key().id(),
+                                  sequence=job.chunk_count, entity_kind=model.kind(), entity_count=count, data=data))
+        job.chunk_count = job.chunk_count + 1
+    job.entity_count = job.entity_count + len(entities)
+    if len(entities) < EXPORTBATCH:
+        job.kind_index = job.kind_index + 1
+        job.cursor = None
+    else:
+        job.cursor = query.cursor()
+    job.done = job.kind_index >= len(job.kinds)
+    # a chunk can be close to the size limit of a put, so they go one at a
+    # time. if any of these fail the slice is exported again under the same
+    # sequence numbers
+    for chunk in chunks:
+        chunk.put()
+    job.put()
+    return not job.done
+
+def restoreChunk(backend, data, models):
+    "put the entities of a chunk back, models is a dict of kind -> model. returns how many were put"
+    entities = []
+    ids = {}
+    for record in readChunk(data):
+        model = models.get(record["kind"])
+        if model is None:
+            raise ValueError("can't restore entities of kind %s" % record["kind"])
+        entities.append(decodeEntity(backend, model, record))
+        if record.get("id"):
+            ids.setdefault(model, []).append(record["id"])
+    # so votes made after the restore don't get the ids of restored ones
+    for model, model_ids in ids.items():
+        backend.reserveIds(model, model_ids)
+    for i in range(0, len(entities), RESTOREBATCH):
+        backend.put(entities[i:i+RESTOREBATCH])
+    return len(entities)
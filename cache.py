@@ -0,0 +1,65 @@
+"""read-through memcache for computed results and rendered pages.
+
+cached values are stored under keys that include the current version of each
+kind of data they were built from, such as votes or activity. anything that
+changes that data bumps its version, so readers move straight on to fresh keys
+and the stale entries are left to expire. hits and misses are counted per
+group of cached values, for the admin page.
+"""
+import time
+
+from google.appengine.api import memcache
+
+# how long a cached value is kept, even if nothing changes
+CACHESECONDS = 60*60
+
+def _versionKey(namespace):
+    return 'cacheversion/' + namespace
+
+def _newVersion():
+    # if a version is evicted it restarts from the clock, so it can't go back
+    # to a number that was used before
+    return int(time.time() * 1000)
+
+def getVersions(namespaces):
+    "returns a string made from the current version of each namespace"
+    keys = [_versionKey(namespace) for namespace in namespaces]
+    versions = memcache.get_multi(keys)
+    missing = dict((key, _newVersion()) for key in keys if key not in versions)
+    if missing:
+        memcache.add_multi(missing)
+        versions.update(memcache.get_multi(list(missing.keys())))
+    return '.'.join([str(versions.get(key, 0)) for key in keys])
+
+def bump(*namespaces):
+    "throw away everything cached from these namespaces"
+    for namespace in namespaces:
+        memcache.incr(_versionKey(namespace), initial_value=_newVersion())
+
+def _countKey(group, outcome):
+    return 'cachecount/%s/%s' % (group, outcome)
+
+def readThrough(group, key, namespaces, compute, time=CACHESECONDS):
+    """return the cached value of key in group, or compute it and cache it.
+    namespaces are the kinds of data the value is built from"""
+    cache_key = 'cache/%s/%s/%s' % (group, getVersions(namespaces), key)
+    value = memcache.get(cache_key)
+    if value is not None:
+        memcache.incr(_countKey(group, 'hits'), initial_value=0)
+        return value
+    memcache.incr(_countKey(group, 'misses'), initial_value=0)
+    value = compute()
+    memcache.set(cache_key, value, time=time)
+    return value
+
+def getHitRates(groups):
+    "returns a list of (group, hits, misses) for display"
+    keys = []
+    for group in groups:
+        keys.append(_countKey(group, 'hits'))
+        keys.append(_countKey(group, 'misses'))
+    counts = memcache.get_multi(keys)
+    rates = []
+    for group in groups:
+        rates.append((group, counts.get(_countKey(group, 'hits'), 0), counts.get(_countKey(group, 'misses'), 0)))
+    return rates
@@ -9,3 +9,31 @@ FETCHLIMIT = 1000
 
 # number of items to be displayed on pages that page items
 PAGINGLIMIT = 10
+
+# the number of flickr api calls that can be in flight at once
+FETCHCONCURRENCY = 10
+
+# uncomment to send flickr api calls to a local stand in rather than flickr
+# FLICKRAPIURL = "http://localhost:8090/services/rest/"
+
+# the hourly call quota for your flickr api key
+FLICKRQUOTA = 3600
+
+# failed flickr calls are retried this many times, waiting FETCHBACKOFF seconds
+# before the first retry and twice as long before each one after
+FETCHRETRIES = 2
+FETCHBACKOFF = 0.5
+
+# after this many failed flickr calls in a row, stop calling flickr for
+# BREAKERCOOLDOWN seconds
+BREAKERTHRESHOLD = 20
+BREAKERCOOLDOWN = 300
+
+# where photos, activities, contributors and votes are kept, "datastore" or
+# "sqlite". sqlite is for running and profiling the app off appengine
+STORAGEBACKEND = "datastore"
+SQLITEPATH = "flickr-voter.sqlite"
+
+# the address digests of new activity are mailed from, it must be an admin of
+# the app. digests aren't sent unless this is set
+# DIGESTSENDER = "you@example.com"
@@ -0,0 +1,187 @@
+"""sharded vote tallies.
+
+a vote is added to one randomly chosen shard of its counter inside a
+transaction, so votes on the same contributor don't all contend on one entity
+and none are lost. reading a tally sums that counter's shards with one batched
+get, and the total is cached in memcache until the next vote, or for at most
+CACHESECONDS. a read racing a vote can cache the total from before it, so the
+expiry bounds how long that stale total is served.
+
+each counter also has a base shard, which holds the tally that was stored on
+the voted entity before its votes were sharded.
+"""
+import random
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+# how many recent batch tokens a shard remembers, so a retried batch isn't counted twice
+TOKENHISTORY = 50
+
+# the longest a summed total is served from memcache
+CACHESECONDS = 60
+
+class VoteCounterShard(db.Model):
+    "one shard of a vote tally, keyed by the counter name and shard number"
+    counter = db.StringProperty(required=True)
+    vote_sum = db.IntegerProperty(default=0)
+    vote_count = db.IntegerProperty(default=0)
+    applied_tokens = db.StringListProperty()
+    # set on the base shard by the first vote, see claimFirstVote
+    first_voted = db.BooleanProperty(default=False)
+
+def _shardKeyNames(name, num_shards):
+    return ['%s/base' % name] + ['%s/%d' % (name, i) for i in range(num_shards)]
+
+def _cacheKey(name):
+    return 'votetotals/' + name
+
+def seed(name, vote_count, vote_sum):
+    "start a counter off from an existing tally, this only has an effect the first time"
+    VoteCounterShard.get_or_insert('%s/base' % name, counter=name, vote_count=vote_count, vote_sum=vote_sum)
+    memcache.delete(_cacheKey(name))
+
+def claimFirstVote(name, num_shards):
+    """whether a vote is the first on its counter. it is decided in a
+    transaction on the base shard, so of two first votes racing, or of two
+    batches whose deltas haven't been applied yet, only one is first. the
+    other shards are checked first for counters that were voted on before the
+    base shard was marked, but a vote racing one of those can still be taken
+    as the first, once"""
+    key_name = '%s/base' % name
+    for shard in VoteCounterShard.get_by_key_name(_shardKeyNames(name, num_shards)[1:]):
+        if shard and shard.vote_count:
+            return False
+    def txn():
+        base = VoteCounterShard.get_by_key_name(key_name)
+        if base is None:
+            base = VoteCounterShard(key_name=key_name, counter=name)
+        elif base.first_voted or base.vote_count:
+            return False
+        base.first_voted = True
+        base.put()
+        return True
+    return db.run_in_transaction(txn)
+
+def increment(name, value, num_shards, count=1, token=None):
+    """add count votes totalling value to a random shard of the counter. if a
+    token is given the shard is picked from it, and an increment with a token
+    the shard has already seen is ignored, so retrying it is safe"""
+    if token is None:
+        index = random.randint(0, num_shards - 1)
+    else:
+        index = (zlib.crc32(token) & 0xffffffff) % num_shards
+    key_name = '%s/%d' % (name, index)
+    def txn():
+        shard = VoteCounterShard.get_by_key_name(key_name)
+        if shard is None:
+            shard = VoteCounterShard(key_name=key_name, counter=name)
+        if token is not None:
+            if token in shard.applied_tokens:
+                return
+            shard.applied_tokens = (shard.applied_tokens + [token])[-TOKENHISTORY:]
+        shard.vote_sum = shard.vote_sum + value
+        shard.vote_count = shard.vote_count + count
+        shard.put()
+    db.run_in_transaction(txn)
+    memcache.delete(_cacheKey(name))
+
+def getTotalsMulti(names, num_shards):
+    "returns a dict of counter name -> (vote_count, vote_sum)"
+    names = list(set(names))
+    totals = {}
+    cached = memcache.get_multi([_cacheKey(name) for name in names])
+    missing = []
+    for name in names:
+        if _cacheKey(name) in cached:
+            totals[name] = cached[_cacheKey(name)]
+        else:
+            missing.append(name)
+    if missing:
+        key_names = []
+        for name in missing:
+            key_names.extend(_shardKeyNames(name, num_shards))
+        shards = VoteCounterShard.get_by_key_name(key_names)
+        fresh = dict((name, (0, 0)) for name in missing)
+        for shard in shards:
+            if shard:
+                vote_count, vote_sum = fresh[shard.counter]
+                fresh[shard.counter] = (vote_count + shard.vote_count, vote_sum + shard.vote_sum)
+        memcache.set_multi(dict((_cacheKey(name), total) for name, total in fresh.items()), time=CACHESECONDS)
+        totals.update(fresh)
+    return totals
+
+def getTotals(name, num_shards):
+    "returns (vote_count, vote_sum) for one counter"
+    return getTotalsMulti([name], num_shards)[name]
+
+# aggregate counts of things in the datastore, such as the number of
+# activities or photos. these are sharded in the same way as the vote tallies,
+# and corrected from time to time by counting the real entities.
+
+STATSHARDS = 10
+
+class StatCounterShard(db.Model):
+    "one shard of an aggregate count, keyed by the stat name and shard number"
+    stat = db.StringProperty(required=True)
+    value = db.IntegerProperty(default=0)
+
+def _statKeyNames(name):
+    return ['%s/base' % name] + ['%s/%d' % (name, i) for i in range(STATSHARDS)]
+
+def _statCacheKey(name):
+    return 'stat/' + name
+
+def incrementStat(name, delta):
+    "add delta to a random shard of the stat"
+    if not delta:
+        return
+    key_name = '%s/%d' % (name, random.randint(0, STATSHARDS - 1))
+    def txn():
+        shard = StatCounterShard.get_by_key_name(key_name)
+        if shard is None:
+            shard = StatCounterShard(key_name=key_name, stat=name)
+        shard.value = shard.value + delta
+        shard.put()
+    db.run_in_transaction(txn)
+    memcache.delete(_statCacheKey(name))
+
+def incrementStats(deltas):
+    "takes a dict of stat name -> delta"
+    for name, delta in deltas.items():
+        incrementStat(name, delta)
+
+def getStats(names):
+    "returns a dict of stat name -> value"
+    names = list(set(names))
+    cached = memcache.get_multi([_statCacheKey(name) for name in names])
+    stats = {}
+    missing = []
+    for name in names:
+        if _statCacheKey(name) in cached:
+            stats[name] = cached[_statCacheKey(name)]
+        else:
+            missing.append(name)
+    if missing:
+        key_names = []
+        for name in missing:
+            key_names.extend(_statKeyNames(name))
+        fresh = dict((name, 0) for name in missing)
+        for shard in StatCounterShard.get_by_key_name(key_names):
+            if shard:
+                fresh[shard.stat] = fresh[shard.stat] + shard.value
+        memcache.set_multi(dict((_statCacheKey(name), value) for name, value in fresh.items()), time=CACHESECONDS)
+        stats.update(fresh)
+    return stats
+
+def getStat(name):
+    return getStats([name])[name]
+
+def setStat(name, value):
+    "correct a stat to value, by adjusting its base shard to make the shards add up"
+    shards = StatCounterShard.get_by_key_name(_statKeyNames(name)[1:])
+    counted = sum([shard.value for shard in shards if shard])
+    base = StatCounterShard(key_name='%s/base' % name, stat=name, value=value - counted)
+    base.put()
+    memcache.delete(_statCacheKey(name))
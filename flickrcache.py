@@ -0,0 +1,119 @@
+"""a record of the last response to each flickr url.
+
+for every url we keep the hash of the last body flickr sent, any validators it
+sent (etag and last-modified) so the next request can be conditional, and the
+body itself so a 304 can still be answered. records live in memcache. only
+the ones with validators are backed by the datastore so they survive
+eviction, the rest are just a hash and aren't worth a write. urls are
+normalised first, so the same call made with its parameters in a different
+order shares a record.
+"""
+import hashlib
+import time
+
+try:
+    from urlparse import urlsplit, urlunsplit, parse_qsl
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+try:
+    from google.appengine.api import memcache
+    from google.appengine.ext import db
+except ImportError:
+    memcache = None
+    db = None
+
+# bodies bigger than this aren't stored, so their next request can't be conditional
+MAXBODYBYTES = 900 * 1024
+
+class Entry(object):
+    "what we know about the last response to a url"
+    def __init__(self, url, body_hash, etag=None, last_modified=None, body=None, fetched=None):
+        self.url = url
+        self.body_hash = body_hash
+        self.etag = etag
+        self.last_modified = last_modified
+        self.body = body
+        self.fetched = fetched or time.time()
+
+    def conditionalHeaders(self):
+        "headers that make a request conditional on the response having changed"
+        headers = {}
+        if self.body is None:
+            return headers
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+if db is not None:
+    class CachedFlickrResponse(db.Model):
+        "the datastore copy of an Entry, keyed by the hash of the normalised url"
+        url = db.TextProperty()
+        body_hash = db.StringProperty()
+        etag = db.StringProperty()
+        last_modified = db.StringProperty()
+        body = db.BlobProperty()
+        fetched = db.FloatProperty()
+
+# used off appengine
+_local_entries = {}
+
+def normaliseUrl(url):
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    params = sorted(parse_qsl(query))
+    return urlunsplit((scheme.lower(), netloc.lower(), path, urlencode(params), ''))
+
+def _key(url):
+    return 'r' + hashlib.sha1(normaliseUrl(url).encode('utf-8')).hexdigest()
+
+def hashBody(body):
+    return hashlib.sha1(body).hexdigest()
+
+def lookup(urls):
+    "returns a dict of url -> Entry for the urls we have a record of"
+    keys = dict((url, _key(url)) for url in urls)
+    if db is None:
+        return dict((url, _local_entries[key]) for url, key in keys.items() if key in _local_entries)
+    found = memcache.get_multi(list(keys.values()), key_prefix='flickrresponse/')
+    entries = {}
+    missing = []
+    for url, key in keys.items():
+        if key in found:
+            entries[url] = found[key]
+        else:
+            missing.append(url)
+    if missing:
+        stored = CachedFlickrResponse.get_by_key_name([keys[url] for url in missing])
+        refill = {}
+        for url, record in zip(missing, stored):
+            if record:
+                entry = Entry(url, record.body_hash, record.etag, record.last_modified, record.body, record.fetched)
+                entries[url] = entry
+                refill[keys[url]] = entry
+        if refill:
+            memcache.set_multi(refill, key_prefix='flickrresponse/')
+    return entries
+
+def store(entries):
+    """save a list of Entry in memcache, and the ones flickr sent validators
+    for in the datastore too. without validators the body can't be used, so
+    only the hash is kept"""
+    if not entries:
+        return
+    for entry in entries:
+        if entry.body is not None and len(entry.body) > MAXBODYBYTES:
+            entry.body = None
+        if not (entry.etag or entry.last_modified):
+            entry.body = None
+    if db is None:
+        for entry in entries:
+            _local_entries[_key(entry.url)] = entry
+        return
+    memcache.set_multi(dict((_key(entry.url), entry) for entry in entries), key_prefix='flickrresponse/')
+    db.put([CachedFlickrResponse(key_name=_key(entry.url), url=entry.url, body_hash=entry.body_hash,
+                                 etag=entry.etag, last_modified=entry.last_modified,
+                                 body=entry.body and db.Blob(entry.body), fetched=entry.fetched)
+            for entry in entries if entry.etag or entry.last_modified])
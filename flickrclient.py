@@ -0,0 +1,288 @@
+"""every call to the flickr api goes through here, so that all of the app's
+tasks share one budget for the api key's hourly quota.
+
+the budget is a token bucket that holds BURST calls at the start of each hour
+and refills at FLICKRQUOTA calls an hour, up to FLICKRQUOTA. the number of
+calls spent in the current hour is a memcache counter, so it is shared by every
+instance. each call has a priority, and lower priority calls may only spend
+part of the bucket, so when the budget runs low the pool scan still gets
+through while polling of cold photos is deferred.
+
+responses are remembered in flickrcache, so repeat calls are made conditional
+and a body flickr has sent before can be recognised without parsing it. a
+caller that skips unchanged bodies records the new ones itself, once it has
+finished with them, so a task that dies part way doesn't skip them when it is
+retried. error responses are never remembered.
+
+failed calls are retried with a growing delay, and if flickr keeps failing a
+circuit breaker stops all calls for a while, rather than letting every queued
+task spend its retries against an outage.
+"""
+import logging
+import threading
+import time
+
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    memcache = None
+
+import flickrcache
+import flickrfetch
+import flickrxml
+
+try:
+    from config import FLICKRQUOTA
+except ImportError:
+    FLICKRQUOTA = 3600 # flickr allows 3600 calls an hour per key
+
+try:
+    from config import FETCHRETRIES, FETCHBACKOFF
+except ImportError:
+    FETCHRETRIES = 2 # extra attempts at a call that failed
+    FETCHBACKOFF = 0.5 # seconds before the first retry, doubled for each one after
+
+try:
+    from config import BREAKERTHRESHOLD, BREAKERCOOLDOWN
+except ImportError:
+    BREAKERTHRESHOLD = 20 # failed calls in a row before we stop calling flickr
+    BREAKERCOOLDOWN = 300 # seconds to stop for
+
+# flickr error codes that mean flickr itself is failing, sent with a 200
+RETRYABLEERRORS = set(["105"]) # service currently unavailable
+
+# calls available at the start of every hour
+BURST = FLICKRQUOTA // 4
+
+# priorities, most important first
+PRIORITY_POOL = 0 # looking for new photos in the pool
+PRIORITY_ACTIVE = 1 # photos that have had recent activity
+PRIORITY_COLD = 2 # photos that have been quiet for a while
+
+# the share of the bucket each priority is allowed to spend
+PRIORITYSHARE = {PRIORITY_POOL: 1.0,
+                 PRIORITY_ACTIVE: 0.9,
+                 PRIORITY_COLD: 0.6}
+
+class FlickrDeferred(Exception):
+    "flickr can't be called right now, try again in retry_after seconds"
+    def __init__(self, message, retry_after):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+class QuotaExceeded(FlickrDeferred):
+    "there isn't enough budget left for a call at this priority"
+    def __init__(self, priority, retry_after):
+        FlickrDeferred.__init__(self, 'flickr quota too low for priority %d, retry in %ds' % (priority, retry_after), retry_after)
+        self.priority = priority
+
+class CircuitOpen(FlickrDeferred):
+    "flickr has been failing, so calls are stopped until the breaker closes"
+    def __init__(self, retry_after):
+        FlickrDeferred.__init__(self, 'flickr is failing, calls are stopped for %ds' % retry_after, retry_after)
+
+# used off appengine, where there is no memcache to share the counter through
+_local_counts = {}
+_local_lock = threading.Lock()
+
+def _window(now):
+    return int(now // 3600)
+
+def _counterKey(window):
+    return 'flickrquota-%d' % window
+
+def _spend(key, n):
+    "add n to the calls spent in this window, returns the new total"
+    if memcache is not None:
+        spent = memcache.incr(key, n, initial_value=0)
+        if spent is not None:
+            return spent
+        logging.warning('memcache incr of %s failed, quota is not being counted' % key)
+        return n
+    _local_lock.acquire()
+    try:
+        _local_counts[key] = _local_counts.get(key, 0) + n
+        return _local_counts[key]
+    finally:
+        _local_lock.release()
+
+def _refund(key, n):
+    if memcache is not None:
+        memcache.decr(key, n)
+        return
+    _local_lock.acquire()
+    try:
+        _local_counts[key] = max(0, _local_counts.get(key, 0) - n)
+    finally:
+        _local_lock.release()
+
+def allowance(elapsed):
+    "calls the bucket has made available this far into the hour"
+    return min(FLICKRQUOTA, BURST + FLICKRQUOTA * elapsed / 3600.0)
+
+def acquire(n, priority):
+    "take n calls from the bucket, or raise QuotaExceeded"
+    now = time.time()
+    window = _window(now)
+    elapsed = now - window * 3600
+    key = _counterKey(window)
+    spent = _spend(key, n)
+    share = PRIORITYSHARE[priority]
+    if spent <= allowance(elapsed) * share:
+        return
+    _refund(key, n)
+    # work out when the bucket will have refilled far enough for this call
+    needed = spent / share
+    if needed > FLICKRQUOTA:
+        retry_after = 3600 - elapsed
+    else:
+        retry_after = (needed - BURST) * 3600.0 / FLICKRQUOTA - elapsed
+    raise QuotaExceeded(priority, int(max(1, retry_after)))
+
+def remaining():
+    "calls left in the bucket right now, for display"
+    now = time.time()
+    window = _window(now)
+    key = _counterKey(window)
+    if memcache is not None:
+        spent = memcache.get(key) or 0
+    else:
+        spent = _local_counts.get(key, 0)
+    return int(allowance(now - window * 3600) - spent)
+
+# circuit breaker
+
+BREAKERFAILURES = 'flickrbreaker/failures'
+BREAKEROPENUNTIL = 'flickrbreaker/open_until'
+
+_local_breaker = {}
+
+def _breakerGet(key):
+    if memcache is not None:
+        return memcache.get(key)
+    return _local_breaker.get(key)
+
+def _breakerSet(key, value):
+    if memcache is not None:
+        memcache.set(key, value)
+    else:
+        _local_breaker[key] = value
+
+def checkBreaker():
+    "raise CircuitOpen if calls to flickr are stopped"
+    open_until = _breakerGet(BREAKEROPENUNTIL)
+    if open_until and open_until > time.time():
+        raise CircuitOpen(int(max(1, open_until - time.time())))
+
+def _recordOutcome(failures, successes):
+    """a batch without failures closes the breaker, failures open it once
+    BREAKERTHRESHOLD have been counted with no clean batch in between, however
+    many calls succeeded alongside them. after the cooldown one failure opens
+    it again"""
+    if not failures:
+        if successes and _breakerGet(BREAKERFAILURES):
+            _breakerSet(BREAKERFAILURES, 0)
+        return
+    if memcache is not None:
+        count = memcache.incr(BREAKERFAILURES, failures, initial_value=0) or failures
+    else:
+        count = (_local_breaker.get(BREAKERFAILURES) or 0) + failures
+        _local_breaker[BREAKERFAILURES] = count
+    if count >= BREAKERTHRESHOLD:
+        logging.error('%d flickr calls in a row have failed, stopping calls for %ds' % (count, BREAKERCOOLDOWN))
+        _breakerSet(BREAKEROPENUNTIL, time.time() + BREAKERCOOLDOWN)
+
+def _failed(result):
+    "whether a call is worth retrying"
+    if result is None or result.status_code >= 500:
+        return True
+    return result.status_code == 200 and flickrxml.errorCode(result.content) in RETRYABLEERRORS
+
+def _fetchWithRetries(urls, cached, priority):
+    "fetch urls, conditionally where we can, retrying failures. returns url -> FetchResult or None"
+    results = {}
+    pending = urls
+    for attempt in range(FETCHRETRIES + 1):
+        if attempt:
+            time.sleep(FETCHBACKOFF * 2 ** (attempt - 1))
+            # retries are calls too
+            acquire(len(pending), priority)
+        requests = []
+        for url in pending:
+            entry = cached.get(url)
+            requests.append((url, entry and entry.conditionalHeaders() or {}))
+        results.update(flickrfetch.fetchRaw(requests))
+        pending = [url for url in pending if _failed(results[url])]
+        if not pending:
+            break
+        logging.warning('%d flickr calls failed on attempt %d' % (len(pending), attempt + 1))
+    return results
+
+def _fetch(urls, priority, skip_unchanged):
+    """fetch urls, returns a dict of url -> response body, and a dict of url ->
+    flickrcache.Entry for the responses that are new"""
+    urls = list(urls)
+    if not urls:
+        return {}, {}
+    checkBreaker()
+    acquire(len(urls), priority)
+    cached = flickrcache.lookup(urls)
+    results = _fetchWithRetries(urls, cached, priority)
+    bodies = {}
+    fresh = {}
+    failures = 0
+    for url in urls:
+        result = results[url]
+        entry = cached.get(url)
+        if result is not None and result.status_code == 304 and entry:
+            if skip_unchanged:
+                bodies[url] = None
+            else:
+                bodies[url] = entry.body
+            continue
+        if _failed(result) or result.status_code != 200:
+            if _failed(result):
+                failures = failures + 1
+            bodies[url] = False
+            continue
+        if flickrxml.errorCode(result.content) is not None:
+            # flickr answered, but with an error, which isn't worth remembering
+            bodies[url] = result.content
+            continue
+        body_hash = flickrcache.hashBody(result.content)
+        etag = result.headers.get('etag')
+        last_modified = result.headers.get('last-modified')
+        if entry and entry.body_hash == body_hash:
+            if skip_unchanged:
+                bodies[url] = None
+            else:
+                bodies[url] = result.content
+            if entry.etag == etag and entry.last_modified == last_modified:
+                continue
+        else:
+            bodies[url] = result.content
+        fresh[url] = flickrcache.Entry(url, body_hash, etag, last_modified, result.content)
+    _recordOutcome(failures, len(urls) - failures)
+    return bodies, fresh
+
+def fetchUrls(urls, priority):
+    """fetch a batch of flickr urls concurrently, charging them all to the
+    bucket up front. returns a dict of url -> response body, or False where
+    the call failed. raises FlickrDeferred if the calls can't be made right now"""
+    bodies, fresh = _fetch(urls, priority, False)
+    flickrcache.store(list(fresh.values()))
+    return bodies
+
+def fetchChangedUrls(urls, priority):
+    """like fetchUrls, but a body that is the same as the last one flickr sent
+    for that url is given as None, so it needn't be parsed again. the new
+    bodies aren't remembered until they are passed to recordResponses, returns
+    the bodies and a dict of url -> flickrcache.Entry to pass it"""
+    return _fetch(urls, priority, True)
+
+def recordResponses(entries):
+    "remember responses from fetchChangedUrls once they have been dealt with"
+    flickrcache.store(entries)
+
+def fetchUrl(url, priority):
+    return fetchUrls([url], priority)[url]
@@ -0,0 +1,121 @@
+"""fetch lots of flickr api urls at once.
+
+on appengine this issues asynchronous urlfetch rpcs, keeping at most
+max_concurrent of them in flight. off appengine (for example when running
+against a local fake flickr server) it uses a bounded pool of worker threads
+instead.
+"""
+import logging
+import threading
+
+try:
+    from google.appengine.api import urlfetch
+except ImportError:
+    urlfetch = None
+
+try:
+    import Queue as queue
+    import urllib2 as urlrequest
+    import urllib2 as urlerror
+except ImportError:
+    import queue
+    import urllib.request as urlrequest
+    import urllib.error as urlerror
+
+try:
+    from config import FETCHCONCURRENCY
+except ImportError:
+    FETCHCONCURRENCY = 10
+
+# seconds to wait on any one flickr call
+FETCHDEADLINE = 10
+
+HEADERS = {'Cache-Control' : 'max-age=300'}
+
+class FetchResult(object):
+    "the status, body and headers of one response"
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        # header names are kept lower case, so they can be looked up either way
+        self.headers = dict((name.lower(), value) for name, value in headers.items())
+
+def fetchRaw(requests, max_concurrent=FETCHCONCURRENCY):
+    """fetch a list of (url, extra headers) at most max_concurrent at a time.
+    returns a dict of url -> FetchResult, or None where the fetch itself failed"""
+    requests = list(requests)
+    if not requests:
+        return {}
+    if urlfetch is not None:
+        return _fetchWithRpcs(requests, max_concurrent)
+    return _fetchWithThreads(requests, max_concurrent)
+
+def fetchUrls(urls, max_concurrent=FETCHCONCURRENCY):
+    """fetch all of urls, at most max_concurrent at a time. returns a dict of
+    url -> response body, with False for any url that did not return a 200"""
+    results = fetchRaw([(url, {}) for url in urls], max_concurrent)
+    bodies = {}
+    for url, result in results.items():
+        if result is not None and result.status_code == 200:
+            bodies[url] = result.content
+        else:
+            bodies[url] = False
+    return bodies
+
+def fetchUrl(url):
+    return fetchUrls([url], 1)[url]
+
+def _headers(extra):
+    headers = dict(HEADERS)
+    headers.update(extra)
+    return headers
+
+def _fetchWithRpcs(requests, max_concurrent):
+    results = {}
+    in_flight = []
+    pending = list(requests)
+    pending.reverse()
+    while pending or in_flight:
+        # top the window up, then wait on the oldest rpc
+        while pending and len(in_flight) < max_concurrent:
+            url, extra = pending.pop()
+            rpc = urlfetch.create_rpc(deadline=FETCHDEADLINE)
+            urlfetch.make_fetch_call(rpc, url, headers=_headers(extra))
+            in_flight.append((url, rpc))
+        url, rpc = in_flight.pop(0)
+        try:
+            result = rpc.get_result()
+            results[url] = FetchResult(result.status_code, result.content, result.headers)
+        except urlfetch.Error:
+            logging.warning('fetch of %s failed' % url)
+            results[url] = None
+    return results
+
+def _fetchOne(url, extra):
+    try:
+        response = urlrequest.urlopen(urlrequest.Request(url, headers=_headers(extra)), timeout=FETCHDEADLINE)
+        return FetchResult(response.getcode(), response.read(), dict(response.info().items()))
+    except urlerror.HTTPError as e:
+        return FetchResult(e.code, e.read(), dict(e.info().items()))
+    except Exception:
+        logging.warning('fetch of %s failed' % url)
+    return None
+
+def _fetchWithThreads(requests, max_concurrent):
+    results = {}
+    work = queue.Queue()
+    for request in requests:
+        work.put(request)
+    def worker():
+        while True:
+            try:
+                url, extra = work.get_nowait()
+            except queue.Empty:
+                return
+            results[url] = _fetchOne(url, extra)
+    workers = [threading.Thread(target=worker) for i in range(min(max_concurrent, len(requests)))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return results
@@ -0,0 +1,71 @@
+"""single pass parsing of flickr rest responses.
+
+rather than building a whole dom for a response, records() reads it as a
+stream of parse events and yields a FlickrRecord for each element we are
+interested in, dropping each element as soon as it has been yielded. so a 500
+photo pool page, or a photo with thousands of comments, is read once and
+never held in memory all at once.
+"""
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+from io import BytesIO
+
+# the elements a record is made for
+POOL = "photos" # a page of the group pool, has the number of pages
+POOLPHOTO = "photo" # a photo on a pool page
+DATES = "dates" # the dates of a photo, has lastupdate
+TAG = "tag"
+NOTE = "note"
+COMMENT = "comment"
+ERROR = "err"
+
+RECORDKINDS = set([POOL, POOLPHOTO, DATES, TAG, NOTE, COMMENT, ERROR])
+
+# the kinds that are activity on a photo
+ACTIVITYKINDS = set([TAG, NOTE, COMMENT])
+
+class FlickrRecord(object):
+    """one element of a response. getAttribute behaves like the minidom method
+    of the same name, so records can be used where pool photo elements were"""
+    def __init__(self, kind, attrs, text):
+        self.kind = kind
+        self.attrs = attrs
+        self.text = text
+
+    def getAttribute(self, name):
+        return self.attrs.get(name, "")
+
+def records(response, kinds=RECORDKINDS):
+    "yield a FlickrRecord for each element of response whose name is in kinds"
+    if not isinstance(response, bytes):
+        response = response.encode("utf-8")
+    parents = []
+    for event, elem in ElementTree.iterparse(BytesIO(response), events=("start", "end")):
+        if event == "start":
+            if elem.tag in kinds and elem.tag == POOL:
+                # the pool's page count is wanted before its photos
+                yield FlickrRecord(elem.tag, dict(elem.attrib), None)
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag in kinds and elem.tag != POOL:
+            yield FlickrRecord(elem.tag, dict(elem.attrib), elem.text or "")
+        # done with this element, let it go
+        if parents:
+            parents[-1].remove(elem)
+
+def recordsOfKind(response, kind):
+    return records(response, set([kind]))
+
+def errorCode(response):
+    "the code of the error in a stat=\"fail\" response, or None if it isn't one"
+    if not isinstance(response, bytes):
+        response = response.encode("utf-8")
+    if b'stat="fail"' not in response[:200]:
+        return None
+    for error in recordsOfKind(response, ERROR):
+        return error.getAttribute("code")
+    return ""
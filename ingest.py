@@ -0,0 +1,818 @@
+#!/usr/bin/env python
+"""the ingestion workers: the cron tick, walking the group pool, finding
+changed photos and checking them for new activity, indexing activity for
+search and mailing digests of it. only cron and the task queues come here, so
+the flickr client, its xml parsing and mail are never loaded by an instance
+serving pages or votes.
+"""
+import hashlib
+import logging
+import os
+import time as clock
+from datetime import datetime, timedelta
+from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.api.labs import taskqueue
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp import util
+
+from config import apikey
+from config import GROUPID
+from config import FETCHLIMIT
+try:
+    # point this at a local stand in for flickr when testing
+    from config import FLICKRAPIURL
+except ImportError:
+    FLICKRAPIURL = "http://api.flickr.com/services/rest/"
+try:
+    # digests of new activity are only mailed out if there is a sender
+    from config import DIGESTSENDER
+except ImportError:
+    DIGESTSENDER = None
+
+import cache
+import counters
+import flickrclient
+import flickrxml
+import instrument
+import searchindex
+from main import Photo, PhotoActivity, PoolSyncState, MailRecipients
+from main import store, addTasks
+from main import newPhoto, getPhoto, getPhotos, getActivities, createActivities
+from main import joinActivityPhotoLinks, genSearchDocument, SEARCHINDEXBATCH
+from main import CACHE_PHOTOS, STAT_PHOTOS, SUMMARYDATEFORMAT
+from main import MINPOLLMINUTES, MAXPOLLMINUTES
+
+FLICKRKEY = apikey
+
+# the pool is walked newest first, POOLPERPAGE photos at a time (flickr allows
+# up to 500), and each photosq task fetches at most POOLPAGESPERTASK pages
+# before handing the rest of the walk on to a new task
+POOLPERPAGE = 500
+POOLPAGESPERTASK = 5
+
+# new activities are looked up and stored this many at a time, so a photo
+# with thousands of comments never has them all in memory
+ACTIVITYBATCH = 200
+
+# photos with activity in the last ACTIVEDAYS days are polled at a higher
+# priority than the rest when the flickr quota runs low
+ACTIVEDAYS = 7
+
+# photos whose getInfo and comments calls are fetched together in one
+# concurrent batch when sweeping the whole group
+PHOTOBATCH = 50
+
+# activity checks are queued PHOTOSPERTASK photos to a task
+PHOTOSPERTASK = 10
+
+# a photo is claimed by its queued check for at most CHECKCLAIMSECONDS
+CHECKCLAIMSECONDS = 60 * 60
+
+# a photo's polling interval is worked out from the creation times of its
+# RECENTACTIVITY most recent activities
+RECENTACTIVITY = 10
+
+# the pool listing is walked for changed photos at most once every
+# DETECTMINUTES. busy photos are already polled on their own schedule, this
+# catches quiet ones that have woken up
+DETECTMINUTES = 60
+
+# flickr api calls
+
+def genPhotoCommentUrl(PhotoId, min_comment_date=None):
+    url = FLICKRAPIURL+"?method=flickr.photos.comments.getList&photo_id="+PhotoId+"&api_key="+FLICKRKEY
+    if min_comment_date:
+        url = url + "&min_comment_date=" + str(min_comment_date)
+    return url
+
+def genPhotoCommentUrlForPhoto(photo):
+    "only ask for the comments made since the newest one we have"
+    return genPhotoCommentUrl(photo.uid, photo.comment_watermark_date)
+
+def genPhotoInfoUrl(PhotoId):
+    url = FLICKRAPIURL+"?method=flickr.photos.getInfo&photo_id="+PhotoId+"&api_key="+FLICKRKEY
+    return url
+
+def genPhotoSizeQueryUrl(PhotoId):
+    url = FLICKRAPIURL+"?method=flickr.photos.getSizes&photo_id="+PhotoId+"&api_key="+FLICKRKEY
+    return url
+
+def genGroupPhotoQueryUrl(page=1, per_page=POOLPERPAGE, extras=None):
+    url = FLICKRAPIURL+'?method=flickr.groups.pools.getPhotos&group_id='+GROUPID+'&api_key='+FLICKRKEY
+    url = url + '&page=' + str(page) + '&per_page=' + str(per_page)
+    if extras:
+        url = url + '&extras=' + extras
+    return url
+
+# xml response
+
+def getResponseFromUrl(url, priority=flickrclient.PRIORITY_ACTIVE):
+    "raises flickrclient.FlickrDeferred if flickr can't be called at this priority right now"
+    return flickrclient.fetchUrl(url, priority)
+
+def getPoolResponseFromUrl(url):
+    "pool calls have the top priority, if even they can't be afforded treat it like a failed call"
+    try:
+        return getResponseFromUrl(url, flickrclient.PRIORITY_POOL)
+    except flickrclient.FlickrDeferred as e:
+        logging.warning(str(e))
+        return False
+
+# model setters and getters
+
+def genPhotoImageLink(server, uid, secret):
+    photoimage_url = "http://farm5.static.flickr.com/"+server+"/"+uid+"_"+secret+"_m.jpg"
+    return photoimage_url
+
+def genPhotoThumbLink(server, uid, secret):
+    photothumb_url = "http://farm5.static.flickr.com/"+server+"/"+uid+"_"+secret+"_t.jpg"
+    return photothumb_url
+
+def genPhotoPageLink(owner, uid):
+    photopage_url = "http://www.flickr.com/photos/"+owner+"/"+uid
+    return photopage_url
+
+# get and set image data
+
+def buildPhotoFromXML(photo_xml):
+    "build, but don't store, a photo object from a pool photo element"
+    uid = photo_xml.getAttribute("id")
+    owner = photo_xml.getAttribute("owner")
+    server = photo_xml.getAttribute("server")
+    secret = photo_xml.getAttribute("secret")
+    title = photo_xml.getAttribute("title")
+    ownername = photo_xml.getAttribute("ownername")
+    photopage_url = genPhotoPageLink(owner, uid)
+    photoimage_url = genPhotoImageLink(server, uid, secret)
+    photothumb_url = genPhotoThumbLink(server, uid, secret)
+    #
+    photo = newPhoto(uid)
+    photo.owner_id = owner
+    photo.owner_name = ownername
+    photo.photopage_url = photopage_url
+    photo.photoimage_url = photoimage_url
+    photo.photothumb_url = photothumb_url
+    photo.title = title
+    photo.last_modified = '' # we don't really know, we will get activity later, but we need to zero this
+    photo.next_poll = datetime.now()
+    return photo
+
+def storeNewPoolPhotos(photos_xml):
+    "store the photos from a list of pool photo elements that we don't already have"
+    # check all of the photoids against the datastore in one go
+    stored = getPhotos([photo_xml.getAttribute("id") for photo_xml in photos_xml])
+    uids = []
+    new_photos = []
+    for photo_xml in photos_xml:
+        uid = photo_xml.getAttribute("id")
+        # if the picture is there, or we have already seen it in this response, then don't do anything
+        if stored.get(uid) or uid in uids:
+            continue
+        # otherwise create a picture object, they all get stored together below
+        new_photos.append(buildPhotoFromXML(photo_xml))
+        uids.append(uid)
+    store.put(new_photos)
+    if new_photos:
+        counters.incrementStat(STAT_PHOTOS, len(new_photos))
+        cache.bump(CACHE_PHOTOS)
+    return uids
+
+def parsePoolPage(response, high_water):
+    """store the new photos on one page of the pool. the pool is ordered by the
+    date photos were added, so once we see a photo at or below the high water
+    mark the rest of the pool is already known.
+    returns (new uids, newest dateadded on the page, reached known photos, number of pages)"""
+    pages = 0
+    photos_xml = []
+    newest = 0
+    reached_known = False
+    for photo_xml in flickrxml.records(response, set([flickrxml.POOL, flickrxml.POOLPHOTO])):
+        if photo_xml.kind == flickrxml.POOL:
+            pages = int(photo_xml.getAttribute("pages") or 0)
+            continue
+        dateadded = int(photo_xml.getAttribute("dateadded") or 0)
+        if high_water and dateadded <= high_water:
+            reached_known = True
+            break
+        newest = max(newest, dateadded)
+        photos_xml.append(photo_xml)
+    uids = storeNewPoolPhotos(photos_xml)
+    return uids, newest, reached_known, pages
+
+def getPoolSyncState():
+    return PoolSyncState.get_or_insert("g" + GROUPID)
+
+def syncPoolPages(state, max_pages):
+    """walk up to max_pages of the pool from the checkpoint in state, storing new
+    photos and their add activities. returns (new uids, finished)"""
+    if not state.in_progress:
+        state.in_progress = True
+        state.next_page = 1
+        state.run_high_water = state.high_water
+        state.run_started = datetime.now()
+    uids = []
+    finished = False
+    for i in range(max_pages):
+        response = getPoolResponseFromUrl(genGroupPhotoQueryUrl(state.next_page))
+        if not response:
+            # leave the checkpoint where it is, the next task picks up from here
+            break
+        page_uids, newest, reached_known, pages = parsePoolPage(response, state.high_water)
+        genPhotoAddActivitiesFromPhotoUIDs(page_uids)
+        uids.extend(page_uids)
+        state.run_high_water = max(state.run_high_water, newest)
+        if reached_known or state.next_page >= pages:
+            state.high_water = state.run_high_water
+            state.in_progress = False
+            finished = True
+            break
+        state.next_page = state.next_page + 1
+    state.put()
+    return uids, finished
+
+def genPhotoAddActivitiesFromPhotoUIDs(uids):
+    if uids is not None:
+        "if someone has added a picture to the group this should be recorded as an activity"
+        photos = getPhotos(uids)
+        records = []
+        for uid in uids:
+            photo = photos.get(uid)
+            if photo:
+                records.append((uid, uid, photo.owner_id, "added photo", "photo"))
+        createActivities(records, photos)
+    else:
+        return None
+
+class GetPhotos(webapp.RequestHandler):
+    "retreive a list of photos from a flickr group, and store new images"
+    def get(self):
+    
+        state = getPoolSyncState()
+        continuing = self.request.get("continue")
+        recent = state.updated and datetime.now() - state.updated < timedelta(minutes=10)
+        if state.in_progress and recent and not continuing:
+            # a chain of tasks is already walking the pool, leave it to it
+            uids = "a pool sync is already in progress"
+        else:
+            uids, finished = syncPoolPages(state, POOLPAGESPERTASK)
+            if not finished:
+                # carry on with the rest of the pool in a new task, the name stops
+                # a retried task from starting a second chain for the same page
+                name = "poolsync-%s-%d" % (state.run_started.strftime("%Y%m%d%H%M%S"), state.next_page)
+                try:
+                    taskqueue.Queue(name='photosq').add(taskqueue.Task(url='/getphotos/?continue=true', method='GET', name=name))
+                except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                    pass
+            # might not find any new images
+            if not uids:
+                uids = "no new photos were found"
+    
+        template_values = {'photoids': uids}
+        path = os.path.join(os.path.dirname(__file__), 'GetPhotos.html')
+        self.response.out.write(instrument.renderTemplate(path, template_values))
+        
+# photo parsing
+
+def parsePhotoInfo(response):
+    """read a getInfo response once, returns its lastupdate and a list of
+    records for the tags and notes on the photo"""
+    remote_last_modified = ''
+    activity_records = []
+    for record in flickrxml.records(response, set([flickrxml.DATES, flickrxml.TAG, flickrxml.NOTE])):
+        if record.kind == flickrxml.DATES:
+            remote_last_modified = record.getAttribute("lastupdate")
+        else:
+            activity_records.append(record)
+    return remote_last_modified, activity_records
+
+# get and set photo activity 
+
+
+def extractActivityBatch(PhotoId, tags, photo=None):
+    "store the activities in a list of tag, note or comment records that we don't already have"
+    # look up every activity in the batch in one batched get
+    stored = getActivities([tag.getAttribute("id") for tag in tags])
+    records = []
+    seen = set()
+    for tag in tags:
+        activity_id = tag.getAttribute("id")
+        if stored.get(activity_id) or activity_id in seen:
+            continue
+        seen.add(activity_id)
+        activity_author = tag.getAttribute("author")
+        records.append((activity_id, PhotoId, activity_author, tag.text, tag.kind))
+    photos = {}
+    if photo:
+        photos[PhotoId] = photo
+    return createActivities(records, photos)
+
+def extractActivity(PhotoId, activity_records, photo=None):
+    """store new activity from an iterable of flickrxml tag, note or comment
+    records, ACTIVITYBATCH at a time"""
+    new_activity_ids = []
+    batch = []
+    for record in activity_records:
+        batch.append(record)
+        if len(batch) == ACTIVITYBATCH:
+            new_activity_ids.extend(extractActivityBatch(PhotoId, batch, photo))
+            batch = []
+    if batch:
+        new_activity_ids.extend(extractActivityBatch(PhotoId, batch, photo))
+    return new_activity_ids
+
+def newCommentsSince(comment_records, photo):
+    """pass on only the comments made after the photo's comment watermark, and
+    move the watermark on to the newest comment seen once they have all been
+    passed on. the photo still needs storing"""
+    watermark_date = photo.comment_watermark_date or 0
+    watermark_id = photo.comment_watermark_id
+    newest_date, newest_id = watermark_date, watermark_id
+    for comment in comment_records:
+        try:
+            datecreate = int(comment.getAttribute("datecreate"))
+        except ValueError:
+            datecreate = 0
+        comment_id = comment.getAttribute("id")
+        if datecreate < watermark_date:
+            continue
+        if datecreate == watermark_date and comment_id == watermark_id:
+            continue
+        if datecreate >= newest_date:
+            newest_date, newest_id = datecreate, comment_id
+        yield comment
+    photo.comment_watermark_date = newest_date
+    photo.comment_watermark_id = newest_id
+
+def getPhotoCommentsXML(PhotoId, min_comment_date=None):
+    url = genPhotoCommentUrl(PhotoId, min_comment_date)
+    comments_xml = getResponseFromUrl(url)
+    return comments_xml
+    
+def CreatePhotoActivity(PhotoId, info_records, comment_xml=None, photo=None):
+    "info_records are the tag and note records from parsePhotoInfo"
+    new_activity_ids = []
+    # tag and notes activity
+    new_activity_ids.extend(extractActivity(PhotoId, info_records, photo))
+    # comment activity, the comments may already have been fetched alongside the photo info
+    if comment_xml is None:
+        comment_xml = getPhotoCommentsXML(PhotoId, photo and photo.comment_watermark_date)
+    if comment_xml:
+        comments = flickrxml.recordsOfKind(comment_xml, flickrxml.COMMENT)
+        if photo:
+            comments = newCommentsSince(comments, photo)
+        new_activity_ids.extend(extractActivity(PhotoId, comments, photo))
+    return new_activity_ids     
+
+def photoPriority(photo):
+    "photos that have changed recently are more likely to change again"
+    try:
+        last_modified = datetime.fromtimestamp(int(photo.last_modified))
+    except (TypeError, ValueError):
+        return flickrclient.PRIORITY_ACTIVE # never checked
+    if datetime.now() - last_modified < timedelta(days=ACTIVEDAYS):
+        return flickrclient.PRIORITY_ACTIVE
+    return flickrclient.PRIORITY_COLD
+
+def fetchPhotoInfoAndComments(photos, deferred=None):
+    """fetch the getInfo and comments calls for every photo concurrently, most
+    important photos first. photos that the quota can't cover are added to
+    deferred, or if deferred is None flickrclient.FlickrDeferred is raised.
+    responses that are the same as the last ones flickr sent are given as None.
+    returns the responses, and the new ones to pass to flickrclient.recordResponses
+    once their activities are stored"""
+    responses = {}
+    fresh = {}
+    by_priority = {}
+    for photo in photos:
+        by_priority.setdefault(photoPriority(photo), []).append(photo)
+    for priority in sorted(by_priority.keys()):
+        urls = []
+        for photo in by_priority[priority]:
+            urls.append(genPhotoInfoUrl(photo.uid))
+            urls.append(genPhotoCommentUrlForPhoto(photo))
+        try:
+            bodies, entries = flickrclient.fetchChangedUrls(urls, priority)
+        except flickrclient.FlickrDeferred as e:
+            if deferred is None:
+                raise
+            logging.info(str(e))
+            deferred.extend(by_priority[priority])
+            continue
+        responses.update(bodies)
+        fresh.update(entries)
+    return responses, fresh
+
+def getRecentActivityTimes(PhotoId, new_activity_ids):
+    """the creation times of a photo's RECENTACTIVITY most recent activities,
+    newest first. the ones just stored may not show up in the query yet, so
+    new_activity_ids are counted as made now"""
+    now = datetime.now()
+    query = store.query(PhotoActivity).filter("photo_id =", PhotoId).order("-created")
+    times = dict((activity.activity_id, activity.created) for activity in query.fetch(RECENTACTIVITY))
+    for activity_id in new_activity_ids:
+        times[activity_id] = now
+    return sorted(times.values(), reverse=True)[:RECENTACTIVITY]
+
+def schedulePhotoPoll(photo, activity_times=None):
+    """work out when a photo should next be polled. activity_times are the
+    creation times of its recent activities, given when a check found
+    something new, and the photo is polled about as often as they have been
+    turning up. a check that finds nothing doubles the interval, so quiet
+    photos back off towards MAXPOLLMINUTES"""
+    now = datetime.now()
+    if activity_times:
+        span = now - activity_times[-1]
+        interval = (span.days * 24 * 60 + span.seconds // 60) // len(activity_times)
+    else:
+        interval = (photo.poll_interval or MINPOLLMINUTES) * 2
+    photo.poll_interval = max(MINPOLLMINUTES, min(MAXPOLLMINUTES, interval))
+    photo.next_poll = now + timedelta(minutes=photo.poll_interval)
+
+def newPhotoActivities(photos, deferred=None):
+    """check a batch of photos for new activity. the getInfo and comments calls
+    for every photo in the batch are fetched concurrently, so the batch costs
+    about one round trip to flickr. returns a dict of photo uid -> new activity ids"""
+    responses, fresh = fetchPhotoInfoAndComments(photos, deferred)
+    new_activity = {}
+    checked = []
+    # only responses that have been dealt with are remembered, so a retry of
+    # a check that died part way doesn't take them as already seen
+    seen = []
+    for photo in photos:
+        info_url = genPhotoInfoUrl(photo.uid)
+        if info_url not in responses:
+            # deferred
+            continue
+        photo_info_xml = responses[info_url]
+        if photo_info_xml is None:
+            # the same as last time, so there can't be anything new
+            schedulePhotoPoll(photo)
+            checked.append(photo)
+            continue
+        if not photo_info_xml:
+            continue
+        seen.append(info_url)
+        remote_last_modified, info_records = parsePhotoInfo(photo_info_xml)
+        if isNewerUpdate(remote_last_modified, photo.last_modified):
+            # update local last modified time
+            photo.last_modified = remote_last_modified
+            # an unchanged comment list has nothing new in it, don't fetch it again
+            comment_url = genPhotoCommentUrlForPhoto(photo)
+            comment_xml = responses.get(comment_url) or False
+            if comment_xml:
+                seen.append(comment_url)
+            new_activity[photo.uid] = CreatePhotoActivity(photo.uid, info_records, comment_xml, photo)
+        if new_activity.get(photo.uid):
+            schedulePhotoPoll(photo, getRecentActivityTimes(photo.uid, new_activity[photo.uid]))
+        else:
+            schedulePhotoPoll(photo)
+        checked.append(photo)
+    store.put(checked)
+    flickrclient.recordResponses([fresh[url] for url in seen if url in fresh])
+    return new_activity
+
+def newPhotoActivity(PhotoId):
+    photo = getPhoto(PhotoId)
+    if photo:
+        return newPhotoActivities([photo]).get(PhotoId, [])
+    return []
+
+# change detection
+
+def isNewerUpdate(remote_last_modified, local_last_modified):
+    "flickr lastupdate values are unix timestamps, compare them as numbers"
+    try:
+        return int(remote_last_modified) > int(local_last_modified or 0)
+    except ValueError:
+        return remote_last_modified > local_last_modified
+
+def parsePoolLastUpdates(response):
+    "returns a list of (uid, lastupdate) from a pool page fetched with extras=last_update, and the number of pages"
+    pages = 0
+    updates = []
+    for photo_xml in flickrxml.records(response, set([flickrxml.POOL, flickrxml.POOLPHOTO])):
+        if photo_xml.kind == flickrxml.POOL:
+            pages = int(photo_xml.getAttribute("pages") or 0)
+        else:
+            updates.append((photo_xml.getAttribute("id"), photo_xml.getAttribute("lastupdate")))
+    return updates, pages
+
+def findChangedPhotos(updates):
+    """diff pool lastupdate values against the stored photos in one batched
+    get, and make the photos that have changed due, so the next enginestart
+    queues their checks. returns the uids of the changed photos"""
+    stored = getPhotos([uid for uid, lastupdate in updates])
+    now = datetime.now()
+    changed = []
+    rescheduled = []
+    for uid, lastupdate in updates:
+        photo = stored.get(uid)
+        # photos we don't have yet are picked up by GetPhotos
+        if not photo:
+            continue
+        if lastupdate and isNewerUpdate(lastupdate, photo.last_modified):
+            changed.append(uid)
+        elif photo.next_poll:
+            continue
+        # changed, or stored before photos had a polling schedule
+        if not photo.next_poll or photo.next_poll > now:
+            photo.next_poll = now
+            rescheduled.append(photo)
+    store.put(rescheduled)
+    return changed
+
+def pollBucket(minutes=MINPOLLMINUTES, now=None):
+    "the slot of so many minutes a time falls in, for naming tasks"
+    return int((now or clock.time()) // (minutes * 60))
+
+def claimPhotoChecks(uids):
+    """claim each photo for one queued check with a memcache add, so a photo
+    whose check is still queued or running isn't queued again. returns the uids
+    that were claimed. the claims lapse after CHECKCLAIMSECONDS in case a check
+    never finishes, and if memcache is down every photo is let through"""
+    unclaimed = memcache.add_multi(dict((uid, True) for uid in uids), time=CHECKCLAIMSECONDS,
+                                   key_prefix='activitycheck/')
+    if unclaimed and len(unclaimed) == len(uids):
+        if not memcache.get_multi(unclaimed, key_prefix='activitycheck/'):
+            return uids
+    unclaimed = set(unclaimed)
+    return [uid for uid in uids if uid not in unclaimed]
+
+def releasePhotoChecks(uids):
+    "a check has finished with these photos, they can be queued again"
+    memcache.delete_multi(uids, key_prefix='activitycheck/')
+
+def enqueuePhotoActivityChecks(uids, per_task=PHOTOSPERTASK):
+    """queue activity checks for uids, per_task photos to a task. only the
+    photos that can be claimed are queued, the rest are already waiting on a
+    check. returns the number of photos queued"""
+    uids = claimPhotoChecks(uids)
+    tasks = []
+    for i in range(0, len(uids), per_task):
+        tasks.append(taskqueue.Task(url="/photo/getactivities/?uids=" + ",".join(uids[i:i+per_task]), method='GET'))
+    addTasks('activityq', tasks)
+    return len(uids)
+
+class DetectPhotoChanges(webapp.RequestHandler):
+    """walk the pool listing with the last_update extra and make the photos
+    that flickr says have changed since we last looked due for a check.
+    LoadQueues is the one place checks are queued from"""
+    def get(self):
+        run = self.request.get("run") or datetime.now().strftime("%Y%m%d%H%M%S")
+        page = int(self.request.get("page") or 1)
+        changed = []
+        for i in range(POOLPAGESPERTASK):
+            response = getPoolResponseFromUrl(genGroupPhotoQueryUrl(page, extras='last_update'))
+            if not response:
+                break
+            updates, pages = parsePoolLastUpdates(response)
+            changed.extend(findChangedPhotos(updates))
+            if page >= pages:
+                break
+            page = page + 1
+        else:
+            # more of the pool to go, hand on to another task
+            name = "changes-%s-%d" % (run, page)
+            try:
+                taskqueue.Queue(name='photosq').add(taskqueue.Task(url='/photo/detectchanges/?run=%s&page=%d' % (run, page), method='GET', name=name))
+            except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                pass
+        self.response.out.write("%d changed photos are due for a check" % len(changed))
+
+class GetNewPhotoActivity(webapp.RequestHandler):
+    def get(self, PhotoId):
+        photo = getPhoto(PhotoId)
+        try:
+            new_activity = newPhotoActivity(PhotoId)
+        except flickrclient.FlickrDeferred as e:
+            # put the check back on the queue for when flickr can be called again
+            logging.info(str(e))
+            worker_url = "/photo/getactivity/" + PhotoId
+            taskqueue.Queue(name='activityq').add(taskqueue.Task(url=worker_url, method='GET', countdown=e.retry_after))
+            new_activity = []
+        template_values = {'photo':photo,'photoid': PhotoId, 'activity':new_activity}
+        path = os.path.join(os.path.dirname(__file__), 'GetPhotoActivity.html')
+        self.response.out.write(instrument.renderTemplate(path, template_values))
+
+class GetNewPhotoActivities(webapp.RequestHandler):
+    """check a chunk of photos in one task, so the startup and datastore costs
+    are shared between them. photos the quota can't cover are left due, so the
+    next enginestart picks them up again"""
+    def get(self):
+        uids = [uid for uid in self.request.get("uids").split(",") if uid]
+        photos = list(getPhotos(uids).values())
+        deferred = []
+        try:
+            new_activity = newPhotoActivities(photos, deferred)
+        except flickrclient.FlickrDeferred as e:
+            logging.info(str(e))
+            new_activity = {}
+            deferred = photos
+        if deferred:
+            for photo in deferred:
+                photo.next_poll = datetime.now()
+            store.put(deferred)
+        releasePhotoChecks(uids)
+        count = sum([len(ids) for ids in new_activity.values()])
+        self.response.out.write("checked %d photos, %d new activities, %d deferred" % (len(photos) - len(deferred), count, len(deferred)))
+
+class UpdateAllPhotoActivity(webapp.RequestHandler):
+    def get(self):
+        query = store.query(Photo)
+        photos = query.fetch(FETCHLIMIT)
+        updates = []
+        deferred = []
+        for i in range(0, len(photos), PHOTOBATCH):
+            batch = photos[i:i+PHOTOBATCH]
+            new_activity = newPhotoActivities(batch, deferred)
+            for photo in batch:
+                if new_activity.get(photo.uid): updates.append([photo.uid, new_activity[photo.uid]])
+        
+        if deferred:
+            logging.info('%d photos were not checked, the flickr quota is running low' % len(deferred))
+        template_values = {'updates':updates, 'deferred':len(deferred)}
+        path = os.path.join(os.path.dirname(__file__), 'ShowAllUpdates.html')
+        self.response.out.write(instrument.renderTemplate(path, template_values))
+
+# search
+
+class IndexActivities(webapp.RequestHandler):
+    "add a batch of activities to the search index"
+    def post(self):
+        ids = [i for i in self.request.get('ids').split(',') if i]
+        activities = [a for a in getActivities(ids).values() if a]
+        terms = searchindex.indexDocuments([genSearchDocument(a) for a in activities])
+        logging.debug("indexed %d activities under %d terms" % (len(activities), terms))
+
+class BackfillSearchIndex(webapp.RequestHandler):
+    """index the activities stored before there was a search index, oldest
+    first, SEARCHINDEXBATCH at a time, each step queueing the next from its
+    cursor. running it again over indexed activities changes nothing"""
+    def get(self):
+        query = store.query(PhotoActivity).order("created")
+        cursor = self.request.get("cursor")
+        if cursor:
+            query.with_cursor(cursor)
+        activities = query.fetch(SEARCHINDEXBATCH)
+        searchindex.indexDocuments([genSearchDocument(a) for a in activities])
+        if len(activities) == SEARCHINDEXBATCH:
+            task = taskqueue.Task(url='/search/backfill/', params={'cursor': query.cursor()}, method='GET')
+            taskqueue.Queue(name='searchq').add(task)
+        self.response.out.write("indexed %d activities" % len(activities))
+
+# digests
+
+# recipients mailed by one task
+DIGESTRECIPIENTSPERTASK = 50
+# activities read from the datastore at a time, and the most a digest lists
+DIGESTPAGE = 200
+DIGESTITEMS = 1000
+DIGESTSECONDS = 6*60*60
+
+def getDigestActivities(since, until):
+    """the activities created after since and up to until, oldest first, at most
+    DIGESTITEMS. returns the activities and whether there were more"""
+    activities = []
+    cursor = None
+    while len(activities) < DIGESTITEMS:
+        query = store.query(PhotoActivity).filter("created >", since).filter("created <=", until).order("created")
+        if cursor:
+            query.with_cursor(cursor)
+        page = query.fetch(DIGESTPAGE)
+        activities.extend(page)
+        if len(page) < DIGESTPAGE:
+            return activities[:DIGESTITEMS], len(activities) > DIGESTITEMS
+        cursor = query.cursor()
+    return activities[:DIGESTITEMS], True
+
+def renderDigest(since, until, host_url):
+    """the body of the digest of activity between since and until, grouped by
+    photo, or None if there wasn't any. recipients with the same watermark get
+    the same digest, so it is built once and cached for the rest of the run"""
+    def render():
+        activities, more = getDigestActivities(since, until)
+        if not activities:
+            # memcache won't tell a cached None from a miss
+            return ""
+        photos = []
+        by_photo = {}
+        for activity, photopage_url, photothumb_url in joinActivityPhotoLinks(activities):
+            if activity.photo_id not in by_photo:
+                by_photo[activity.photo_id] = []
+                photos.append((photopage_url or activity.photo_id, by_photo[activity.photo_id]))
+            by_photo[activity.photo_id].append(activity)
+        template_values = {'count': len(activities), 'more': more, 'photos': photos,
+                           'since': since.strftime(SUMMARYDATEFORMAT), 'host_url': host_url}
+        path = os.path.join(os.path.dirname(__file__), 'DigestMail.txt')
+        return instrument.renderTemplate(path, template_values)
+    key = "%s/%s" % (since.strftime("%Y%m%d%H%M%S%f"), until.strftime("%Y%m%d%H%M%S%f"))
+    return cache.readThrough("digest", key, [], render, DIGESTSECONDS) or None
+
+class StartDigests(webapp.RequestHandler):
+    "from cron, mails each recipient the activity since their last digest"
+    def get(self):
+        until = clock.time()
+        addTasks('mailq', [taskqueue.Task(url='/digests/send/', params={'until': repr(until)},
+                                          method='GET', name="digests-%d" % int(until))])
+        self.response.out.write("sending digests")
+
+class SendDigests(webapp.RequestHandler):
+    """mails one batch of recipients, queueing the next batch first. recipients
+    are grouped by watermark, so each group's new activity is read and rendered
+    once however many recipients share it"""
+    def get(self):
+        until_time = float(self.request.get("until"))
+        until = datetime.fromtimestamp(until_time)
+        cursor = self.request.get("cursor")
+        query = store.query(MailRecipients).order("created")
+        if cursor:
+            query.with_cursor(cursor)
+        recipients = query.fetch(DIGESTRECIPIENTSPERTASK)
+        if len(recipients) == DIGESTRECIPIENTSPERTASK:
+            next_cursor = query.cursor()
+            name = "digests-%d-%s" % (int(until_time), hashlib.md5(next_cursor.encode("utf-8")).hexdigest())
+            addTasks('mailq', [taskqueue.Task(url='/digests/send/', params={'until': repr(until_time), 'cursor': next_cursor},
+                                              method='GET', name=name)])
+        if not DIGESTSENDER:
+            logging.warning("no DIGESTSENDER in config.py, digests are not being sent")
+            return
+        sent = 0
+        for recipient in recipients:
+            since = recipient.digest_watermark or recipient.created
+            if since >= until:
+                # already sent in this run
+                continue
+            body = renderDigest(since, until, self.request.host_url)
+            if body:
+                try:
+                    mail.send_mail(sender=DIGESTSENDER, to=recipient.email,
+                                   subject="new activity in the flickr group", body=body)
+                except Exception:
+                    # their watermark stays put, so the next run's digest covers this one too
+                    logging.exception("couldn't mail the digest to %s" % recipient.email)
+                    continue
+            # straight away, so if the task is retried they aren't mailed twice
+            recipient.digest_watermark = until
+            store.put([recipient])
+            sent = sent + 1
+        logging.info("sent digests to %d recipients" % sent)
+
+# queuing
+
+class LoadQueues(webapp.RequestHandler):
+    def get(self):
+        # named for this poll bucket, so if runs overlap the pool is only walked once
+        bucket = pollBucket()
+        phototask = taskqueue.Task(url='/getphotos/', method='GET', name="getphotos-%d" % bucket)
+        
+        #monitor = TaskMonitor()
+        #monitor.queue = "placed new photo check"
+        #monitor.put()
+
+        # look at the pool listing to see which photos have changed since they
+        # were last checked, and make those due. at most once every DETECTMINUTES,
+        # however often cron runs
+        changestask = taskqueue.Task(url='/photo/detectchanges/', method='GET', name="detectchanges-%d" % pollBucket(DETECTMINUTES))
+        addTasks('photosq', [phototask, changestask])
+
+        # and poll the photos whose schedule says they are due, which is the only
+        # way checks are queued. they are pushed on by their polling interval
+        # straight away so the next tick doesn't queue them again, the check
+        # itself sets the real next poll time
+        now = datetime.now()
+        query = store.query(Photo)
+        query.filter("next_poll <=", now)
+        query.order("next_poll")
+        photos = query.fetch(FETCHLIMIT)
+        for photo in photos:
+            photo.next_poll = now + timedelta(minutes=photo.poll_interval or MINPOLLMINUTES)
+        store.put(photos)
+        enqueuePhotoActivityChecks([photo.uid for photo in photos])
+
+        #monitor = TaskMonitor()
+        #monitor.queue = "placed photo activites check"
+        #monitor.put()
+        
+        # ok let's see what happens with the queuing!
+        # self.redirect('/')
+
+ROUTES = [('/enginestart', LoadQueues),
+          ('/getphotos/', GetPhotos),
+          ('/getupdates/', UpdateAllPhotoActivity),
+          ('/photo/detectchanges/', DetectPhotoChanges),
+          ('/photo/getactivity/(.*)', GetNewPhotoActivity),
+          ('/photo/getactivities/', GetNewPhotoActivities),
+          ('/search/index/', IndexActivities),
+          ('/search/backfill/', BackfillSearchIndex),
+          ('/digests/start/', StartDigests),
+          ('/digests/send/', SendDigests)]
+
+def makeApplication():
+    return instrument.instrument(webapp.WSGIApplication(ROUTES, debug=True))
+
+def main():
+    util.run_wsgi_app(makeApplication())
+
+if __name__ == '__main__':
+    main()
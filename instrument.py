@@ -0,0 +1,202 @@
+"""per request measurements, for the admin page.
+
+instrument() wraps a wsgi application so that every request records its wall
+time, its datastore gets, puts and queries, its urlfetch calls and how long
+they took, the tasks it queued and the time spent rendering templates. the
+service calls are counted by apiproxy hooks, so nothing in the handlers has
+to change. templates are rendered through renderTemplate, which times them
+and only imports the template module (and django) when a page is rendered.
+
+each handler keeps its last WINDOW requests in memcache, one slot per request,
+and the admin page works percentiles out from those. the SLOWSAMPLES slowest
+requests of the last SLOWSECONDS are kept with their breakdowns.
+"""
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+# requests kept per handler for the percentiles
+WINDOW = 200
+# slow requests kept with their breakdowns, and for how long
+SLOWSAMPLES = 10
+SLOWSECONDS = 60*60
+
+# the measurements of a request, in the order they are stored
+FIELDS = ['wall_ms', 'datastore_gets', 'datastore_puts', 'datastore_queries',
+          'urlfetches', 'urlfetch_ms', 'tasks', 'render_ms']
+
+# datastore calls, by what they count as
+DATASTORECALLS = {'Get': 'datastore_gets',
+                  'Put': 'datastore_puts',
+                  'RunQuery': 'datastore_queries',
+                  'Next': 'datastore_queries'}
+
+_current = threading.local()
+_hooks_installed = False
+_known_handlers = set()
+# the wall time a request needs to get into the slowest, cached here for a
+# minute so most requests don't need to look
+_slow_threshold = {'wall_ms': 0, 'until': 0}
+
+class RequestRecord(object):
+    def __init__(self, handler):
+        self.handler = handler
+        self.counts = dict((field, 0) for field in FIELDS)
+        self.fetch_started = {}
+
+    def add(self, field, amount=1):
+        self.counts[field] = self.counts[field] + amount
+
+def _record():
+    return getattr(_current, 'record', None)
+
+def _preCall(service, call, request, response):
+    record = _record()
+    if record is None:
+        return
+    if service == 'datastore_v3' and call in DATASTORECALLS:
+        record.add(DATASTORECALLS[call])
+    elif service == 'urlfetch' and call == 'Fetch':
+        record.add('urlfetches')
+        record.fetch_started[id(request)] = time.time()
+    elif service == 'taskqueue' and call == 'BulkAdd':
+        record.add('tasks', request.add_request_size())
+    elif service == 'taskqueue' and call == 'Add':
+        record.add('tasks')
+
+def _postCall(service, call, request, response):
+    record = _record()
+    if record is None or service != 'urlfetch':
+        return
+    started = record.fetch_started.pop(id(request), None)
+    if started is not None:
+        record.add('urlfetch_ms', int((time.time() - started) * 1000))
+
+def renderTemplate(path, template_values):
+    "template.render, timed"
+    from google.appengine.ext.webapp import template
+    started = time.time()
+    try:
+        return template.render(path, template_values)
+    finally:
+        record = _record()
+        if record is not None:
+            record.add('render_ms', int((time.time() - started) * 1000))
+
+def installHooks():
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('instrument', _preCall)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('instrument', _postCall)
+    _hooks_installed = True
+
+def handlerName(application, path):
+    "the name of the handler class a path is routed to"
+    for regexp, handler in getattr(application, '_url_mapping', []):
+        if regexp.match(path):
+            return handler.__name__
+    return path
+
+# storage of the measurements
+
+def _slotKey(handler, slot):
+    return 'reqstats/%s/%d' % (handler, slot)
+
+def _counterKey(handler):
+    return 'reqstats/%s/n' % handler
+
+HANDLERSKEY = 'reqstats/handlers'
+SLOWESTKEY = 'reqstats/slowest'
+
+def _registerHandler(handler):
+    if handler in _known_handlers:
+        return
+    handlers = memcache.get(HANDLERSKEY) or []
+    if handler not in handlers:
+        memcache.set(HANDLERSKEY, handlers + [handler])
+    _known_handlers.add(handler)
+
+def _keepIfSlow(record, path, now):
+    wall_ms = record.counts['wall_ms']
+    if now < _slow_threshold['until'] and wall_ms <= _slow_threshold['wall_ms']:
+        return
+    slowest = memcache.get(SLOWESTKEY) or []
+    slowest = [sample for sample in slowest if now - sample['time'] < SLOWSECONDS]
+    if len(slowest) < SLOWSAMPLES or wall_ms > slowest[-1]['counts']['wall_ms']:
+        slowest.append({'handler': record.handler, 'path': path, 'time': now, 'counts': record.counts})
+        slowest.sort(key=lambda sample: -sample['counts']['wall_ms'])
+        slowest = slowest[:SLOWSAMPLES]
+        memcache.set(SLOWESTKEY, slowest)
+    if len(slowest) >= SLOWSAMPLES:
+        _slow_threshold['wall_ms'] = slowest[-1]['counts']['wall_ms']
+    else:
+        _slow_threshold['wall_ms'] = 0
+    _slow_threshold['until'] = now + 60
+
+def save(record, path):
+    now = time.time()
+    try:
+        _registerHandler(record.handler)
+        n = memcache.incr(_counterKey(record.handler), initial_value=0)
+        if n is not None:
+            memcache.set(_slotKey(record.handler, n % WINDOW), [record.counts[field] for field in FIELDS])
+        _keepIfSlow(record, path, now)
+    except Exception:
+        # measuring must never break a request
+        logging.exception('could not save request measurements')
+
+def instrument(application):
+    "wrap a wsgi application so every request it serves is measured"
+    installHooks()
+    def wrapped(environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        record = RequestRecord(handlerName(application, path))
+        _current.record = record
+        started = time.time()
+        try:
+            return application(environ, start_response)
+        finally:
+            _current.record = None
+            record.counts['wall_ms'] = int((time.time() - started) * 1000)
+            save(record, path)
+    return wrapped
+
+# reading them back
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class HandlerSummary(object):
+    "percentiles of each measurement over a handler's recent requests"
+    def __init__(self, handler, samples):
+        self.handler = handler
+        self.requests = len(samples)
+        for i, field in enumerate(FIELDS):
+            values = [sample[i] for sample in samples]
+            setattr(self, field, (percentile(values, 0.5), percentile(values, 0.9), percentile(values, 0.99)))
+
+def getSummaries():
+    "returns a HandlerSummary for each handler that has been measured, slowest first"
+    handlers = memcache.get(HANDLERSKEY) or []
+    keys = []
+    for handler in handlers:
+        keys.extend([_slotKey(handler, slot) for slot in range(WINDOW)])
+    found = memcache.get_multi(keys)
+    summaries = []
+    for handler in handlers:
+        samples = [found[_slotKey(handler, slot)] for slot in range(WINDOW) if _slotKey(handler, slot) in found]
+        if samples:
+            summaries.append(HandlerSummary(handler, samples))
+    summaries.sort(key=lambda summary: -summary.wall_ms[1])
+    return summaries
+
+def getSlowest():
+    "the slowest recent requests, as dicts of handler, path, time and counts"
+    return memcache.get(SLOWESTKEY) or []
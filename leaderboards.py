@@ -0,0 +1,171 @@
+"""ranked tables of contributors by the votes they have received.
+
+there is a board for all time, for each week and for each month, each overall
+and for every activity type, so a vote on a tag counts towards six boards:
+all time, this week and this month, overall and for tags.
+
+every contributor has a score on each board they have been voted on in, and
+each board keeps its top TOPK contributors in a single entity. votes are
+applied a batch at a time from the vote write-behind tasks: each score is
+updated in its own transaction, then every board in the batch once, so a
+board's entity is written once per batch rather than once per vote.
+
+a contributor's rank is one batched get of the board and their score.
+"""
+from django.utils import simplejson
+from google.appengine.ext import db
+
+# contributors shown on a board
+TOPK = 100
+# boards keep this many more than they show, so a contributor who drops out
+# of the top after a down vote can be replaced by whoever was just below
+TOPKSLACK = 50
+
+# how many recent batch tokens a score remembers, so a retried batch isn't counted twice
+TOKENHISTORY = 50
+
+ALLTIME = 'all'
+WEEK = 'week'
+MONTH = 'month'
+PERIODS = [ALLTIME, WEEK, MONTH]
+# the board for every activity type together
+ALLTYPES = 'all'
+
+class LeaderboardScore(db.Model):
+    "one contributor's score on one board, keyed by the board and the author"
+    board = db.StringProperty(required=True)
+    author = db.StringProperty(required=True)
+    vote_sum = db.IntegerProperty(default=0)
+    vote_count = db.IntegerProperty(default=0)
+    applied_tokens = db.StringListProperty()
+
+class Leaderboard(db.Model):
+    "the top of one board, entries is a json list of [author, vote_sum, vote_count], highest first"
+    board = db.StringProperty(required=True)
+    entries = db.TextProperty()
+    updated = db.DateTimeProperty(auto_now=True)
+
+def genPeriodName(period, when):
+    "the name of the period a time falls in, such as week-2010-22"
+    if period == WEEK:
+        year, week, day = when.isocalendar()
+        return 'week-%d-%02d' % (year, week)
+    if period == MONTH:
+        return 'month-%d-%02d' % (when.year, when.month)
+    return ALLTIME
+
+def genBoardName(period, activity_type, when):
+    return '%s/%s' % (genPeriodName(period, when), activity_type or ALLTYPES)
+
+def boardsFor(activity_type, when):
+    "the boards a vote on an activity of activity_type made at when counts towards"
+    boards = []
+    for period in PERIODS:
+        for board_type in [ALLTYPES, activity_type]:
+            board = genBoardName(period, board_type, when)
+            if board not in boards:
+                boards.append(board)
+    return boards
+
+def _scoreKeyName(board, author):
+    return '%s/%s' % (board, author)
+
+def _applyScore(board, author, vote_count, vote_sum, token, seed):
+    "add to one score, returns its new (vote_count, vote_sum), or None if the token was already applied"
+    key_name = _scoreKeyName(board, author)
+    def txn():
+        score = LeaderboardScore.get_by_key_name(key_name)
+        if score is None:
+            score = LeaderboardScore(key_name=key_name, board=board, author=author)
+            if seed:
+                # the all time score starts from the contributor's tally from
+                # before there were boards, and this batch is added to it below
+                score.vote_count, score.vote_sum = seed
+        if token in score.applied_tokens:
+            return None
+        score.applied_tokens = (score.applied_tokens + [token])[-TOKENHISTORY:]
+        score.vote_count = score.vote_count + vote_count
+        score.vote_sum = score.vote_sum + vote_sum
+        score.put()
+        return score.vote_count, score.vote_sum
+    return db.run_in_transaction(txn)
+
+def _updateBoard(board, scores):
+    "put the new scores, a dict of author -> (vote_count, vote_sum), in their places on a board"
+    def txn():
+        entity = Leaderboard.get_by_key_name(board)
+        if entity is None:
+            entity = Leaderboard(key_name=board, board=board)
+            entries = []
+        else:
+            entries = simplejson.loads(entity.entries)
+        entries = [entry for entry in entries if entry[0] not in scores]
+        for author, (vote_count, vote_sum) in scores.items():
+            entries.append([author, vote_sum, vote_count])
+        entries.sort(key=lambda entry: (-entry[1], entry[0]))
+        entity.entries = simplejson.dumps(entries[:TOPK + TOPKSLACK])
+        entity.put()
+    db.run_in_transaction(txn)
+
+def applyVotes(votes, token, when, seed_all_time=None):
+    """count a batch of votes onto the boards. votes is a list of
+    (author, activity_type, vote_count, vote_sum), when is the time they were
+    made and token is unique to the batch, so applying it twice is harmless.
+    seed_all_time(author) gives the (vote_count, vote_sum) a contributor's
+    all time score should start from, for contributors voted on before there
+    were boards. it mustn't include this batch, or any other whose deltas are
+    still to be applied, or they would be counted twice"""
+    deltas = {}
+    for author, activity_type, vote_count, vote_sum in votes:
+        for board in boardsFor(activity_type, when):
+            count, total = deltas.get((board, author), (0, 0))
+            deltas[(board, author)] = (count + vote_count, total + vote_sum)
+    all_time = genBoardName(ALLTIME, ALLTYPES, when)
+    changed = {}
+    for (board, author), (vote_count, vote_sum) in deltas.items():
+        seed = None
+        if board == all_time and seed_all_time:
+            if not LeaderboardScore.get_by_key_name(_scoreKeyName(board, author)):
+                seed = seed_all_time(author)
+        score = _applyScore(board, author, vote_count, vote_sum, token, seed)
+        if score is None:
+            # already counted by an earlier run of this batch, the board may not have been
+            score = _currentScore(board, author)
+        changed.setdefault(board, {})[author] = score
+    for board, scores in changed.items():
+        _updateBoard(board, scores)
+
+def seedScores(board, scores):
+    """start a board off from existing tallies, a dict of author -> (vote_count,
+    vote_sum). contributors who already have a score on it keep theirs"""
+    stored = {}
+    for author, (vote_count, vote_sum) in scores.items():
+        score = LeaderboardScore.get_or_insert(_scoreKeyName(board, author), board=board, author=author,
+                                               vote_count=vote_count, vote_sum=vote_sum)
+        stored[author] = (score.vote_count, score.vote_sum)
+    if stored:
+        _updateBoard(board, stored)
+
+def _currentScore(board, author):
+    score = LeaderboardScore.get_by_key_name(_scoreKeyName(board, author))
+    return score.vote_count, score.vote_sum
+
+def getBoard(board, limit=TOPK):
+    "the top of a board, as a list of (author, vote_sum, vote_count)"
+    entity = Leaderboard.get_by_key_name(board)
+    if entity is None:
+        return []
+    return [tuple(entry) for entry in simplejson.loads(entity.entries)[:limit]]
+
+def getRank(board, author):
+    """returns (rank, vote_sum, vote_count) for a contributor on a board, rank
+    counting from 1, or None for rank if they are outside the top TOPK"""
+    entity, score = db.get([db.Key.from_path('Leaderboard', board),
+                            db.Key.from_path('LeaderboardScore', _scoreKeyName(board, author))])
+    if score is None:
+        return None, 0, 0
+    if entity is not None:
+        for rank, entry in enumerate(simplejson.loads(entity.entries)[:TOPK]):
+            if entry[0] == author:
+                return rank + 1, score.vote_sum, score.vote_count
+    return None, score.vote_sum, score.vote_count
@@ -1,25 +1,79 @@
 #!/usr/bin/env python
-import logging
-from datetime import datetime, date, time
+"""the app's data classes and the code they share, and the handlers of the
+pages and the vote rpcs.
+
+the app is served by four entry points, each a script of its own in app.yaml
+so a fresh instance only imports what its requests need:
+
+  browse.py   the pages people look at
+  votes.py    voting, and the tasks that apply votes
+  ingest.py   cron and the task queues that read the group from flickr, index
+              activity for search and mail digests
+  admin.py    the admin pages and jobs
+
+this module is imported by all of them, so it keeps to the datastore, the task
+queue and users. templates (and with them django) are only loaded by the first
+request that renders one, and the flickr client, xml parsing and mail only by
+ingest.py.
+"""
+from datetime import datetime, date, time, timedelta
 from django.utils import simplejson
 from google.appengine.ext import db
 from google.appengine.api import users
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import util
-from google.appengine.ext.webapp import template
-from google.appengine.api import urlfetch
 from google.appengine.api.labs import taskqueue
-from google.appengine.api.labs.taskqueue import Queue
-from google.appengine.api import mail
-from xml.dom import minidom
+import hashlib
 import os
+import time as clock
+import calendar
+from urllib import urlencode
 
-from config import apikey
-from config import GROUPID
 from config import FETCHLIMIT
 from config import PAGINGLIMIT
 
-FLICKRKEY = apikey
+import cache
+import counters
+import paging
+import storage
+import instrument
+import leaderboards
+import searchindex
+
+# vote tallies are spread over this many shards, contributors collect the
+# votes from all of their activities so they get more
+ACTIVITYVOTESHARDS = 3
+CONTRIBUTORVOTESHARDS = 20
+
+# the sharded tallies are copied back onto activities and contributors, for
+# sorting and filtering, at most once every VOTEFOLDSECONDS
+VOTEFOLDSECONDS = 10
+
+# contributors put on the all time leaderboard by one SeedLeaderboard step
+SEEDBATCH = 100
+
+# cached pages are versioned on the kinds of data they show, see cache.py
+CACHE_ACTIVITY = "activity"
+CACHE_PHOTOS = "photos"
+CACHE_VOTES = "votes"
+CACHEGROUPS = ["leaguetable", "showactors", "actorreport", "listactivities"]
+
+# the first page of activities changes often, so isn't kept as long
+LISTINGCACHESECONDS = 10*60
+
+# photos are polled again between MINPOLLMINUTES and MAXPOLLMINUTES after
+# they were last checked. when a check finds new activity the interval is how
+# often the photo's recent activities have been turning up, and it doubles
+# every time a check finds nothing new
+MINPOLLMINUTES = 15
+MAXPOLLMINUTES = 60*24*14
+
+# the actor pages show this many of a contributor's most recent items of each
+# type, and of the votes they have received
+ACTORRECENT = 10
+
+# tasks are added to a queue TASKBATCH at a time (the most one taskqueue call will take)
+TASKBATCH = 100
 
 # data classes
 
@@ -27,9 +81,20 @@ class TaskMonitor(db.Model):
     queue = db.StringProperty()
     created = db.DateTimeProperty(auto_now_add=True)
 
+class PoolSyncState(db.Model):
+    "checkpoint for walking the group pool, keyed by the group id"
+    high_water = db.IntegerProperty(default=0) # dateadded of the newest photo from the last complete sync
+    run_high_water = db.IntegerProperty(default=0) # newest dateadded seen by the sync in progress
+    next_page = db.IntegerProperty(default=1)
+    in_progress = db.BooleanProperty(default=False)
+    run_started = db.DateTimeProperty()
+    updated = db.DateTimeProperty(auto_now=True)
+
 class MailRecipients(db.Model):
     email = db.StringProperty(required=True)
     created = db.DateTimeProperty(auto_now_add=True)
+    # activities created up to this time have been in a digest sent to the recipient
+    digest_watermark = db.DateTimeProperty()
 
 class Photo(db.Model):
     uid = db.StringProperty(required=True)
@@ -40,6 +105,11 @@ class Photo(db.Model):
     photoimage_url = db.StringProperty()
     photothumb_url = db.StringProperty()
     last_modified = db.StringProperty()
+    next_poll = db.DateTimeProperty()
+    poll_interval = db.IntegerProperty(default=MINPOLLMINUTES) # minutes
+    # the newest comment we have stored for this photo, so we only ask flickr for newer ones
+    comment_watermark_date = db.IntegerProperty(default=0) # unix time the comment was made
+    comment_watermark_id = db.StringProperty()
 
 class PhotoActivity(db.Model):
     activity_id = db.StringProperty(required=True)
@@ -47,8 +117,13 @@ class PhotoActivity(db.Model):
     author = db.StringProperty()
     activity_type = db.StringProperty()
     activity_content = db.StringProperty()
+    # copied from the photo when the activity is created, so listings don't
+    # have to look the photo up
+    photopage_url = db.StringProperty()
+    photothumb_url = db.StringProperty()
     vote_sum = db.IntegerProperty(default=0)
     vote_count = db.IntegerProperty(default=0)
+    votes_sharded = db.BooleanProperty(default=False)
     created = db.DateTimeProperty(auto_now_add=True)
     
 class UniqueContributors(db.Model):
@@ -59,8 +134,23 @@ class UniqueContributors(db.Model):
     last_activity_id = db.StringProperty()
     vote_sum = value = db.IntegerProperty(default=0)
     vote_count = value = db.IntegerProperty(default=0)
+    votes_sharded = db.BooleanProperty(default=False)
     created = db.DateTimeProperty(auto_now_add=True)
     
+class ActorSummary(db.Model):
+    """everything the actor pages show about a contributor, kept up to date as
+    their activities and votes come in. keyed like their UniqueContributors.
+    recent is json: a list of recent items for each activity type and for votes"""
+    author = db.StringProperty(required=True)
+    photo_count = db.IntegerProperty(default=0)
+    tag_count = db.IntegerProperty(default=0)
+    note_count = db.IntegerProperty(default=0)
+    comment_count = db.IntegerProperty(default=0)
+    recent = db.TextProperty()
+    vote_sum = db.IntegerProperty(default=0)
+    vote_count = db.IntegerProperty(default=0)
+    created = db.DateTimeProperty(auto_now_add=True)
+
 class Vote(db.Model):
     "we don't need a uid, as every vote action is stored, if a vote happens twice due to concurrency issues, ow well, it's not very important"
     recipient = db.StringProperty()
@@ -69,19 +159,61 @@ class Vote(db.Model):
     activity_id = db.StringProperty()
     created = db.DateTimeProperty(auto_now_add=True)
 
-
+# everything but the pool sync checkpoint is kept in the backend picked in
+# config.py, the datastore unless it says otherwise, see storage.py
+store_models = [Photo, PhotoActivity, UniqueContributors, Vote, MailRecipients, TaskMonitor, ActorSummary]
+store = storage.openBackend(store_models)
     
 # getters and setters for the data classes 
-    
+
+# photos, activities and contributors are stored under key names derived from
+# their flickr ids, so that lookups are direct key gets rather than queries.
+# datastore key names may not start with a digit, and flickr ids nearly always
+# do, so each kind gets a short prefix.
+
+def genPhotoKeyName(photoid):
+    return "p" + photoid
+
+def genActivityKeyName(activity_id):
+    return "a" + activity_id
+
+def genContributorKeyName(author):
+    return "u" + author
+
+# names of the aggregate counts kept in counters.py
+STAT_ACTIVITIES = "activities"
+STAT_UNVOTED = "unvoted"
+STAT_PHOTOS = "photos"
+STAT_CONTRIBUTORS = "contributors"
+STAT_VOTES = "votes"
+ACTIVITYTYPES = ["photo", "tag", "note", "comment"]
+
+def genActivityTypeStatName(activity_type):
+    return STAT_ACTIVITIES + "/" + activity_type
+
+def genNewActivityStats(activity_types, new_contributors=0):
+    "the changes to the aggregate counts when activities of activity_types are created"
+    deltas = {STAT_ACTIVITIES: len(activity_types), STAT_UNVOTED: len(activity_types), STAT_CONTRIBUTORS: new_contributors}
+    for activity_type in activity_types:
+        name = genActivityTypeStatName(activity_type)
+        deltas[name] = deltas.get(name, 0) + 1
+    return deltas
 
 def getUniqueContributor(author):
-    try:
-        query = db.Query(UniqueContributors)
-        query.filter('author =', author)
-        c  = query.fetch(limit=1)
-        return c[0] 
-    except:
-        return None 
+    if not author:
+        return None
+    return store.get(UniqueContributors, [genContributorKeyName(author)])[0]
+
+def getUniqueContributors(authors):
+    "batched version of getUniqueContributor, returns a dict of author -> contributor"
+    authors = list(set(authors))
+    if not authors:
+        return {}
+    contributors = store.get(UniqueContributors, [genContributorKeyName(a) for a in authors])
+    return dict(zip(authors, contributors))
+
+def newUniqueContributor(author):
+    return UniqueContributors(key_name=genContributorKeyName(author), author=author)
 
 def create_contributor_record(target):
     def wrapper(*args, **kwargs):
@@ -92,143 +224,220 @@ def create_contributor_record(target):
         if uc:
             uc.last_activity_date = now
             uc.last_activity_id = activity_id
-            uc.put()
+            store.put([uc])
             return target(*args, **kwargs)
         else:
-            uc = UniqueContributors(author=author)
+            uc = newUniqueContributor(author)
             uc.last_activity_date = now
             uc.last_activity_id = activity_id
-            uc.put()
+            store.put([uc])
+            counters.incrementStat(STAT_CONTRIBUTORS, 1)
             return target(*args, **kwargs)
     return wrapper
+
+def newActivity(uid, photo_id, author, action, activity_type, photo=None):
+    a = PhotoActivity(key_name=genActivityKeyName(uid), activity_id=uid, photo_id=photo_id)
+    a.author=author
+    a.activity_content=action
+    a.activity_type=activity_type
+    if photo:
+        a.photopage_url = photo.photopage_url
+        a.photothumb_url = photo.photothumb_url
+    return a
     
 # use a decorator to create contributor ids in a seperate datastore,
 # so that this logic is easier to handle from here.
 # this is a good intercept point to create these, as this is where we will see
 # all new contributors.
 @create_contributor_record
-def createActivity(uid, photo_id, author, action, activity_type):
-    a = PhotoActivity(activity_id=uid, photo_id=photo_id)
-    a.author=author
-    a.activity_content=action
-    a.activity_type=activity_type
-    a.put()
+def createActivity(uid, photo_id, author, action, activity_type, photo=None):
+    if photo is None:
+        photo = getPhoto(photo_id)
+    a = newActivity(uid, photo_id, author, action, activity_type, photo)
+    store.put([a])
+    updateActorSummaries([a])
+    counters.incrementStats(genNewActivityStats([activity_type]))
+    queueSearchIndexing([uid])
+    cache.bump(CACHE_ACTIVITY)
     return True
 
-def getActivity(activity_id):
-    try:
-        query = db.Query(PhotoActivity)
-        query.filter('activity_id =', activity_id)
-        a = query.fetch(limit=1)
-        return a[0]
-    except:
-        return None 
-
-def createPhoto(photoid):
-    p = Photo(uid=photoid)
-    p.put()
-    return p
-
-def getPhoto(photoid):
-    try:
-        query = db.Query(Photo)
-        query.filter('uid =', photoid)
-        photo = query.fetch(limit=1)
-        return photo[0]
-    except:
-        return None 
-
-# flickr api calls
+def createActivities(activity_records, photos=None):
+    """batched version of createActivity, takes a list of
+    (uid, photo_id, author, action, activity_type) tuples and writes the
+    activities and their contributor records in a single put. photos is a
+    dict of photo_id -> photo, any photos not in it are looked up"""
+    if not activity_records:
+        return []
+    now = datetime.now()
+    photos = dict(photos or {})
+    missing = [r[1] for r in activity_records if r[1] not in photos]
+    if missing:
+        photos.update(getPhotos(missing))
+    authors = [r[2] for r in activity_records]
+    contributors = getUniqueContributors(authors)
+    entities = []
+    new_authors = set()
+    for uid, photo_id, author, action, activity_type in activity_records:
+        uc = contributors.get(author)
+        if not uc:
+            uc = newUniqueContributor(author)
+            contributors[author] = uc
+            new_authors.add(author)
+        uc.last_activity_date = now
+        uc.last_activity_id = uid
+        entities.append(newActivity(uid, photo_id, author, action, activity_type, photos.get(photo_id)))
+    store.put(entities + list(contributors.values()))
+    updateActorSummaries(entities, new_authors)
+    counters.incrementStats(genNewActivityStats([r[4] for r in activity_records], len(new_authors)))
+    queueSearchIndexing([r[0] for r in activity_records])
+    cache.bump(CACHE_ACTIVITY)
+    return [r[0] for r in activity_records]
 
-def genPhotoCommentUrl(PhotoId):
-    url = "http://api.flickr.com/services/rest/?method=flickr.photos.comments.getList&photo_id="+PhotoId+"&api_key="+FLICKRKEY
-    return url
+def getActivity(activity_id):
+    if not activity_id:
+        return None
+    return store.get(PhotoActivity, [genActivityKeyName(activity_id)])[0]
+
+def getActivities(activity_ids):
+    "batched version of getActivity, returns a dict of activity_id -> activity"
+    activity_ids = list(set(activity_ids))
+    if not activity_ids:
+        return {}
+    activities = store.get(PhotoActivity, [genActivityKeyName(a) for a in activity_ids])
+    return dict(zip(activity_ids, activities))
+
+# actor summaries
+
+SUMMARYDATEFORMAT = "%Y-%m-%d %H:%M:%S"
+
+def genActorSummaryKeyName(author):
+    return genContributorKeyName(author)
+
+def newActorSummary(author):
+    summary = ActorSummary(key_name=genActorSummaryKeyName(author), author=author)
+    summary.recent = simplejson.dumps(dict((t, []) for t in ACTIVITYTYPES + ["votes"]))
+    return summary
+
+def getActorSummaries(authors):
+    "returns a dict of author -> summary, for the authors that have one"
+    authors = list(set([a for a in authors if a]))
+    if not authors:
+        return {}
+    summaries = store.get(ActorSummary, [genActorSummaryKeyName(a) for a in authors])
+    return dict([(a, s) for a, s in zip(authors, summaries) if s])
+
+def summaryActivityItem(activity, photopage_url=None, photothumb_url=None):
+    return {'activity_id': activity.activity_id, 'photo_id': activity.photo_id,
+            'activity_content': activity.activity_content,
+            'photopage_url': photopage_url or activity.photopage_url,
+            'photothumb_url': photothumb_url or activity.photothumb_url,
+            'created': activity.created.strftime(SUMMARYDATEFORMAT)}
+
+def summaryVoteItem(vote):
+    return {'voter': vote.voter, 'value': vote.value, 'activity_id': vote.activity_id,
+            'created': vote.created.strftime(SUMMARYDATEFORMAT)}
+
+def addToActorSummary(author, activities, create=False):
+    """count new activities into an author's summary, in a transaction so
+    tasks adding to the same summary at once can't lose each other's counts.
+    an author without a summary is left for getActorSummary to build, as it
+    can count what they did before, unless create is set"""
+    summary = getActorSummaries([author]).get(author)
+    if not summary:
+        if not create:
+            return
+        summary = newActorSummary(author)
+    recent = simplejson.loads(summary.recent)
+    for activity in activities:
+        if activity.activity_type not in ACTIVITYTYPES:
+            continue
+        items = [summaryActivityItem(activity)] + recent[activity.activity_type]
+        recent[activity.activity_type] = items[:ACTORRECENT]
+        count_property = activity.activity_type + "_count"
+        setattr(summary, count_property, getattr(summary, count_property) + 1)
+    summary.recent = simplejson.dumps(recent)
+    store.put([summary])
+
+def updateActorSummaries(activities, new_authors=()):
+    """count stored activities into their authors' summaries, one transaction
+    per author. nothing of new_authors' has been counted anywhere yet, so
+    their summaries start here"""
+    by_author = {}
+    for activity in activities:
+        by_author.setdefault(activity.author, []).append(activity)
+    for author, authored in by_author.items():
+        store.runInTransaction(addToActorSummary, author, authored, author in new_authors)
+
+def countActivities(make_query):
+    "count everything a query matches, a FETCHLIMIT batch at a time"
+    count = 0
+    cursor = None
+    while True:
+        query = make_query()
+        if cursor:
+            query.with_cursor(cursor)
+        batch = query.fetch(FETCHLIMIT)
+        count = count + len(batch)
+        if len(batch) < FETCHLIMIT:
+            return count
+        cursor = query.cursor()
+
+def buildActorSummary(author):
+    "work a summary out from the stored activities and votes, for contributors from before there were summaries"
+    summary = newActorSummary(author)
+    recent = simplejson.loads(summary.recent)
+    for activity_type in ACTIVITYTYPES:
+        setattr(summary, activity_type + "_count", countActivities(genActivityQuery(activity_type, author)))
+        activities = paging.fetchPage(genActivityQuery(activity_type, author), "created", ACTORRECENT).items
+        recent[activity_type] = [summaryActivityItem(a, page_url, thumb_url) for a, page_url, thumb_url in joinActivityPhotoLinks(activities)]
+    recent["votes"] = [summaryVoteItem(v) for v in getActorVotesHistory(author, ACTORRECENT)]
+    summary.recent = simplejson.dumps(recent)
+    contributor = getUniqueContributor(author)
+    if contributor:
+        fillinContributorVotes([contributor])
+        summary.vote_count = contributor.vote_count
+        summary.vote_sum = contributor.vote_sum
+    store.put([summary])
+    return summary
+
+def getActorSummary(author):
+    "the summary of a contributor, built if they don't have one yet. None if they have done nothing"
+    summary = getActorSummaries([author]).get(author)
+    if summary:
+        return summary
+    if not getUniqueContributor(author):
+        return None
+    return buildActorSummary(author)
 
-def genPhotoInfoUrl(PhotoId):
-    url = "http://api.flickr.com/services/rest/?method=flickr.photos.getInfo&photo_id="+PhotoId+"&api_key="+FLICKRKEY
-    return url
+def readActorSummary(summary):
+    "the recent items of a summary, with their dates as datetimes for the templates"
+    recent = simplejson.loads(summary.recent)
+    for items in recent.values():
+        for item in items:
+            item['created'] = datetime.strptime(item['created'], SUMMARYDATEFORMAT)
+    return recent
 
-def genPhotoSizeQueryUrl(PhotoId):
-    url = "http://api.flickr.com/services/rest/?method=flickr.photos.getSizes&photo_id="+PhotoId+"&api_key="+FLICKRKEY
-    return url
+def newPhoto(photoid):
+    return Photo(key_name=genPhotoKeyName(photoid), uid=photoid)
 
-def genGroupPhotoQueryUrl():
-    url = 'http://api.flickr.com/services/rest/?method=flickr.groups.pools.getPhotos&group_id='+GROUPID+'&api_key='+FLICKRKEY
-    return url
+def getPhoto(photoid):
+    if not photoid:
+        return None
+    return store.get(Photo, [genPhotoKeyName(photoid)])[0]
 
-# xml response
+def getPhotos(photoids):
+    "batched version of getPhoto, returns a dict of photoid -> photo"
+    photoids = list(set(photoids))
+    if not photoids:
+        return {}
+    photos = store.get(Photo, [genPhotoKeyName(p) for p in photoids])
+    return dict(zip(photoids, photos))
 
-def getResponseFromUrl(url):
-    result = urlfetch.fetch(url,headers = {'Cache-Control' : 'max-age=300'})        
-    if result.status_code == 200:
-        return result.content
-    else:
-        return False
-
-# model setters and getters
-
-def genPhotoImageLink(server, uid, secret):
-    photoimage_url = "http://farm5.static.flickr.com/"+server+"/"+uid+"_"+secret+"_m.jpg"
-    return photoimage_url
-
-def genPhotoThumbLink(server, uid, secret):
-    photothumb_url = "http://farm5.static.flickr.com/"+server+"/"+uid+"_"+secret+"_t.jpg"
-    return photothumb_url
-
-def genPhotoPageLink(owner, uid):
-    photopage_url = "http://www.flickr.com/photos/"+owner+"/"+uid
-    return photopage_url
-
-# get and set image data
-
-def fillinPhotoDetails(photo_xml):
-    "this is our fist act of creating the photo object"
-    uid = photo_xml.getAttribute("id")
-    owner = photo_xml.getAttribute("owner")
-    server = photo_xml.getAttribute("server")
-    secret = photo_xml.getAttribute("secret")
-    title = photo_xml.getAttribute("title")
-    ownername = photo_xml.getAttribute("ownername")
-    photopage_url = genPhotoPageLink(owner, uid)
-    photoimage_url = genPhotoImageLink(server, uid, secret)
-    photothumb_url = genPhotoThumbLink(server, uid, secret)
-    #
-    photo = createPhoto(uid)
-    photo.owner_id = owner
-    photo.owner_name = ownername
-    photo.photopage_url = photopage_url
-    photo.photoimage_url = photoimage_url
-    photo.photothumb_url = photothumb_url
-    photo.title = title
-    photo.last_modified = '' # we don't really know, we will get activity later, but we need to zero this
-    photo.put()
-    
-def parsePhotosFromGroupResponse(response):
-    xml = minidom.parseString(response)
-    photos_xml = xml.getElementsByTagName('photo')
-    uids = []
-    for photo_xml in photos_xml:
-        # get the photoid
-        uid = photo_xml.getAttribute("id")
-        # check to see if the photoid is in our local database
-        photo = getPhoto(uid)
-        # if the picture is there, then don't do anything
-        if photo:
-            continue
-        # otherwise create a picture object and add it to the datastore
-        else:
-            #createPhoto(uid)
-            fillinPhotoDetails(photo_xml)
-            uids.append(uid)
-    if len(uids) == 0:
-        return None
-    return uids
-         
 class ListPhotos(webapp.RequestHandler):
     "list images that we have already retrieved from a flickr group"
     def get(self):
     
-        query = Photo.all()
+        query = store.query(Photo)
         pictures = query.fetch(1000) # could impliment paging here, but not yet
         picturenumber = len(pictures)
         #stored_uids = []
@@ -236,293 +445,162 @@ class ListPhotos(webapp.RequestHandler):
         #    stored_uids.append(picture.uid)
         template_values = {'count':picturenumber, 'pictures':pictures}
         path = os.path.join(os.path.dirname(__file__), 'ListPhotos.html')
-        self.response.out.write(template.render(path, template_values))
-
-def genPhotoAddActivityFromPhotoUID(uid):
-    "if someone has added a picture to the group this should be recorded as an activity"
-    photo = getPhoto(uid)
-    author = photo.owner_id
-    action = "added photo"
-    activity_type = "photo"
-    createActivity(uid, uid, author, action, activity_type)    
-    return True
-
-def genPhotoAddActivitiesFromPhotoUIDs(uids):
-    if uids is not None:
-        "if someone has added a picture to the group this should be recorded as an activity"
-        for uid in uids:
-            genPhotoAddActivityFromPhotoUID(uid)
-    else:
-        return None
-
-class GetPhotos(webapp.RequestHandler):
-    "retreive a list of photos from a flickr group, and store new images"
-    def get(self):
-    
-        url = genGroupPhotoQueryUrl()
-
-        response = getResponseFromUrl(url) 
-        if response:
-            uids = parsePhotosFromGroupResponse(response)
-            # might not find any new images, so the next function has to be able to 
-            # deal with None as a return type
-            genPhotoAddActivitiesFromPhotoUIDs(uids)
-        else:
-            uids = "no new photos were found"
-        if uids == None:
-            uids = "no new photos were found"
-    
-    
-        template_values = {'photoids': uids}
-        path = os.path.join(os.path.dirname(__file__), 'GetPhotos.html')
-        self.response.out.write(template.render(path, template_values))
-        
-# photo parsing
-
-def parsePhotoInfoResponse(response):
-    xml = minidom.parseString(response)
-    dates_xml = xml.getElementsByTagName('dates')
-    remote_last_modified = dates_xml[0].getAttribute("lastupdate") # I don't know why I need the [0] here
-    return remote_last_modified
-
-def getLastModifiedTime(PhotoId):
-    url = genPhotoInfoUrl(PhotoId)
-    response = getResponseFromUrl(url)
-    if response:
-        remote_last_modified = parsePhotoInfoResponse(response)
-        return remote_last_modified, response
-    else:
-        return None 
+        self.response.out.write(instrument.renderTemplate(path, template_values))
 
-# get and set photo activity 
-
-
-def extractActivity(PhotoId, photo_info, activity_type):
-    "need to change the iter names in this function to be more genaric"
-    new_activity_ids = []
-    photo_info_xml = minidom.parseString(photo_info)
-    tags = photo_info_xml.getElementsByTagName(activity_type)
-    for tag in tags:
-        activity_id = tag.getAttribute("id")
-        activity = getActivity(activity_id)
-        if not activity:
-            activity_author = tag.getAttribute("author")
-            tagtext = tag.firstChild.nodeValue # first child is the text in the tag, doh!
-            createActivity(activity_id, PhotoId, activity_author, tagtext, activity_type)
-            new_activity_ids.append(activity_id)
-        else:
-            continue
-    return new_activity_ids
-
-def getPhotoCommentsXML(PhotoId):
-    url = genPhotoCommentUrl(PhotoId)
-    comments_xml = getResponseFromUrl(url)
-    return comments_xml
-    
-def CreatePhotoActivity(PhotoId, photo_info_xml):
-    new_activity_ids = []
-    # tag activity
-    new_activity_ids.extend(extractActivity(PhotoId, photo_info_xml, "tag"))
-    # notes activity
-    new_activity_ids.extend(extractActivity(PhotoId, photo_info_xml, "note"))
-    # comment activity
-    comment_xml = getPhotoCommentsXML(PhotoId)
-    new_activity_ids.extend(extractActivity(PhotoId, comment_xml, "comment"))
-    return new_activity_ids     
-
-def newPhotoActivity(PhotoId):
-    new_activity = []
-    photo = getPhoto(PhotoId)
-    if photo:
-        local_last_modified = photo.last_modified
-        remote_last_modified, photo_info_xml = getLastModifiedTime(PhotoId)
-        if remote_last_modified > local_last_modified:
-            # update local last modified time
-            photo.last_modified = remote_last_modified
-            photo.put()
-            message = 'yay, I have found some new activity on that photo'
-            new_activity = CreatePhotoActivity(PhotoId, photo_info_xml)
-            # now we parse photo_info_xml to get some activity data
-            # get the activity on the photo
-        else:
-            new_activity = []
-    else:
-        new_activity = []
-    return new_activity
-
-class GetNewPhotoActivity(webapp.RequestHandler):
-    def get(self, PhotoId):
-        photo = getPhoto(PhotoId)
-        new_activity = newPhotoActivity(PhotoId)
-        template_values = {'photo':photo,'photoid': PhotoId, 'activity':new_activity}
-        path = os.path.join(os.path.dirname(__file__), 'GetPhotoActivity.html')
-        self.response.out.write(template.render(path, template_values))
-
-class UpdateAllPhotoActivity(webapp.RequestHandler):
-    def get(self):
-        query = Photo.all()
-        photos = query.fetch(FETCHLIMIT)
-        updates = []
-        for photo in photos:
-            new_activity = newPhotoActivity(photo.uid)
-            if new_activity: updates.append([photo.uid, new_activity])
-        
-        template_values = {'updates':updates}
-        path = os.path.join(os.path.dirname(__file__), 'ShowAllUpdates.html')
-        self.response.out.write(template.render(path, template_values))
+# queuing
 
-def getLocalPhotoActivity(PhotoId):
-    q = db.GqlQuery("SELECT * FROM PhotoActivity WHERE photo_id = :1", PhotoId)
-    results = q.fetch(FETCHLIMIT)
-    return results
+def addTasks(queue_name, tasks):
+    """add tasks to a queue TASKBATCH at a time. named tasks that have already
+    been added are skipped, the rest of their batch still goes in"""
+    queue = taskqueue.Queue(name=queue_name)
+    for i in range(0, len(tasks), TASKBATCH):
+        try:
+            queue.add(tasks[i:i+TASKBATCH])
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+def genActivityQuery(activity_type=None, author=None, unvoted=False, photo_id=None):
+    "returns a function that makes an activity query with the given filters, for the pager"
+    def make_query():
+        query = store.query(PhotoActivity)
+        if activity_type:
+            query.filter("activity_type =", activity_type)
+        if author:
+            query.filter("author =", author)
+        if unvoted:
+            query.filter("vote_count =", 0)
+        if photo_id:
+            query.filter("photo_id =", photo_id)
+        return query
+    return make_query
+
+def getLocalPhotoActivity(PhotoId, cursor=None, direction=paging.FORWARD):
+    "returns a paging.Page of the activity on a photo"
+    return paging.fetchPage(genActivityQuery(photo_id=PhotoId), "created", PAGINGLIMIT, cursor, direction)
 
 class ShowStoredPhotoActivity(webapp.RequestHandler):
     def get(self, PhotoId):
-        activities = getLocalPhotoActivity(PhotoId)
+        page = getLocalPhotoActivity(PhotoId, self.request.get('cursor') or None, self.request.get('dir') or paging.FORWARD)
         photo = getPhoto(PhotoId)
-        template_values = {'photo':photo ,'photoid': PhotoId, 'activities': activities}
+        template_values = {'photo':photo ,'photoid': PhotoId, 'activities': page.items, 'page': page}
         path = os.path.join(os.path.dirname(__file__), 'ShowPhotoActivity.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(instrument.renderTemplate(path, template_values))
+
+def joinActivityPhotoLinks(activities):
+    """pair each activity with its photo page and thumbnail links. these are
+    stored on the activity, only activities from before that was done need
+    their photos looking up, and those are fetched in one batched get"""
+    missing = [a.photo_id for a in activities if not a.photothumb_url]
+    photos = getPhotos(missing)
+    activiies_photolinks = []
+    for activity in activities:
+        photopage_url = activity.photopage_url
+        photothumb_url = activity.photothumb_url
+        if not photothumb_url:
+            photo = photos.get(activity.photo_id)
+            if photo:
+                photopage_url = photo.photopage_url
+                photothumb_url = photo.photothumb_url
+        activiies_photolinks.append((activity, photopage_url, photothumb_url))
+    return activiies_photolinks
+
+def getCurrentAdmin():
+    "the nickname of the current user if they are an admin, otherwise None"
+    admin = None 
+    if users.get_current_user():
+        user = users.get_current_user()
+        nickname = user.nickname()
+        if users.is_current_user_admin():
+            admin = nickname
+    return admin
+
+def renderActivityListing(handler, make_query, params, count, template_file, cache_key=None):
+    "one page of activities, with their photos and paging links, cached under cache_key if given"
+    admin = getCurrentAdmin()
+    def render():
+        page = paging.fetchRequestedPage(handler.request, make_query, "created", PAGINGLIMIT, params)
+        activiies_photolinks = joinActivityPhotoLinks(fillinActivityVotes(page.items))
+        template_values = {'count':count, 'activities':activiies_photolinks, 'page':page, 'admin':admin}
+        path = os.path.join(os.path.dirname(__file__), template_file)
+        return instrument.renderTemplate(path, template_values)
+    if cache_key:
+        # admins see a little more on the page
+        html = cache.readThrough("listactivities", "%s/%s" % (cache_key, bool(admin)), [CACHE_ACTIVITY, CACHE_VOTES], render, LISTINGCACHESECONDS)
+    else:
+        html = render()
+    handler.response.out.write(html)
 
 class ListActivities(webapp.RequestHandler):
+    "all activities, most recent first, optionally only those of one type or by one author"
     def get(self):
-        query = PhotoActivity.all()
-        query.order("-__key__") #chronological reverse order
-        activities = query.fetch(PAGINGLIMIT+1)
-        
-        # some code for paging
-        # taken from http://code.google.com/appengine/articles/paging.html
-        forward = self.request.get("next")
-        back = self.request.get("previous")
-        newest = self.request.get("newest") 
-        oldest = self.request.get("oldest")  
-
-        if forward:
-            activities = PhotoActivity.all().order("-__key__").filter('__key__ <=', db.Key(forward)).fetch(PAGINGLIMIT+1)
-        elif back:
-            activities = PhotoActivity.all().order("__key__").filter('__key__ >=', db.Key(back)).fetch(PAGINGLIMIT+1)
-            activities.reverse()
-        elif newest:
-            activities = PhotoActivity.all().order("-__key__").fetch(PAGINGLIMIT+1)
-        elif oldest:
-            activities = PhotoActivity.all().order("__key__").fetch(PAGINGLIMIT) # not seeking extras, we know this is the end  
-            activities.reverse()
-        else:
-            activities = PhotoActivity.all().order("-__key__").fetch(PAGINGLIMIT+1)
-            
-        # we need to get the key of the very last item in the results set, if that is in our 
-        # set that we are showing, then we don't display a previous link
-        next = None
-        previous = None 
-        query = PhotoActivity.all()
-        query.order("-__key__") #chronological reverse order
-        first_activity_key = query.fetch(1)[0].key()
-
-        previous = activities[0].key()
-        if previous == first_activity_key: previous = None 
-
-        # if we skip to the end, and there are not modulo page number results, when we iterate backwards
-        # we will end up with a situation in which we get less that the page set, yet we will be at the start, so
-        # we need another check here.
-        next = activities[0].key()
-        if len(activities) == PAGINGLIMIT+1 or next == first_activity_key:
-            next = activities[-1].key()
-            activities = activities[:PAGINGLIMIT]
+        activity_type = self.request.get("type") or None
+        author = self.request.get("author") or None
+        params = {}
+        if activity_type: params["type"] = activity_type
+        if author: params["author"] = author
+        if activity_type and not author:
+            activity_number = counters.getStat(genActivityTypeStatName(activity_type))
         else:
-            next = None 
-        
-        # do a join over activities and photos!
-        activiies_photolinks = []
-        for activity in activities:
-            photo = getPhoto(activity.photo_id)
-            photopage_url = photo.photopage_url
-            photothumb_url = photo.photothumb_url
-            activiies_photolinks.append((activity, photopage_url, photothumb_url))
-        
-        # find out if current user is an admin
-        admin = None 
-        if users.get_current_user():
-            user = users.get_current_user()
-            nickname = user.nickname()
-            if users.is_current_user_admin():
-                admin = nickname
-        
-        activity_number = PhotoActivity.all().count()
-        template_values = {'count':activity_number, 'activities':activiies_photolinks, 'next':next, 'previous':previous, 'admin':admin}
-        path = os.path.join(os.path.dirname(__file__), 'ListActivities.html')
-        self.response.out.write(template.render(path, template_values))
-
+            activity_number = counters.getStat(STAT_ACTIVITIES)
+        cache_key = None
+        if not params and not self.request.get('cursor') and not self.request.get('dir'):
+            # the first page of all activities is the most visited
+            cache_key = "first"
+        renderActivityListing(self, genActivityQuery(activity_type, author), params, activity_number, 'ListActivities.html', cache_key)
 
 class ListUnvoted(webapp.RequestHandler):
     "activities that have no votes yet"
     def get(self):
-        query = PhotoActivity.all()
-        query.filter("vote_count =", 0)
-        query.order("-__key__") #chronological reverse order
-        activities = query.fetch(PAGINGLIMIT+1)
-        
-        # some code for paging
-        # taken from http://code.google.com/appengine/articles/paging.html
-        forward = self.request.get("next")
-        back = self.request.get("previous")
-        newest = self.request.get("newest") 
-        oldest = self.request.get("oldest")  
-
-        if forward:
-            activities = PhotoActivity.all().order("-__key__").filter("vote_count =", 0).filter('__key__ <=', db.Key(forward)).fetch(PAGINGLIMIT+1)
-        elif back:
-            activities = PhotoActivity.all().order("__key__").filter("vote_count =", 0).filter('__key__ >=', db.Key(back)).fetch(PAGINGLIMIT+1)
-            activities.reverse()
-        elif newest:
-            activities = PhotoActivity.all().order("-__key__").filter("vote_count =", 0).fetch(PAGINGLIMIT+1)
-        elif oldest:
-            activities = PhotoActivity.all().order("__key__").filter("vote_count =", 0).fetch(PAGINGLIMIT) # not seeking extras, we know this is the end  
-            activities.reverse()
-        else:
-            activities = PhotoActivity.all().order("-__key__").filter("vote_count =", 0).fetch(PAGINGLIMIT+1)
-            
-        # we need to get the key of the very last item in the results set, if that is in our 
-        # set that we are showing, then we don't display a previous link
-        next = None
-        previous = None 
-        query = PhotoActivity.all()
-        query.order("-__key__") #chronological reverse order
-        query.filter("vote_count =", 0)
-        first_activity_key = query.fetch(1)[0].key()
-
-        previous = activities[0].key()
-        if previous == first_activity_key: previous = None 
-
-        # if we skip to the end, and there are not modulo page number results, when we iterate backwards
-        # we will end up with a situation in which we get less that the page set, yet we will be at the start, so
-        # we need another check here.
-        next = activities[0].key()
-        if len(activities) == PAGINGLIMIT+1 or next == first_activity_key:
-            next = activities[-1].key()
-            activities = activities[:PAGINGLIMIT]
-        else:
-            next = None 
-        
-        # do a join over activities and photos!
-        activiies_photolinks = []
-        for activity in activities:
-            photo = getPhoto(activity.photo_id)
-            photopage_url = photo.photopage_url
-            photothumb_url = photo.photothumb_url
-            activiies_photolinks.append((activity, photopage_url, photothumb_url))
-        
-        # find out if current user is an admin
-        admin = None 
-        if users.get_current_user():
-            user = users.get_current_user()
-            nickname = user.nickname()
-            if users.is_current_user_admin():
-                admin = nickname
-        
-        activity_number = PhotoActivity.all().count()
-        template_values = {'count':activity_number, 'activities':activiies_photolinks, 'next':next, 'previous':previous, 'admin':admin}
-        path = os.path.join(os.path.dirname(__file__), 'ListUnvoted.html')
-        self.response.out.write(template.render(path, template_values))
+        activity_number = counters.getStat(STAT_UNVOTED)
+        renderActivityListing(self, genActivityQuery(unvoted=True), {}, activity_number, 'ListUnvoted.html')
+
+# search
+
+# activities indexed by one task, and by each step of the backfill
+SEARCHINDEXBATCH = 50
+
+def genSearchDocument(activity):
+    "an activity as searchindex.indexDocuments takes it"
+    return (activity.activity_id, activity.activity_content, activity.activity_type, activity.author,
+            calendar.timegm(activity.created.timetuple()))
+
+def queueSearchIndexing(activity_ids):
+    "index new activities' content behind, so ingestion doesn't wait on the posting shards"
+    tasks = []
+    for i in range(0, len(activity_ids), SEARCHINDEXBATCH):
+        tasks.append(taskqueue.Task(url='/search/index/', params={'ids': ','.join(activity_ids[i:i+SEARCHINDEXBATCH])}))
+    addTasks('searchq', tasks)
+
+class SearchActivities(webapp.RequestHandler):
+    "activities whose content has every word of the query, newest first, optionally of one type or by one author"
+    def get(self):
+        query = self.request.get("q")
+        activity_type = self.request.get("type") or None
+        author = self.request.get("author") or None
+        try:
+            start = max(0, int(self.request.get("start") or 0))
+        except ValueError:
+            start = 0
+        params = {"q": query.encode("utf-8")}
+        if activity_type: params["type"] = activity_type
+        if author: params["author"] = author
+        total, ids = searchindex.search(query, activity_type, author, PAGINGLIMIT, start)
+        found = getActivities(ids)
+        activities = [found[i] for i in ids if found.get(i)]
+        def pageUrl(page_start):
+            return '/search/?' + urlencode(dict(params, start=page_start))
+        # the search stops counting once it knows there is another page
+        more = total is None or start + PAGINGLIMIT < total
+        page = paging.Page(activities,
+                           start and pageUrl(0) or None,
+                           start and pageUrl(max(0, start - PAGINGLIMIT)) or None,
+                           more and pageUrl(start + PAGINGLIMIT) or None,
+                           None)
+        template_values = {'count': total, 'more_than': total is None and start + PAGINGLIMIT, 'query': query, 'type': activity_type, 'author': author,
+                           'activities': joinActivityPhotoLinks(fillinActivityVotes(activities)),
+                           'page': page, 'admin': getCurrentAdmin(), 'types': ACTIVITYTYPES}
+        path = os.path.join(os.path.dirname(__file__), 'Search.html')
+        self.response.out.write(instrument.renderTemplate(path, template_values))
 
 # active actors
 
@@ -530,41 +608,28 @@ class ActorVotes(webapp.RequestHandler):
     def get(self, ActorId):
         template_values = {}
         path = os.path.join(os.path.dirname(__file__), 'ActorVotes.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(instrument.renderTemplate(path, template_values))
 
-def getActorItems(ActorIDInput, itemtype):
-    #q = db.GqlQuery("SELECT * FROM PhotoActivity WHERE author = :1",  ActorID)
+def getActorItems(ActorIDInput, itemtype, limit=FETCHLIMIT):
+    "the first page of an actor's items, the rest can be paged through with /listactivities/?author=..&type=.."
     ActorID = ActorIDInput.replace("%40", "@") # dirty filthy hack, the @ gets encoded as it's passed in via url parameter!
-    a = PhotoActivity.all()
-    a.filter("author =", ActorID)
-    a.filter("activity_type =", itemtype)
-    a.order("-created")
-    results = a.fetch(FETCHLIMIT)
-    return results
+    page = paging.fetchPage(genActivityQuery(itemtype, ActorID), "created", limit)
+    return page.items
 
 def getActorPhotos(ActorID):
     actor_photos = getActorItems(ActorID, "photo")  
     return actor_photos
 
-def getActorTags(ActorID):
-    actor_tags = getActorItems(ActorID, "tag")    
-
-    return actor_tags
+def genVoteQuery(recipient):
+    def make_query():
+        v = store.query(Vote)
+        v.filter("recipient =", recipient)
+        return v
+    return make_query
 
-def getActorNotes(ActorID):
-    actor_notes = getActorItems(ActorID, "note")    
-    return actor_notes
-    
-def getActorComments(ActorID):
-    actor_comments = getActorItems(ActorID, "comment")    
-    return actor_comments    
-
-def getActorVotesHistory(ActorID):
-    v  = Vote.all()
-    v.filter("recipient =", ActorID)
-    v.order("-created")
-    vote_history = v.fetch(FETCHLIMIT)
-    return vote_history    
+def getActorVotesHistory(ActorID, limit=FETCHLIMIT):
+    page = paging.fetchPage(genVoteQuery(ActorID), "created", limit)
+    return page.items
     
 class ActorPictures(webapp.RequestHandler):
     def get(self, ActorId):
@@ -572,72 +637,92 @@ class ActorPictures(webapp.RequestHandler):
         ActorIDInput= ActorId.replace("%40", "@")
         template_values = {'actor_photos':actor_photos, 'actor_id':ActorIDInput}
         path = os.path.join(os.path.dirname(__file__), 'ActorPictures.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(instrument.renderTemplate(path, template_values))
+
+def genActorTemplateValues(ActorId):
+    """the values both actor pages are rendered from, all out of the actor's
+    summary. the full lists are paged through with /listactivities/?author=..&type=.."""
+    summary = getActorSummary(ActorId)
+    if not summary:
+        return {'actor_id': ActorId, 'actor': None}
+    recent = readActorSummary(summary)
+    counts = dict((t, getattr(summary, t + "_count")) for t in ACTIVITYTYPES)
+    return {'actor_id': ActorId, 'actor': summary, 'counts': counts,
+            'actor_photos': recent["photo"], 'actor_notes': recent["note"],
+            'actor_comments': recent["comment"], 'actor_tags': recent["tag"],
+            'votes': recent["votes"]}
 
 class ActorActivity(webapp.RequestHandler):
-    def get(self, uid):
-
-        actor_photos = getActorPhotos(ActorId)
-        actor_notes = getActorNotes(uid)
-        actor_comments = getActorComments(uid)
-        actor_tags = getActorTags(uid)
-        vote_history = getActorVotesHistory(uid)\
-        
-        # get the photo objects, rather than just their ids, so we can display links to the images
-        photos = []
-        for actor_photo in actor_photos:
-            photo_id = actor_photo.photo_id
-            photos.append(getPhoto(photo_id))
-        
-        template_values = {'actor_notes':actor_notes, 'actor_comments':actor_comments, 'actor_tags':actor_tags, 'actor_id': uid, 'actor_photos':photos, 'votes':vote_history}
+    def get(self, ActorIdInput):
+        ActorId = ActorIdInput.replace("%40", "@")
         path = os.path.join(os.path.dirname(__file__), 'ActorActivity.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(instrument.renderTemplate(path, genActorTemplateValues(ActorId)))
         
 class ActorReport(webapp.RequestHandler):
     def get(self, ActorIdInput):
 
 
         ActorId = ActorIdInput.replace("%40", "@")
-    
-        actor_photos = getActorPhotos(ActorId)
-        actor_notes = getActorNotes(ActorId)
-        actor_comments = getActorComments(ActorId)
-        actor_tags = getActorTags(ActorId)
-        vote_history = getActorVotesHistory(ActorId)
-        
-        actor = getUniqueContributor(ActorId)
-        
-        # get the photo objects, rather than just their ids, so we can display links to the images
-        photos = []
-        for actor_photo in actor_photos:
-            photo_id = actor_photo.photo_id
-            photos.append(getPhoto(photo_id))
-        
-        template_values = {'actor_notes':actor_notes, 'actor_comments':actor_comments, 'actor_tags':actor_tags, 'actor_id': ActorId, 'actor_photos':photos, 'votes':vote_history, 'actor': actor}
-    
+        html = cache.readThrough("actorreport", ActorId, [CACHE_ACTIVITY, CACHE_VOTES, CACHE_PHOTOS], lambda: self.render(ActorId))
+        self.response.out.write(html)
+
+    def render(self, ActorId):
+        # the report shows the most recent of each, with links to page through the rest
         path = os.path.join(os.path.dirname(__file__), 'ActorReport.html')
-        self.response.out.write(template.render(path, template_values))
+        return instrument.renderTemplate(path, genActorTemplateValues(ActorId))
         
 def locallyStoredActors():
-    query = UniqueContributors.all()
+    query = store.query(UniqueContributors)
     query.order("-last_activity_date") 
     actors = query.fetch(FETCHLIMIT)
     return actors
 
 def locallyStoredActorsVoteRanked():
-    query = UniqueContributors.all()
+    query = store.query(UniqueContributors)
     query.order("-vote_sum") 
     actors = query.fetch(FETCHLIMIT)
     return actors
         
 class ShowActors(webapp.RequestHandler):
     def get(self):
-        actors = locallyStoredActors()
+        html = cache.readThrough("showactors", "", [CACHE_ACTIVITY, CACHE_VOTES], self.render)
+        self.response.out.write(html)
+
+    def render(self):
+        actors = fillinContributorVotes(locallyStoredActors())
         template_values = {"actors":actors}
         path = os.path.join(os.path.dirname(__file__), 'ShowActors.html')
-        self.response.out.write(template.render(path, template_values))
+        return instrument.renderTemplate(path, template_values)
 
 # votes
+
+# the vote_sum and vote_count on activities and contributors are a copy of their
+# sharded tallies in counters.py, kept for ordering and for finding unvoted
+# activities. the tallies themselves are the real totals.
+
+def genActivityCounterName(activity_id):
+    return "activity/" + activity_id
+
+def genContributorCounterName(author):
+    return "contributor/" + author
+
+def startShardedVotes(entity, counter_name):
+    "carry the votes an entity had before its tally was sharded over to the counter"
+    if not entity.votes_sharded:
+        counters.seed(counter_name, entity.vote_count, entity.vote_sum)
+        entity.votes_sharded = True
+        store.put([entity])
+
+def queueVoteFold(kind, id):
+    "copy the tally back onto the entity shortly, one task per entity per VOTEFOLDSECONDS"
+    bucket = int(clock.time() // VOTEFOLDSECONDS)
+    # ids like 12345@N00 can't go in a task name as they are
+    name = "fold-%s-%s-%d" % (kind, hashlib.md5(id.encode("utf-8")).hexdigest(), bucket)
+    try:
+        taskqueue.Queue(name='votesq').add(taskqueue.Task(url='/votes/fold/', params={'kind': kind, 'id': id}, name=name, countdown=VOTEFOLDSECONDS))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
 def set_activity_votes(target):
     "when an activity gets voted on set a flag, so we can easily find activities with no votes"
     def wrapper(*args, **kwargs):
@@ -645,9 +730,15 @@ def set_activity_votes(target):
         vote_value = args[2]
         activity = getActivity(activity_id)
         if activity:
-            activity.vote_count = activity.vote_count + 1
-            activity.vote_sum = activity.vote_sum + vote_value
-            activity.put()
+            counter_name = genActivityCounterName(activity_id)
+            startShardedVotes(activity, counter_name)
+            first_vote = counters.claimFirstVote(counter_name, ACTIVITYVOTESHARDS)
+            counters.increment(counter_name, vote_value, ACTIVITYVOTESHARDS)
+            stats = {STAT_VOTES: 1}
+            if first_vote:
+                stats[STAT_UNVOTED] = -1
+            counters.incrementStats(stats)
+            queueVoteFold('activity', activity_id)
             return target(*args, **kwargs)
     return wrapper
 
@@ -656,20 +747,75 @@ def set_contributor_votes(target):
     def wrapper(*args, **kwargs):
         actor = args[0]
         vote_value = args[2]
-        actor = getUniqueContributor(actor)
-        if actor:
-            actor.vote_count = actor.vote_count + 1
-            actor.vote_sum = actor.vote_sum + vote_value
-            actor.put()
+        contributor = getUniqueContributor(actor)
+        if contributor:
+            counter_name = genContributorCounterName(actor)
+            startShardedVotes(contributor, counter_name)
+            counters.increment(counter_name, vote_value, CONTRIBUTORVOTESHARDS)
+            queueVoteFold('contributor', actor)
             return target(*args, **kwargs)
     return wrapper
 
 def get_activity_votes(activityid):
-    activity = getActivity(activityid)
-    vote_count = activity.vote_count 
-    vote_sum = activity.vote_sum
+    vote_count, vote_sum = counters.getTotals(genActivityCounterName(activityid), ACTIVITYVOTESHARDS)
     return vote_count, vote_sum   
 
+def get_contributor_votes(author):
+    vote_count, vote_sum = counters.getTotals(genContributorCounterName(author), CONTRIBUTORVOTESHARDS)
+    return vote_count, vote_sum   
+
+def fillinActivityVotes(activities):
+    "replace the copied tallies on a list of activities with the live sharded ones"
+    names = [genActivityCounterName(a.activity_id) for a in activities if a.votes_sharded]
+    totals = counters.getTotalsMulti(names, ACTIVITYVOTESHARDS)
+    for a in activities:
+        if a.votes_sharded:
+            a.vote_count, a.vote_sum = totals[genActivityCounterName(a.activity_id)]
+    return activities
+
+def fillinContributorVotes(contributors):
+    "replace the copied tallies on a list of contributors with the live sharded ones"
+    names = [genContributorCounterName(c.author) for c in contributors if c.votes_sharded]
+    totals = counters.getTotalsMulti(names, CONTRIBUTORVOTESHARDS)
+    for c in contributors:
+        if c.votes_sharded:
+            c.vote_count, c.vote_sum = totals[genContributorCounterName(c.author)]
+    return contributors
+
+def foldActorSummaryVotes(author, vote_count, vote_sum, votes):
+    "copy vote totals and recent votes onto a summary, run in a transaction"
+    summary = getActorSummaries([author]).get(author)
+    if summary:
+        summary.vote_count = vote_count
+        summary.vote_sum = vote_sum
+        recent = simplejson.loads(summary.recent)
+        recent["votes"] = votes
+        summary.recent = simplejson.dumps(recent)
+        store.put([summary])
+
+class FoldVoteTotals(webapp.RequestHandler):
+    "copy a sharded vote tally back onto its activity or contributor"
+    def post(self):
+        kind = self.request.get('kind')
+        id = self.request.get('id')
+        if kind == 'activity':
+            entity = getActivity(id)
+            vote_count, vote_sum = get_activity_votes(id)
+        else:
+            entity = getUniqueContributor(id)
+            vote_count, vote_sum = get_contributor_votes(id)
+        if entity:
+            entity.vote_count = vote_count
+            entity.vote_sum = vote_sum
+            entity.votes_sharded = True
+            store.put([entity])
+            if kind == 'contributor':
+                # the summary keeps the same totals, and the votes that made them
+                votes = [summaryVoteItem(v) for v in getActorVotesHistory(id, ACTORRECENT)]
+                store.runInTransaction(foldActorSummaryVotes, id, vote_count, vote_sum, votes)
+            # the order of the league table may have changed
+            cache.bump(CACHE_VOTES)
+
 @set_contributor_votes
 @set_activity_votes
 def createVote(actor, activityid, vote_value):
@@ -679,7 +825,14 @@ def createVote(actor, activityid, vote_value):
     v.activity_id = activityid
     v.recipient = actor
     v.voter = user.nickname()
-    v.put()
+    store.put([v])
+    # the leaderboards are updated behind, as they are for batches of votes
+    activity = getActivity(activityid)
+    deltas = {'token': str(store.idOrName(v)), 'time': clock.time(),
+              'activities': [], 'contributors': [],
+              'leaderboard': [[actor, activity.activity_type, 1, vote_value]]}
+    taskqueue.Queue(name='votesq').add(taskqueue.Task(url='/votes/apply/', params={'deltas': simplejson.dumps(deltas)}))
+    cache.bump(CACHE_VOTES)
     return None
 
 class VoteUp(webapp.RequestHandler):
@@ -693,7 +846,7 @@ class VoteUp(webapp.RequestHandler):
         #
         template_values = {"actor":actor, "activity":activityid}
         path = os.path.join(os.path.dirname(__file__), 'voteup.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(instrument.renderTemplate(path, template_values))
 
 class VoteDown(webapp.RequestHandler):
     "using post as we intend to update the vote records"
@@ -706,7 +859,7 @@ class VoteDown(webapp.RequestHandler):
         #
         template_values = {"actor":actor, "activity":activityid}
         path = os.path.join(os.path.dirname(__file__), 'votedown.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(instrument.renderTemplate(path, template_values))
 
 class RpcVoteUp(webapp.RequestHandler):
     "using post as we intend to update the vote records"
@@ -736,57 +889,174 @@ class RpcVoteDown(webapp.RequestHandler):
         response = {'message':message, 'sum': vote_sum, 'count': vote_count}
         self.response.out.write(simplejson.dumps(response))
         
-class LeagueTable(webapp.RequestHandler):
-    def get(self):
-        actors = locallyStoredActorsVoteRanked()
-        template_values = {"actors":actors}
-        path = os.path.join(os.path.dirname(__file__), 'LeagueTable.html')
-        self.response.out.write(template.render(path, template_values))
+def createVotes(votes, voter):
+    """store a batch of (actor, activityid, vote_value) votes in one put, and
+    queue the tally changes to be applied together by ApplyVoteDeltas. votes on
+    activities or contributors we don't know about are dropped, as in createVote.
+    returns a dict of activityid -> (vote_count, vote_sum) including this batch"""
+    activities = getActivities([activityid for actor, activityid, vote_value in votes])
+    contributors = getUniqueContributors([actor for actor, activityid, vote_value in votes])
+    vote_records = []
+    activity_deltas = {}
+    contributor_deltas = {}
+    leaderboard_deltas = {}
+    for actor, activityid, vote_value in votes:
+        if not activities.get(activityid) or not contributors.get(actor):
+            continue
+        v = Vote()
+        v.value = v.value + vote_value
+        v.activity_id = activityid
+        v.recipient = actor
+        v.voter = voter
+        vote_records.append(v)
+        vote_count, vote_sum = activity_deltas.get(activityid, (0, 0))
+        activity_deltas[activityid] = (vote_count + 1, vote_sum + vote_value)
+        vote_count, vote_sum = contributor_deltas.get(actor, (0, 0))
+        contributor_deltas[actor] = (vote_count + 1, vote_sum + vote_value)
+        board_key = (actor, activities[activityid].activity_type)
+        vote_count, vote_sum = leaderboard_deltas.get(board_key, (0, 0))
+        leaderboard_deltas[board_key] = (vote_count + 1, vote_sum + vote_value)
+    if not vote_records:
+        return {}
+    for activityid in activity_deltas:
+        startShardedVotes(activities[activityid], genActivityCounterName(activityid))
+    for actor in contributor_deltas:
+        startShardedVotes(contributors[actor], genContributorCounterName(actor))
+    store.put(vote_records)
+    # the vote keys make a token that is unique to this batch, so the deltas are
+    # only applied once however many times the task runs
+    token = str(store.idOrName(vote_records[0]))
+    deltas = {'token': token, 'time': clock.time(),
+              'activities': [[a, c, s] for a, (c, s) in activity_deltas.items()],
+              'contributors': [[a, c, s] for a, (c, s) in contributor_deltas.items()],
+              'leaderboard': [[a, t, c, s] for (a, t), (c, s) in leaderboard_deltas.items()]}
+    taskqueue.Queue(name='votesq').add(taskqueue.Task(url='/votes/apply/', params={'deltas': simplejson.dumps(deltas)}))
+    # the deltas haven't been applied yet, so add them to the current tallies
+    totals = counters.getTotalsMulti([genActivityCounterName(a) for a in activity_deltas], ACTIVITYVOTESHARDS)
+    results = {}
+    first_votes = 0
+    for activityid, (vote_count, vote_sum) in activity_deltas.items():
+        stored_count, stored_sum = totals[genActivityCounterName(activityid)]
+        if counters.claimFirstVote(genActivityCounterName(activityid), ACTIVITYVOTESHARDS):
+            first_votes = first_votes + 1
+        results[activityid] = (stored_count + vote_count, stored_sum + vote_sum)
+    counters.incrementStats({STAT_VOTES: len(vote_records), STAT_UNVOTED: -first_votes})
+    cache.bump(CACHE_VOTES)
+    return results
 
+class ApplyVoteDeltas(webapp.RequestHandler):
+    "write behind for RpcVoteBatch, one counter increment per activity and per contributor in the batch"
+    def post(self):
+        deltas = simplejson.loads(self.request.get('deltas'))
+        token = deltas['token']
+        for activityid, vote_count, vote_sum in deltas['activities']:
+            counters.increment(genActivityCounterName(activityid), vote_sum, ACTIVITYVOTESHARDS, vote_count, token)
+            queueVoteFold('activity', activityid)
+        for actor, vote_count, vote_sum in deltas['contributors']:
+            counters.increment(genContributorCounterName(actor), vote_sum, CONTRIBUTORVOTESHARDS, vote_count, token)
+            queueVoteFold('contributor', actor)
+        if deltas.get('leaderboard'):
+            leaderboards.applyVotes(deltas['leaderboard'], token, datetime.fromtimestamp(deltas['time']), getFoldedContributorVotes)
+        cache.bump(CACHE_VOTES)
+
+class RpcVoteBatch(webapp.RequestHandler):
+    """takes a json list of {"actor": .., "activityid": .., "value": 1 or -1}
+    votes in the body of one post, and returns the new totals for every
+    activity voted on"""
+    def post(self):
+        try:
+            posted = simplejson.loads(self.request.body)
+            votes = []
+            for vote in posted:
+                vote_value = int(vote['value'])
+                if vote_value not in (1, -1):
+                    raise ValueError("a vote is 1 or -1, not %d" % vote_value)
+                votes.append((vote['actor'], vote['activityid'], vote_value))
+        except (ValueError, KeyError, TypeError):
+            self.error(400)
+            return
+        user = users.get_current_user()
+        totals = createVotes(votes, user.nickname())
+        message = "yay! you voted"
+        response = {'message':message,
+                    'votes': [{'activityid': a, 'sum': s, 'count': c} for a, (c, s) in totals.items()]}
+        self.response.out.write(simplejson.dumps(response))
 
-# queuing
+class LeaderboardEntry(object):
+    "one row of a league table"
+    def __init__(self, rank, author, vote_sum, vote_count, contributor):
+        self.rank = rank
+        self.author = author
+        self.vote_sum = vote_sum
+        self.vote_count = vote_count
+        self.last_activity_id = contributor and contributor.last_activity_id
+        self.last_activity_date = contributor and contributor.last_activity_date
 
-class LoadQueues(webapp.RequestHandler):
+class LeagueTable(webapp.RequestHandler):
+    "the top contributors of all time, this week or this month, overall or for one type of activity"
     def get(self):
-        # Add the task to the default queue.
-        photosq = taskqueue.Queue(name='photosq')
-        phototask = taskqueue.Task(url='/getphotos/', method='GET')
-        photosq.add(phototask)
-        
-        #monitor = TaskMonitor()
-        #monitor.queue = "placed new photo check"
-        #monitor.put()
-
-        query = Photo.all()
-        query.order("-last_modified") 
-        photos = query.fetch(FETCHLIMIT)
-        activityq = taskqueue.Queue(name='activityq') 
-        for photo in photos:        
-            worker_url = "/photo/getactivity/" + photo.uid
-            activitytask = taskqueue.Task(url=worker_url, method='GET')  
-            activityq.add(activitytask)          
-
-        #monitor = TaskMonitor()
-        #monitor.queue = "placed photo activites check"
-        #monitor.put()
-        
-        return True
-        # ok let's see what happens with the queuing!
-        # self.redirect('/')
-        
+        period = self.request.get("period")
+        if period not in leaderboards.PERIODS:
+            period = leaderboards.ALLTIME
+        activity_type = self.request.get("type")
+        if activity_type not in ACTIVITYTYPES:
+            activity_type = leaderboards.ALLTYPES
+        board = leaderboards.genBoardName(period, activity_type, datetime.now())
+        html = cache.readThrough("leaguetable", board, [CACHE_ACTIVITY, CACHE_VOTES], lambda: self.render(board, period, activity_type))
+        self.response.out.write(html)
+
+    def render(self, board, period, activity_type):
+        entries = leaderboards.getBoard(board)
+        contributors = getUniqueContributors([author for author, vote_sum, vote_count in entries])
+        actors = [LeaderboardEntry(i + 1, author, vote_sum, vote_count, contributors.get(author))
+                  for i, (author, vote_sum, vote_count) in enumerate(entries)]
+        template_values = {"actors": actors, "period": period, "type": activity_type,
+                           "periods": leaderboards.PERIODS, "types": [leaderboards.ALLTYPES] + ACTIVITYTYPES}
+        path = os.path.join(os.path.dirname(__file__), 'LeagueTable.html')
+        return instrument.renderTemplate(path, template_values)
+
+def getFoldedContributorVotes(author):
+    """the tally last folded onto a contributor. the fold runs VOTEFOLDSECONDS
+    after a vote, by when its leaderboard deltas have normally been applied,
+    so unlike the live counters this doesn't include votes whose deltas are
+    still queued, and a score started from it won't count them twice"""
+    contributor = getUniqueContributor(author)
+    if not contributor:
+        return 0, 0
+    return contributor.vote_count, contributor.vote_sum
+
+class SeedLeaderboard(webapp.RequestHandler):
+    """start the all time board off from the contributors' folded tallies, for
+    votes cast before there were boards, SEEDBATCH contributors at a time, each
+    step queueing the next from its cursor. safe to run again, contributors
+    already on the board keep their scores"""
+    def get(self):
+        query = store.query(UniqueContributors)
+        cursor = self.request.get("cursor")
+        if cursor:
+            query.with_cursor(cursor)
+        actors = query.fetch(SEEDBATCH)
+        scores = dict((actor.author, (actor.vote_count, actor.vote_sum)) for actor in actors if actor.vote_count)
+        leaderboards.seedScores(leaderboards.genBoardName(leaderboards.ALLTIME, leaderboards.ALLTYPES, datetime.now()), scores)
+        if len(actors) == SEEDBATCH:
+            task = taskqueue.Task(url='/votes/seedleaderboard/', params={'cursor': query.cursor()}, method='GET')
+            taskqueue.Queue(name='votesq').add(task)
+        cache.bump(CACHE_VOTES)
+        self.response.out.write("seeded %d contributors" % len(scores))
+
 # simple pages:s
 
 class Advanced(webapp.RequestHandler):
     def get(self):
         template_values = {}
         path = os.path.join(os.path.dirname(__file__), 'advanced.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(instrument.renderTemplate(path, template_values))
 
 class Instructions(webapp.RequestHandler):
     def get(self):
         template_values = {}
         path = os.path.join(os.path.dirname(__file__), 'Instructions.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(instrument.renderTemplate(path, template_values))
 
 # main page
 
@@ -820,33 +1090,19 @@ class MainHandler(webapp.RequestHandler):
             }
 
         path = os.path.join(os.path.dirname(__file__), 'index.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(instrument.renderTemplate(path, template_values))
+
+def makeApplication():
+    """every route of the app in one application, as it was served before it
+    was split into entry points. the benchmarks run against this"""
+    import browse
+    import votes
+    import ingest
+    return instrument.instrument(webapp.WSGIApplication(browse.ROUTES + votes.ROUTES + ingest.ROUTES, debug=True))
 
 def main():
-    application = webapp.WSGIApplication([('/', MainHandler),
-                                          ('/enginestart', LoadQueues),
-                                          ('/photo/getactivity/(.*)', GetNewPhotoActivity),
-                                          ('/photo/showactivity/(.*)', ShowStoredPhotoActivity),   
-                                          ('/actor/votesreceived/(.*)', ActorVotes),
-                                          ('/actor/pictures/(.*)', ActorPictures),   
-                                          ('/actor/activity/(.*)', ActorActivity),   
-                                          ('/actor/report/(.*)', ActorReport),   
-                                          ('/showactors/', ShowActors),   
-                                          ('/increment', VoteUp),                                             
-                                          ('/decrement', VoteDown),
-                                          ('/rpcincrement', RpcVoteUp),                                             
-                                          ('/rpcdecrement', RpcVoteDown),
-                                          ('/leaguetable/', LeagueTable),                                              
-                                          ('/getupdates/', UpdateAllPhotoActivity),   
-                                          ('/getphotos/', GetPhotos),
-                                          ('/listactivities/', ListActivities),
-                                          ('/listunvoted/', ListUnvoted),
-                                          ('/advanced/', Advanced),
-                                          ('/instructions/', Instructions),
-                                          ('/listphotos/', ListPhotos)], debug=True)
-                                          
-    util.run_wsgi_app(application)
+    # app.yaml no longer routes here, but a request that does arrive is served
+    util.run_wsgi_app(makeApplication())
 
 if __name__ == '__main__':
     main()
-    
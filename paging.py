@@ -0,0 +1,87 @@
+"""cursor based paging for listings.
+
+a page is one fetch of a query ordered newest first (or oldest first, when
+paging back from the oldest end), started from a datastore cursor. cursors
+only run one way, so to offer a link back to the previous page we remember,
+in memcache, which cursor each page's successor was reached from. if that has
+been evicted the listing still offers a link to the newest page.
+"""
+import hashlib
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+from google.appengine.api import memcache
+
+FORWARD = 'forward' # newest first
+BACKWARD = 'backward' # oldest first, used when paging from the oldest end
+
+# how long a page remembers how it was reached
+TRAILSECONDS = 60*60
+
+class Page(object):
+    "one page of a listing, with links to its neighbours, or None where there isn't one"
+    def __init__(self, items, newest_url, newer_url, older_url, oldest_url):
+        self.items = items
+        self.newest_url = newest_url
+        self.newer_url = newer_url
+        self.older_url = older_url
+        self.oldest_url = oldest_url
+
+def _trailKey(cursor):
+    return 'pagetrail/' + hashlib.md5(cursor).hexdigest()
+
+def _url(direction, cursor, params):
+    params = dict(params)
+    if direction == BACKWARD:
+        params['dir'] = BACKWARD
+    if cursor:
+        params['cursor'] = cursor
+    return '?' + urlencode(params)
+
+def fetchPage(make_query, order_property, limit, cursor=None, direction=FORWARD, params={}):
+    """fetch one page of the query made by make_query, ordered on order_property.
+    cursor and direction come from the links on the previous page, params are
+    any other request parameters the links should carry, such as filters"""
+    query = make_query()
+    if direction == BACKWARD:
+        query.order(order_property)
+    else:
+        query.order('-' + order_property)
+    if cursor:
+        query.with_cursor(cursor)
+    # one more than a page, so a page that is exactly the last of the listing
+    # doesn't link on to an empty one. the cursor is taken after the page's
+    # last item, before the extra one is read
+    items = []
+    page_cursor = None
+    next_cursor = None
+    for item in query.run(limit=limit + 1):
+        if len(items) == limit:
+            next_cursor = page_cursor
+            break
+        items.append(item)
+        if len(items) == limit:
+            page_cursor = query.cursor()
+    if next_cursor:
+        # remember where we came from, so the next page can link back here
+        memcache.set(_trailKey(next_cursor), cursor or '', time=TRAILSECONDS)
+    previous_url = None
+    if cursor:
+        previous_cursor = memcache.get(_trailKey(cursor))
+        if previous_cursor is not None:
+            previous_url = _url(direction, previous_cursor, params)
+    if direction == BACKWARD:
+        items.reverse()
+        newer_url = next_cursor and _url(BACKWARD, next_cursor, params)
+        newest_url = next_cursor and _url(FORWARD, None, params)
+        return Page(items, newest_url, newer_url, previous_url, cursor and _url(BACKWARD, None, params))
+    older_url = next_cursor and _url(FORWARD, next_cursor, params)
+    oldest_url = next_cursor and _url(BACKWARD, None, params)
+    return Page(items, cursor and _url(FORWARD, None, params), previous_url, older_url, oldest_url)
+
+def fetchRequestedPage(request, make_query, order_property, limit, params={}):
+    "fetch the page asked for by the cursor and dir parameters of a request"
+    return fetchPage(make_query, order_property, limit, request.get('cursor') or None, request.get('dir') or FORWARD, params)
@@ -0,0 +1,231 @@
+"""full text search over activity content.
+
+the words of each activity's content are kept in an inverted index: for every
+term there are POSTINGSHARDS posting shards, each a list of the activities
+containing the term. a batch of activities adds each of its terms to one shard
+picked from the batch, so batches being indexed at the same time mostly write
+to different shards of a hot term rather than queueing on one entity.
+
+each posting carries the activity's type, author and creation time, so type
+and author filters need no activities loaded. when a shard fills up its
+postings move to an overflow page and it starts again, and the shard notes the
+creation time of the newest posting on the page.
+
+a query reads its terms' shards with one batched get, which says roughly how
+many postings each term has. it then reads the rarest term's overflow pages
+newest first, and only as much of the other terms as it takes to check the
+rarest term's postings against them. it stops once it has the page of
+results asked for, so a query on common words reads the recent pages of
+their postings rather than all of them.
+"""
+import re
+import zlib
+
+from google.appengine.ext import db
+
+POSTINGSHARDS = 8
+# postings a shard holds before they move to an overflow page. a posting is
+# about 75 bytes, so a full shard is about 150KB, well under the 1MB entity limit
+SHARDPOSTINGS = 2000
+# terms longer than this are cut short, so they fit in a key name
+TERMLENGTH = 40
+# a query uses at most this many terms
+QUERYTERMS = 8
+
+STOPWORDS = set("""a an and are as at be but by for from has have i in is it its
+me my of on or so that the this to was we were will with you your""".split())
+
+_markup = re.compile(r'<[^>]*>|&\w+;')
+_words = re.compile(r'\w+', re.UNICODE)
+
+class PostingShard(db.Model):
+    """one shard of a term's posting list, keyed by term and shard number.
+    overflow pages are its children, keyed by page number, and page_newest has
+    the creation time of the newest posting on each. postings holds one line
+    per activity: id, type, author and creation time, space separated"""
+    term = db.StringProperty(required=True)
+    postings = db.TextProperty(default='')
+    count = db.IntegerProperty(default=0)
+    pages = db.IntegerProperty(default=0)
+    page_newest = db.ListProperty(int)
+
+def tokenize(text):
+    "the distinct terms of some text, in the order they first appear"
+    if not text:
+        return []
+    text = _markup.sub(' ', text).lower()
+    terms = []
+    for word in _words.findall(text):
+        word = word[:TERMLENGTH]
+        if len(word) < 2 or word in STOPWORDS or word in terms:
+            continue
+        terms.append(word)
+    return terms
+
+def _shardKeyName(term, shard):
+    return '%s/%d' % (term, shard)
+
+def _pageKeyName(page):
+    return 'page%d' % page
+
+def _posting(doc_id, doc_type, author, created):
+    return '%s %s %s %d' % (doc_id, doc_type or '-', author or '-', created)
+
+def _parsePosting(line):
+    "returns doc_id, (doc_type, author, created)"
+    doc_id, doc_type, rest = line.split(' ', 2)
+    author, created = rest.rsplit(' ', 1)
+    return doc_id, (doc_type, author, int(created))
+
+def _appendPostings(term, shard, postings):
+    "add postings to one shard, skipping any it already has from an earlier run of the batch"
+    key_name = _shardKeyName(term, shard)
+    def txn():
+        entity = PostingShard.get_by_key_name(key_name)
+        if entity is None:
+            entity = PostingShard(key_name=key_name, term=term)
+        lines = entity.postings and entity.postings.split('\n') or []
+        present = set(line.split(' ', 1)[0] for line in lines)
+        new = [posting for posting in postings if posting.split(' ', 1)[0] not in present]
+        if not new:
+            return
+        if lines and len(lines) + len(new) > SHARDPOSTINGS:
+            page = PostingShard(parent=entity, key_name=_pageKeyName(entity.pages), term=term,
+                                postings=entity.postings, count=len(lines))
+            page.put()
+            newest = max([_parsePosting(line)[1][2] for line in lines])
+            # pages made before their times were kept can't be older than this one
+            missing = entity.pages - len(entity.page_newest)
+            entity.page_newest = entity.page_newest + [newest] * missing + [newest]
+            entity.pages = entity.pages + 1
+            lines = []
+        lines.extend(new)
+        entity.postings = '\n'.join(lines)
+        entity.count = len(lines)
+        entity.put()
+    db.run_in_transaction(txn)
+
+def indexDocuments(docs):
+    """add documents to the index, docs is a list of
+    (doc_id, text, doc_type, author, created) with created in seconds since the
+    epoch. indexing the same batch again is harmless"""
+    if not docs:
+        return 0
+    batch = ','.join(sorted([doc[0] for doc in docs]))
+    by_term = {}
+    for doc_id, text, doc_type, author, created in docs:
+        for term in tokenize(text):
+            by_term.setdefault(term, []).append(_posting(doc_id, doc_type, author, created))
+    for term, postings in by_term.items():
+        # the same batch always picks the same shard, so a retry finds its postings already there
+        shard = (zlib.crc32((term + '/' + batch).encode('utf-8')) & 0xffffffff) % POSTINGSHARDS
+        _appendPostings(term, shard, postings)
+    return len(by_term)
+
+class _TermReader(object):
+    "the postings of one term read so far, and the overflow pages still to read"
+    def __init__(self, term, shards):
+        self.term = term
+        self.postings = {}
+        self.unread = []
+        for entity in shards:
+            self.add(entity)
+            for page in range(entity.pages):
+                if page < len(entity.page_newest):
+                    newest = entity.page_newest[page]
+                else:
+                    # no time kept, so it has to be read before anything is certain
+                    newest = float('inf')
+                key = db.Key.from_path('PostingShard', _pageKeyName(page), parent=entity.key())
+                self.unread.append((newest, key))
+        self.unread.sort(key=lambda page: page[0], reverse=True)
+
+    def add(self, entity):
+        for line in entity.postings.split('\n'):
+            if line:
+                doc_id, posting = _parsePosting(line)
+                self.postings[doc_id] = posting
+
+    def size(self):
+        "about how many postings the term has"
+        return len(self.postings) + len(self.unread) * SHARDPOSTINGS
+
+    def bound(self):
+        "every posting created after this has been read"
+        if not self.unread:
+            return -1
+        return self.unread[0][0]
+
+    def newestPages(self):
+        "the next POSTINGSHARDS pages, newest first"
+        keys = [key for newest, key in self.unread[:POSTINGSHARDS]]
+        self.unread = self.unread[POSTINGSHARDS:]
+        return keys
+
+    def pagesSince(self, created):
+        "the pages that may hold postings created at or after created"
+        keys = [key for newest, key in self.unread if newest >= created]
+        self.unread = [page for page in self.unread if page[0] < created]
+        return keys
+
+def _readPages(readers, keys):
+    if not keys:
+        return
+    by_term = dict((reader.term, reader) for reader in readers)
+    for entity in db.get(keys):
+        if entity:
+            by_term[entity.term].add(entity)
+
+def search(query, doc_type=None, author=None, limit=20, offset=0):
+    """the documents containing every term of query, newest first, optionally
+    only those of one type or by one author. returns (total, doc_ids) where
+    doc_ids are the limit documents starting at offset. total is None if the
+    search stopped before counting every match, as there are more than
+    offset + limit"""
+    terms = tokenize(query)[:QUERYTERMS]
+    if not terms:
+        return 0, []
+    keys = [db.Key.from_path('PostingShard', _shardKeyName(term, shard)) for term in terms for shard in range(POSTINGSHARDS)]
+    shards = dict((term, []) for term in terms)
+    for entity in db.get(keys):
+        if entity:
+            shards[entity.term].append(entity)
+    if [term for term in terms if not shards[term]]:
+        return 0, []
+    readers = [_TermReader(term, shards[term]) for term in terms]
+    readers.sort(key=lambda reader: reader.size())
+    rarest = readers[0]
+    others = readers[1:]
+    # one more than is shown, to know whether there are more
+    wanted = offset + limit + 1
+    while True:
+        candidates = [(created, doc_id) for doc_id, (found_type, found_author, created) in rarest.postings.items()
+                      if (not doc_type or found_type == doc_type) and (not author or found_author == author)]
+        candidates.sort(reverse=True)
+        bound = rarest.bound()
+        matches = []
+        needed = None
+        for created, doc_id in candidates:
+            if created <= bound:
+                # a newer posting of the rarest term may still be unread
+                break
+            if [reader for reader in others if reader.bound() >= created]:
+                # the other terms haven't been read back this far
+                needed = created
+                break
+            if [reader for reader in others if doc_id not in reader.postings]:
+                continue
+            matches.append(doc_id)
+            if len(matches) == wanted:
+                break
+        if len(matches) == wanted:
+            return None, matches[offset:offset + limit]
+        if needed is not None:
+            keys = []
+            for reader in others:
+                keys.extend(reader.pagesSince(needed))
+        elif rarest.unread:
+            keys = rarest.newestPages()
+        else:
+            return len(matches), matches[offset:offset + limit]
+        _readPages(readers, keys)
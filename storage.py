@@ -0,0 +1,319 @@
+"""where photos, activities, contributors, actor summaries, votes, mail
+recipients and task monitors are kept.
+
+main.py reaches these kinds through a backend rather than the db api, so the
+same ingestion and vote code can run against the appengine datastore or a
+local sqlite file. both backends take and return instances of the app's
+db.Model classes, so handlers and templates don't know which one is in use.
+
+  get(model, key_names)    list of entities, None where there isn't one
+  put(entities)            store entities, of any mix of kinds
+  query(model)             a query with the parts of the db.Query api the app
+                           uses: filter, order, with_cursor, fetch, run,
+                           cursor and count
+  runInTransaction(function, *args)
+                           call function so that the gets and puts it makes
+                           of one entity group happen together, or not at all
+  idOrName(entity)         the id or key name of a stored entity
+  newEntity(model, values, key_name=None, entity_id=None)
+                           an entity that will be stored under the given key
+                           name or id when it is put, for restoring backups
+  reserveIds(model, ids)   make sure ids restored with newEntity are never
+                           given to new entities
+
+the backend is picked by STORAGEBACKEND in config.py, "datastore" unless set.
+the sqlite backend keeps the rest of the app's appengine services (memcache,
+the task queues, the vote and stat counters) as they are, it only moves these
+kinds, which is where nearly all of the datastore work is.
+"""
+import json
+import sqlite3
+import threading
+
+try:
+    from config import STORAGEBACKEND
+except ImportError:
+    STORAGEBACKEND = "datastore"
+
+try:
+    from config import SQLITEPATH
+except ImportError:
+    SQLITEPATH = "flickr-voter.sqlite"
+
+# the datastore backend
+
+class DatastoreBackend(object):
+    def get(self, model, key_names):
+        if not key_names:
+            return []
+        return model.get_by_key_name(key_names)
+
+    def put(self, entities):
+        from google.appengine.ext import db
+        if entities:
+            db.put(entities)
+
+    def query(self, model):
+        return model.all()
+
+    def runInTransaction(self, function, *args):
+        from google.appengine.ext import db
+        return db.run_in_transaction(function, *args)
+
+    def idOrName(self, entity):
+        return entity.key().id_or_name()
+
+    def newEntity(self, model, values, key_name=None, entity_id=None):
+        from google.appengine.ext import db
+        if key_name:
+            return model(key_name=key_name, **values)
+        return model(key=db.Key.from_path(model.kind(), entity_id), **values)
+
+    def reserveIds(self, model, ids):
+        from google.appengine.ext import db
+        if ids:
+            db.allocate_id_range(db.Key.from_path(model.kind(), 1), min(ids), max(ids))
+
+# the sqlite backend
+
+# indexes for the queries the app makes, the sqlite equivalent of index.yaml.
+# sqlite can read an index either way, so each one covers both directions
+SQLITEINDEXES = [('PhotoActivity', ['activity_type', 'author', 'created']),
+                 ('PhotoActivity', ['author', 'created']),
+                 ('PhotoActivity', ['activity_type', 'created']),
+                 ('PhotoActivity', ['photo_id', 'created']),
+                 ('PhotoActivity', ['vote_count', 'key_name']),
+                 ('PhotoActivity', ['vote_count', 'created']),
+                 ('PhotoActivity', ['created']),
+                 ('UniqueContributors', ['last_activity_date']),
+                 ('UniqueContributors', ['vote_sum']),
+                 ('Photo', ['next_poll']),
+                 ('Vote', ['recipient', 'created']),
+                 ('MailRecipients', ['created'])]
+
+OPERATORS = ['=', '<', '<=', '>', '>=']
+
+def _columnType(prop):
+    from google.appengine.ext import db
+    if isinstance(prop, db.DateTimeProperty):
+        return 'timestamp'
+    if isinstance(prop, (db.IntegerProperty, db.BooleanProperty)):
+        return 'integer'
+    return 'text'
+
+def propertyNames(model):
+    # a property can be bound to more than one class attribute, it is stored under its own name
+    names = []
+    for prop in model.properties().values():
+        if prop.name not in names:
+            names.append(prop.name)
+    return sorted(names)
+
+def _column(name):
+    if name == '__key__':
+        return 'key_name'
+    return name
+
+class SqliteQuery(object):
+    "a query on one kind, ordered on one property and then by row"
+    def __init__(self, backend, model):
+        self.backend = backend
+        self.model = model
+        self.filters = []
+        self.order_property = None
+        self.descending = False
+        self.start = None
+        self.last = None
+
+    def filter(self, property_operator, value):
+        name, operator = property_operator.split()
+        if operator not in OPERATORS:
+            raise ValueError('unsupported filter operator %s' % operator)
+        self.filters.append((_column(name), operator, value))
+        return self
+
+    def order(self, prop):
+        self.descending = prop.startswith('-')
+        self.order_property = _column(prop.lstrip('-'))
+        return self
+
+    def with_cursor(self, cursor):
+        self.start = json.loads(cursor)
+        return self
+
+    def cursor(self):
+        "where the last fetch stopped, or the last row run has given, as a string"
+        if self.last is None:
+            return None
+        return json.dumps(self.last)
+
+    def _sql(self, limit):
+        where = ['%s %s ?' % (column, operator) for column, operator, value in self.filters]
+        args = [value for column, operator, value in self.filters]
+        order = self.order_property or 'rowid'
+        direction = self.descending and 'desc' or 'asc'
+        if self.start is not None:
+            # carry on after the last row of the previous fetch
+            value, rowid = self.start
+            beyond = self.descending and '<' or '>'
+            if self.order_property:
+                where.append('(%s %s ? or (%s = ? and rowid %s ?))' % (order, beyond, order, beyond))
+                args.extend([value, value, rowid])
+            else:
+                where.append('rowid %s ?' % beyond)
+                args.append(rowid)
+        sql = 'select rowid, * from %s' % self.model.kind()
+        if where:
+            sql = sql + ' where ' + ' and '.join(where)
+        sql = sql + ' order by %s %s, rowid %s limit %d' % (order, direction, direction, limit)
+        return sql, args
+
+    def _passed(self, row):
+        "move the cursor past row"
+        value = self.order_property and row[self.order_property]
+        if value is not None and not isinstance(value, (int, float)):
+            # datetimes are stored as text, and compared as text
+            value = str(value)
+        self.last = [value, row['rowid']]
+
+    def fetch(self, limit):
+        sql, args = self._sql(limit)
+        rows = self.backend.execute(sql, args).fetchall()
+        if rows:
+            self._passed(rows[-1])
+        return [self.backend.entityFromRow(self.model, row) for row in rows]
+
+    def run(self, limit=-1):
+        "yield up to limit entities, moving the cursor past each one as it is given"
+        sql, args = self._sql(limit)
+        for row in self.backend.execute(sql, args).fetchall():
+            self._passed(row)
+            yield self.backend.entityFromRow(self.model, row)
+
+    def count(self, limit=None):
+        sql, args = self._sql(limit or -1)
+        return self.backend.execute('select count(*) from (%s)' % sql, args).fetchone()[0]
+
+    def __iter__(self):
+        return iter(self.fetch(-1))
+
+class SqliteBackend(object):
+    """keeps each kind in a table named after it, with a column per property
+    and a unique key name. entities without a key name, such as votes, are
+    numbered by the table's rowid"""
+    def __init__(self, path, models):
+        self.connection = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.RLock()
+        self.models = models
+        for model in models:
+            self.createTable(model)
+
+    def execute(self, sql, args=()):
+        self.lock.acquire()
+        try:
+            return self.connection.execute(sql, args)
+        finally:
+            self.lock.release()
+
+    def createTable(self, model):
+        columns = ['%s %s' % (name, _columnType(model.properties()[name])) for name in propertyNames(model)]
+        self.execute('create table if not exists %s (key_name text unique, %s)' % (model.kind(), ', '.join(columns)))
+        for kind, index_columns in SQLITEINDEXES:
+            if kind == model.kind():
+                name = '%s_%s' % (kind, '_'.join(index_columns))
+                self.execute('create index if not exists %s on %s (%s)' % (name, kind, ', '.join(index_columns)))
+
+    def entityFromRow(self, model, row):
+        values = {}
+        for name in propertyNames(model):
+            value = row[name]
+            if value is not None and model.properties()[name].data_type is bool:
+                value = bool(value)
+            values[name] = value
+        if row['key_name']:
+            entity = model(key_name=row['key_name'], **values)
+        else:
+            entity = model(**values)
+        entity._storage_id = row['rowid']
+        return entity
+
+    def get(self, model, key_names):
+        if not key_names:
+            return []
+        found = {}
+        # sqlite allows 999 parameters a statement
+        for i in range(0, len(key_names), 500):
+            batch = key_names[i:i+500]
+            sql = 'select rowid, * from %s where key_name in (%s)' % (model.kind(), ', '.join(['?'] * len(batch)))
+            for row in self.execute(sql, batch):
+                found[row['key_name']] = self.entityFromRow(model, row)
+        return [found.get(key_name) for key_name in key_names]
+
+    def put(self, entities):
+        self.lock.acquire()
+        try:
+            for entity in entities:
+                self._put(entity)
+            self.connection.commit()
+        finally:
+            self.lock.release()
+
+    def _put(self, entity):
+        model = entity.__class__
+        names = propertyNames(model)
+        values = [getattr(entity, name) for name in names]
+        key_name = entity.key().name() if entity.has_key() else None
+        storage_id = getattr(entity, '_storage_id', None)
+        assignments = ', '.join(['%s = ?' % name for name in names])
+        if key_name:
+            # updated in place, so the row keeps its place in any cursor
+            cursor = self.connection.execute('update %s set %s where key_name = ?' % (model.kind(), assignments), values + [key_name])
+            if cursor.rowcount:
+                return
+            sql = 'insert into %s (key_name, %s) values (?, %s)' % (model.kind(), ', '.join(names), ', '.join(['?'] * len(names)))
+            cursor = self.connection.execute(sql, [key_name] + values)
+        elif storage_id:
+            cursor = self.connection.execute('update %s set %s where rowid = ?' % (model.kind(), assignments), values + [storage_id])
+            if cursor.rowcount:
+                return
+            # restored from a backup, it goes back under its old number
+            sql = 'insert into %s (rowid, %s) values (?, %s)' % (model.kind(), ', '.join(names), ', '.join(['?'] * len(names)))
+            cursor = self.connection.execute(sql, [storage_id] + values)
+        else:
+            sql = 'insert into %s (%s) values (%s)' % (model.kind(), ', '.join(names), ', '.join(['?'] * len(names)))
+            cursor = self.connection.execute(sql, values)
+        entity._storage_id = cursor.lastrowid
+
+    def query(self, model):
+        return SqliteQuery(self, model)
+
+    def runInTransaction(self, function, *args):
+        "every read and write goes through the lock, so holding it keeps other threads out"
+        self.lock.acquire()
+        try:
+            return function(*args)
+        finally:
+            self.lock.release()
+
+    def idOrName(self, entity):
+        if entity.has_key():
+            return entity.key().name()
+        return entity._storage_id
+
+    def newEntity(self, model, values, key_name=None, entity_id=None):
+        if key_name:
+            return model(key_name=key_name, **values)
+        entity = model(**values)
+        entity._storage_id = entity_id
+        return entity
+
+    def reserveIds(self, model, ids):
+        # new rows are numbered after the highest rowid, restored ones included
+        pass
+
+def openBackend(models):
+    "the backend named by STORAGEBACKEND, models are the db.Model classes it keeps"
+    if STORAGEBACKEND == "sqlite":
+        return SqliteBackend(SQLITEPATH, models)
+    return DatastoreBackend()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""voting: the vote forms and rpcs, and the write-behind tasks that apply
+votes to the tallies and the leaderboards. a vote rpc on a fresh instance
+loads the datastore, the task queue and simplejson, and no templates.
+"""
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp import util
+
+import instrument
+from main import VoteUp, VoteDown, RpcVoteUp, RpcVoteDown, RpcVoteBatch
+from main import ApplyVoteDeltas, FoldVoteTotals, SeedLeaderboard
+
+ROUTES = [('/increment', VoteUp),
+          ('/decrement', VoteDown),
+          ('/rpcincrement', RpcVoteUp),
+          ('/rpcdecrement', RpcVoteDown),
+          ('/rpcvotebatch', RpcVoteBatch),
+          ('/votes/apply/', ApplyVoteDeltas),
+          ('/votes/fold/', FoldVoteTotals),
+          ('/votes/seedleaderboard/', SeedLeaderboard)]
+
+def makeApplication():
+    return instrument.instrument(webapp.WSGIApplication(ROUTES, debug=True))
+
+def main():
+    util.run_wsgi_app(makeApplication())
+
+if __name__ == '__main__':
+    main()